@@ -0,0 +1,52 @@
+# Микрозамер проверки ответов викторины: сколько сообщений в секунду проверяет AnswerMatcher.matches
+# на смеси обычной болтовни в чате, почти верных и верных ответов.
+#
+#   python bench_answers.py --messages 200000
+#
+# Бот импортируется во временной папке (нужны его зависимости), Telegram не нужен.
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+ANSWERS = ["Париж|Paris", "Александрия", "Вашингтон", "1961", "Ёжик в тумане", "Марс"]
+CHATTER = [
+    "ну и вопрос", "кто знает?", "ахаха", "пропустим", "gm", "это точно не Лондон",
+    "я думаю это был Гагарин в 1961 году, но не уверен, подскажите кто-нибудь", "🔥🔥🔥", "да",
+]
+
+def typo(text, rng):
+    i = rng.randrange(len(text))
+    return text[:i] + rng.choice("абвгдеж") + text[i + 1:]
+
+def main():
+    parser = argparse.ArgumentParser(description="Скорость проверки ответов викторины")
+    parser.add_argument("--messages", type=int, default=200000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench_answers_") as workdir:
+        os.chdir(workdir)
+        os.environ.update(TELEGRAM_TOKEN="123456:bench", CHAT_ID="-100123", STATE_BACKEND="memory")
+        sys.path.insert(0, HERE)
+        import btc_bot
+
+        rng = random.Random(24)
+        cases = []
+        for _ in range(args.messages):
+            answer = rng.choice(ANSWERS)
+            variant = btc_bot.primary_answer(answer)
+            kind = rng.random()
+            message = rng.choice(CHATTER) if kind < 0.7 else typo(variant, rng) if kind < 0.9 else variant.upper()
+            cases.append((answer, message))
+
+        started = time.perf_counter()
+        matched = sum(btc_bot.compile_answer(answer).matches(message) for answer, message in cases)
+        elapsed = time.perf_counter() - started
+        print(f"{args.messages / elapsed:.0f} сообщений/с ({elapsed / args.messages * 1e6:.1f} мкс), засчитано {matched}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+# Нагрузочный прогон: один процесс бота обслуживает сотни чатов, в каждом идёт своя викторина.
+#
+#   pip install aiohttp
+#   python bench_chats.py --chats 300 --rounds 2 --latency 0.05
+#
+# Бот запускается отдельным процессом во временной папке с chats.json на --chats чатов и отвечает
+# локальной заглушке Telegram Bot API (каждый запрос — с задержкой --latency, как по сети).
+# В каждом чате администратор запускает /rpdao_trivia; на каждый вопрос три игрока отвечают сразу:
+# неверно, верно («Париж») и ещё раз верно («Paris»). Победить должен только второй.
+# Прогон длится около минуты плюс 15 секунд на каждый следующий раунд — так устроена сама викторина.
+#
+# Результат: насколько вопросы опоздали к своим 60 секундам (все таймеры чатов срабатывают разом),
+# время от ответов до объявления победителя, число победителей на чат (изоляция состояния) и память процесса.
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import psutil
+from aiohttp import web
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOKEN = "123456:bench"
+CHAT_ID = -100123
+ADMIN, WRONG, WINNER, LATE = 1, 2, 3, 4
+
+def chat_ids(count):
+    return [CHAT_ID - i for i in range(count)]
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] if values else float("nan")
+
+class FakeTelegram:
+    def __init__(self, chats, rounds, latency):
+        self.chats = chat_ids(chats)
+        self.rounds = rounds
+        self.latency = latency
+        self.pending = []
+        self.update_id = 0
+        self.message_id = 0
+        self.started = {}                                  # chat_id → когда бот подтвердил запуск викторины
+        self.question_lag = []                             # Опоздание первого вопроса относительно 60 секунд
+        self.answered = {}                                 # chat_id → когда отданы ответы на текущий вопрос
+        self.win_latency = []
+        self.winners = {chat_id: [] for chat_id in self.chats}
+        self.finished = asyncio.Event()
+
+    def next_message_id(self):
+        self.message_id += 1
+        return self.message_id
+
+    def push(self, chat_id, user_id, text):
+        self.update_id += 1
+        message = {
+            "message_id": self.next_message_id(), "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"bench {chat_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"Player{user_id}", "username": f"player{user_id}"},
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        self.pending.append({"update_id": self.update_id, "message": message})
+
+    def on_message(self, chat_id, text):
+        now = time.perf_counter()
+        if "Викторина запущена" in text:
+            self.started[chat_id] = now
+        elif "Викторина началась" in text:
+            if chat_id not in self.answered and chat_id in self.started:
+                self.question_lag.append(now - self.started[chat_id] - 60)
+            self.answered[chat_id] = now
+            self.push(chat_id, WRONG, "Лондон")
+            self.push(chat_id, WINNER, "Париж")
+            self.push(chat_id, LATE, "Paris")
+        elif "угадал слово" in text:
+            self.win_latency.append(now - self.answered[chat_id])
+            self.winners[chat_id].append(text.split()[1])
+            if all(len(names) >= self.rounds for names in self.winners.values()):
+                self.finished.set()
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        payload = dict(request.query)
+        if request.content_type == "application/json":
+            payload.update(await request.json())
+        elif request.can_read_body:
+            payload.update({k: v for k, v in (await request.post()).items() if isinstance(v, str)})
+
+        if method == "getUpdates":
+            offset = int(payload.get("offset") or 0)
+            self.pending = [u for u in self.pending if u["update_id"] >= offset]
+            if not self.pending:
+                await asyncio.sleep(0.1)                   # Как long polling без новых обновлений
+            return web.json_response({"ok": True, "result": self.pending[:100]})
+
+        await asyncio.sleep(self.latency)
+        chat_id = int(payload.get("chat_id", CHAT_ID))
+        if method == "sendMessage":
+            message_id = self.next_message_id()            # Ответы игроков должны идти после самого вопроса
+            self.on_message(chat_id, payload.get("text", ""))
+            return web.json_response({"ok": True, "result": {
+                "message_id": message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup"}, "text": payload.get("text", ""),
+            }})
+        if method == "getChatMember":
+            user_id = int(payload.get("user_id", 0))
+            return web.json_response({"ok": True, "result": {
+                "status": "administrator" if user_id == ADMIN else "member",
+                "user": {"id": user_id, "is_bot": False, "first_name": f"Player{user_id}", "username": f"player{user_id}"},
+            }})
+        return web.json_response({"ok": True, "result": True})
+
+def prepare_workdir(chats):
+    workdir = tempfile.mkdtemp(prefix="bench_chats_")
+    with open(os.path.join(workdir, "chats.json"), "w", encoding="utf-8") as f:
+        json.dump({str(chat_id): {"price_updates": False} for chat_id in chat_ids(chats)}, f)
+    with open(os.path.join(workdir, "trivia_questions.txt"), "w", encoding="utf-8") as f:
+        f.write("Столица Франции:Париж|Paris\n")
+    shutil.copy(os.path.join(HERE, "btc_bot.py"), workdir)
+    return workdir
+
+async def main():
+    parser = argparse.ArgumentParser(description="Один процесс бота и викторина в сотнях чатов")
+    parser.add_argument("--chats", type=int, default=300, help="сколько чатов обслуживает процесс")
+    parser.add_argument("--rounds", type=int, default=2, help="сколько вопросов сыграть в каждом чате")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка ответа Telegram, с")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    fake = FakeTelegram(args.chats, args.rounds, args.latency)
+    app = web.Application()
+    app.router.add_route("*", "/bot{token}/{method}", fake.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+
+    for chat_id in fake.chats:
+        fake.push(chat_id, ADMIN, "/rpdao_trivia")
+
+    workdir = prepare_workdir(args.chats)
+    env = dict(
+        os.environ,
+        TELEGRAM_TOKEN=TOKEN, CHAT_ID=str(CHAT_ID), TELEGRAM_API_URL=f"http://127.0.0.1:{args.port}",
+        DISCORD_WEBHOOK_URL="", STATE_BACKEND="memory",
+    )
+    process = subprocess.Popen([sys.executable, "btc_bot.py"], cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(fake.finished.wait(), timeout=args.timeout)
+    except asyncio.TimeoutError:
+        print(f"⚠️ За {args.timeout} с сыграно {sum(map(len, fake.winners.values()))} из {args.chats * args.rounds} раундов")
+    rss = psutil.Process(process.pid).memory_info().rss
+    elapsed = time.perf_counter() - started
+    process.terminate()
+    process.wait()
+    shutil.rmtree(workdir, ignore_errors=True)
+    await runner.cleanup()
+
+    wrong = {chat_id: names for chat_id, names in fake.winners.items() if names != [f"Player{WINNER}"] * args.rounds}
+    print(f"Чатов: {args.chats}, раундов в чате: {args.rounds}, прогон {elapsed:.1f} с, память бота {rss / 2 ** 20:.0f} МБ")
+    print(
+        f"Опоздание первого вопроса: медиана {percentile(fake.question_lag, 0.5):.2f} с, "
+        f"макс. {max(fake.question_lag, default=float('nan')):.2f} с"
+    )
+    print(
+        f"Ответ → победитель: медиана {percentile(fake.win_latency, 0.5) * 1000:.0f} мс, "
+        f"p99 {percentile(fake.win_latency, 0.99) * 1000:.0f} мс"
+    )
+    print(f"Чатов с неверными победителями: {len(wrong)}" + (f" (например, {next(iter(wrong.items()))})" if wrong else ""))
+
+if __name__ == "__main__":
+    asyncio.run(main())
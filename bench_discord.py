@@ -0,0 +1,111 @@
+# Замер outbox пересылки в Discord (discord_outbox.db): всплеск сообщений, пока Discord недоступен,
+# и их повторная отправка после перезапуска бота.
+#
+#   python bench_discord.py --messages 3000 --latency 0.02
+#
+# 1. Первый процесс бота без потоков отправки (Discord «лежит») вызывает send_to_discord --messages раз —
+#    так же, как обработчик сообщений Telegram. Результат — записей в outbox в секунду и p99 времени вызова:
+#    столько обработчик (и polling) ждёт на каждом сообщении.
+# 2. Второй процесс — как после перезапуска: поднимает outbox, запускает DISCORD_WORKERS потоков и
+#    отправляет всё накопленное в заглушку вебхука (ответ через --latency). Результат — сообщений в секунду
+#    и сколько POST понадобилось (идущие подряд тексты одного автора склеиваются).
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CHAT_ID = -100123
+
+class FakeWebhook(BaseHTTPRequestHandler):
+    latency = 0.0
+    posts = 0
+    lines = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        time.sleep(self.latency)
+        with FakeWebhook.lock:
+            FakeWebhook.posts += 1
+            FakeWebhook.lines += len(payload["content"].splitlines())
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+# Импорт бота во временной папке: базы и файлы создаются там же
+def import_bot(workdir, webhook_url, workers):
+    os.chdir(workdir)
+    os.environ.update(
+        TELEGRAM_TOKEN="123456:bench", CHAT_ID=str(CHAT_ID), STATE_BACKEND="memory",
+        DISCORD_WEBHOOK_URL=webhook_url, DISCORD_WORKERS=str(workers),
+    )
+    sys.path.insert(0, HERE)
+    import btc_bot
+    return btc_bot
+
+def burst(workdir, webhook_url, messages, results):
+    btc_bot = import_bot(workdir, webhook_url, 1)
+    calls = []
+    started = time.perf_counter()
+    for i in range(messages):
+        t = time.perf_counter()
+        btc_bot.send_to_discord(f"Сообщение {i}", username=f"user{i // 10 % 7}", source_id=f"{CHAT_ID}:{i}")
+        calls.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - started
+    calls.sort()
+    results.put({"rate": messages / elapsed, "p99": calls[int(len(calls) * 0.99)], "pending": btc_bot._outbox_pending})
+
+def replay(workdir, webhook_url, workers, results):
+    btc_bot = import_bot(workdir, webhook_url, workers)
+    pending = btc_bot._outbox_pending
+    started = time.perf_counter()
+    for _ in range(btc_bot.DISCORD_WORKERS):
+        threading.Thread(target=btc_bot.discord_worker, daemon=True).start()
+    while btc_bot._outbox_pending:
+        time.sleep(0.01)
+    results.put({"pending": pending, "elapsed": time.perf_counter() - started})
+
+def run_phase(target, *args):
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    process = ctx.Process(target=target, args=(*args, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Всплеск и повторная отправка через outbox Discord")
+    parser.add_argument("--messages", type=int, default=3000, help="сколько сообщений прислать за всплеск")
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа вебхука, с")
+    parser.add_argument("--workers", type=int, default=1, help="DISCORD_WORKERS при повторной отправке")
+    args = parser.parse_args()
+
+    FakeWebhook.latency = args.latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeWebhook)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    webhook_url = f"http://127.0.0.1:{server.server_port}/webhook"
+
+    with tempfile.TemporaryDirectory(prefix="bench_discord_") as workdir:
+        result = run_phase(burst, workdir, webhook_url, args.messages)
+        print(f"Всплеск: {result['rate']:.0f} записей/с, p99 вызова {result['p99'] * 1000:.2f} мс, в outbox {result['pending']}")
+
+        result = run_phase(replay, workdir, webhook_url, args.workers)
+        print(
+            f"Перезапуск: {result['pending']} сообщений отправлено за {result['elapsed']:.2f} с "
+            f"({result['pending'] / result['elapsed']:.0f} сообщений/с), POST в вебхук: {FakeWebhook.posts}"
+        )
+        if FakeWebhook.lines != args.messages:
+            print(f"⚠️ Вебхук получил {FakeWebhook.lines} сообщений из {args.messages}")
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
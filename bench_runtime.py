@@ -0,0 +1,157 @@
+# Сравнение режимов BOT_RUNTIME=threaded и BOT_RUNTIME=async: сколько /price в секунду бот
+# обрабатывает против локальной заглушки Telegram Bot API (и провайдера цены).
+#
+#   pip install aiohttp
+#   python bench_runtime.py --updates 2000 --chats 64 --latency 0.05
+#
+# Бот запускается отдельным процессом во временной папке (нужны background.jpg и шрифт рядом со скриптом).
+# Заглушка отдаёт все обновления через getUpdates и отвечает на sendPhoto с задержкой --latency,
+# как настоящий Telegram по сети. Результат — обновлений в секунду от первого getUpdates до последнего фото.
+# Обновления распределены по --chats чатам (для них пишется chats.json): в обычном режиме обновления
+# одного чата идут по порядку через один поток диспетчера, поэтому с --chats 1 замер показывает
+# только это ограничение (не больше 1/latency в секунду), а не разницу режимов.
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOKEN = "123456:bench"
+CHAT_ID = -100123
+
+def chat_ids(count):
+    return [CHAT_ID - i for i in range(count)]
+
+class FakeTelegram:
+    def __init__(self, count, chats, latency):
+        self.count = count
+        self.chats = chat_ids(chats)
+        self.latency = latency
+        self.pending = []
+        self.sent = 0
+        self.started = None
+        self.finished = asyncio.Event()
+        self.elapsed = None
+
+    def reset(self):
+        now = int(time.time())
+        self.pending = [{
+            "update_id": 1000 + i,
+            "message": {
+                "message_id": 10 + i, "date": now, "text": "/price",
+                "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+                "chat": {"id": self.chats[i % len(self.chats)], "type": "supergroup", "title": "bench"},
+                "from": {"id": 1 + i % 50, "is_bot": False, "first_name": "Bench", "username": f"user{i % 50}"},
+            },
+        } for i in range(self.count)]
+        self.sent = 0
+        self.started = None
+        self.elapsed = None
+        self.finished = asyncio.Event()
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        payload = dict(request.query)
+        if request.content_type == "application/json":
+            payload.update(await request.json())
+        elif request.can_read_body:
+            payload.update({k: v for k, v in (await request.post()).items() if isinstance(v, str)})
+
+        if method == "getUpdates":
+            if self.started is None:
+                self.started = time.perf_counter()
+            offset = int(payload.get("offset") or 0)
+            updates = [u for u in self.pending if u["update_id"] >= offset][:100]
+            self.pending = [u for u in self.pending if u["update_id"] >= offset]
+            if not updates:
+                await asyncio.sleep(0.5)                   # Как long polling без новых обновлений
+            return web.json_response({"ok": True, "result": updates})
+
+        if method in ("sendPhoto", "sendMessage"):
+            await asyncio.sleep(self.latency)
+            self.sent += 1
+            if self.sent == self.count:
+                self.elapsed = time.perf_counter() - self.started
+                self.finished.set()
+            return web.json_response({"ok": True, "result": {
+                "message_id": 100000 + self.sent, "date": int(time.time()),
+                "chat": {"id": int(payload.get("chat_id", CHAT_ID)), "type": "supergroup"},
+                "photo": [{"file_id": "bench-photo", "file_unique_id": "bench", "width": 1058, "height": 770}],
+            }})
+
+        return web.json_response({"ok": True, "result": True})
+
+async def price(request):
+    await asyncio.sleep(0.2)
+    return web.json_response({"bitcoin": {"usd": 65000.42}})
+
+def prepare_workdir(chats):
+    workdir = tempfile.mkdtemp(prefix="bench_bot_")
+    with open(os.path.join(workdir, "chats.json"), "w", encoding="utf-8") as f:
+        json.dump({str(chat_id): {"price_updates": False} for chat_id in chat_ids(chats)}, f)
+    for name in ("btc_bot.py", "background.jpg", "morning.jpg", "night.jpg", "botlogo.png", "trivia_questions.txt", "SpicyRice-Regular.ttf"):
+        path = os.path.join(HERE, name)
+        if os.path.exists(path):
+            shutil.copy(path, workdir)
+    if not os.path.exists(os.path.join(workdir, "SpicyRice-Regular.ttf")):
+        sys.exit("❌ Рядом со скриптом нет SpicyRice-Regular.ttf — картинку /price не нарисовать.")
+    return workdir
+
+async def run_mode(fake, runtime, port, timeout):
+    fake.reset()
+    workdir = prepare_workdir(len(fake.chats))
+    env = dict(
+        os.environ,
+        TELEGRAM_TOKEN=TOKEN, CHAT_ID=str(CHAT_ID), BOT_RUNTIME=runtime,
+        TELEGRAM_API_URL=f"http://127.0.0.1:{port}",
+        PRICE_PROVIDERS="coingecko", COINGECKO_URL=f"http://127.0.0.1:{port}/price",
+        DISCORD_WEBHOOK_URL="",
+    )
+    process = subprocess.Popen([sys.executable, "btc_bot.py"], cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        await asyncio.wait_for(fake.finished.wait(), timeout=timeout)
+        return fake.count / fake.elapsed
+    except asyncio.TimeoutError:
+        print(f"⚠️ {runtime}: за {timeout} с отправлено {fake.sent} из {fake.count}")
+        return None
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+async def main():
+    parser = argparse.ArgumentParser(description="Сравнение BOT_RUNTIME=threaded и async на заглушке Bot API")
+    parser.add_argument("--updates", type=int, default=2000, help="сколько /price прислать")
+    parser.add_argument("--chats", type=int, default=64, help="по скольким чатам распределить обновления")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка ответа Telegram на sendPhoto, с")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    fake = FakeTelegram(args.updates, args.chats, args.latency)
+    app = web.Application(client_max_size=20 * 1024 * 1024)
+    app.router.add_get("/price", price)
+    app.router.add_route("*", "/bot{token}/{method}", fake.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+
+    results = {}
+    for runtime in ("threaded", "async"):
+        results[runtime] = await run_mode(fake, runtime, args.port, args.timeout)
+        if results[runtime]:
+            print(f"{runtime:>8}: {results[runtime]:.1f} обновлений/с")
+    await runner.cleanup()
+
+    if results["threaded"] and results["async"]:
+        print(f"async быстрее в {results['async'] / results['threaded']:.1f} раз")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+# Замер начисления очков: add_score (таблица и лидерборд в памяти) и запись пачками flush_scores в scores.db.
+#
+#   python bench_scores.py --players 100000 --increments 200000
+#
+# Бот импортируется во временной папке, где заранее создан scores.db с --players игроками одного чата.
+# Начисления идут случайным игрокам из одного потока, а run_score_flusher, как в боте, пишет пачки
+# в фоне (SCORE_FLUSH_EVERY). Результат — начислений в секунду, время одной записи пачки
+# и проверка, что после последней записи сумма очков в базе совпадает с памятью.
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CHAT_ID = "-100123"
+
+def seed_scores(path, players):
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE chat_scores (chat_id TEXT NOT NULL, user_id TEXT NOT NULL, points INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (chat_id, user_id))")
+    db.executemany("INSERT INTO chat_scores VALUES (?, ?, ?)", ((CHAT_ID, str(100000 + i), random.randint(0, 500)) for i in range(players)))
+    db.commit()
+    db.close()
+
+def db_total(btc_bot):
+    with btc_bot._score_db_lock:
+        return btc_bot.score_db.execute("SELECT SUM(points) FROM chat_scores WHERE chat_id = ?", (CHAT_ID,)).fetchone()[0]
+
+def main():
+    parser = argparse.ArgumentParser(description="Начисление очков add_score и запись flush_scores")
+    parser.add_argument("--players", type=int, default=100000, help="игроков в таблице чата")
+    parser.add_argument("--increments", type=int, default=200000, help="сколько начислений сделать")
+    parser.add_argument("--flush-every", type=int, default=50, help="SCORE_FLUSH_EVERY")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench_scores_") as workdir:
+        os.chdir(workdir)
+        seed_scores("scores.db", args.players)
+        os.environ.update(
+            TELEGRAM_TOKEN="123456:bench", CHAT_ID=CHAT_ID, STATE_BACKEND="memory",
+            SCORE_FLUSH_EVERY=str(args.flush_every),
+        )
+        sys.path.insert(0, HERE)
+        started = time.perf_counter()
+        import btc_bot
+        print(f"Загрузка {btc_bot.leaderboard_size(CHAT_ID)} игроков и лидерборда: {time.perf_counter() - started:.2f} с")
+
+        # Время записи пачек — обёртка вокруг flush_scores, которую вызывает фоновый поток
+        flushes = []
+        flush_scores = btc_bot.flush_scores
+        def timed_flush():
+            t = time.perf_counter()
+            flush_scores()
+            flushes.append(time.perf_counter() - t)
+        btc_bot.flush_scores = timed_flush
+        threading.Thread(target=btc_bot.run_score_flusher, daemon=True).start()
+
+        users = [str(100000 + random.randrange(args.players)) for _ in range(args.increments)]
+        started = time.perf_counter()
+        for user_id in users:
+            btc_bot.add_score(CHAT_ID, user_id, 5)
+        elapsed = time.perf_counter() - started
+        print(f"add_score: {args.increments / elapsed:.0f} начислений/с ({elapsed / args.increments * 1e6:.1f} мкс на начисление)")
+
+        flush_scores()
+        flushes.sort()
+        if flushes:
+            print(
+                f"flush_scores: {len(flushes)} пачек, медиана {flushes[len(flushes) // 2] * 1000:.2f} мс, "
+                f"p99 {flushes[int(len(flushes) * 0.99)] * 1000:.2f} мс"
+            )
+        memory_total = sum(btc_bot.scores[CHAT_ID].values())
+        print(f"Сумма очков: в базе {db_total(btc_bot)}, в памяти {memory_total}")
+
+if __name__ == "__main__":
+    main()
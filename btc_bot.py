@@ -5,23 +5,52 @@ import psutil
 import random
 import requests
 from requests.exceptions import ReadTimeout
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageOps
 import datetime
 import time
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from telebot.types import Message
 from telebot.apihelper import ApiTelegramException
-from collections import defaultdict
-from discord_webhook import DiscordWebhook
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import schedule
 import logging
 import threading
-from threading import Timer
+import queue
 import json
-import tempfile
+import heapq
+import array
+import bisect
+import itertools
+import functools
+import sqlite3
+import io
+import hashlib
+import unicodedata
+import hmac
+import secrets
 import uuid
+import socket
+import pickle
+import signal
+import atexit
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# websocket-client нужен только для потокового тикера по ws:// (необязательно)
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+# aiohttp нужен только для асинхронного режима BOT_RUNTIME=async (необязательно)
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 # === ЗАГРУЗКА ПЕРЕМЕННЫХ ОКРУЖЕНИЯ ===
 load_dotenv()
@@ -31,11 +60,13 @@ TOKEN = os.getenv("TELEGRAM_TOKEN")
 CHAT_ID = str(os.getenv("CHAT_ID"))
 DISCORD_WEBHOOK_URL = os.getenv("DISCORD_WEBHOOK_URL")
 DISCORD_AVATAR_URL = os.getenv("DISCORD_AVATAR_URL")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")       # Свой Bot API сервер (Local Bot API, заглушка для замеров)
 BACKGROUND_PATH = 'background.jpg'
 FONT_PATH = 'SpicyRice-Regular.ttf'
 
-# Проверка обязательных переменных
-if not TOKEN or not CHAT_ID:
+# Проверка обязательных переменных — до того, как бот откроет базы и перенесёт старые очки
+# (без CHAT_ID они ушли бы в чат "None"). Импорт модуля, например в тестах, не завершает процесс
+if __name__ == "__main__" and (not TOKEN or not os.getenv("CHAT_ID")):
     logging.critical("TELEGRAM_TOKEN или CHAT_ID не заданы в переменных окружения.")
     sys.exit(1)
 
@@ -70,48 +101,547 @@ schedule.every(3).days.do(clear_log_file)
 # ==== БЛОКИРОВКА ЗАПУСКА ====
 LOCK_FILE = "bot.lock"
 
-# ==== ТАБЛИЦА ЛИДЕРОВ ====
-SCORE_FILE = "scores.json"
+# ==== НАСТРОЙКИ ЧАТОВ ====
+# Один процесс обслуживает все чаты из chats.json (плюс основной CHAT_ID). Пример файла:
+# {"-100123": {"discord_webhook_url": "https://discord.com/api/webhooks/...", "background": "bg2.jpg", "price_updates": false}}
+# Не указанные ключи берутся по умолчанию; Discord и аватар из .env — только у основного чата.
+CHATS_FILE = os.getenv("CHATS_FILE", "chats.json")
+DEFAULT_CHAT_CONFIG = {
+    "discord_webhook_url": None,                           # Куда пересылать сообщения чата (None — не пересылать)
+    "discord_avatar_url": None,
+    "background": BACKGROUND_PATH,                         # Фон для /price и рассылки цены
+    "morning_background": "morning.jpg",                   # Фон для /gm
+    "night_background": "night.jpg",                       # Фон для /gn
+    "price_updates": True,                                 # Рассылать цену BTC каждые 4 часа
+}
 
-# Загружаем счёт
-def load_scores():
+def load_chat_configs():
+    configs = {CHAT_ID: {"discord_webhook_url": DISCORD_WEBHOOK_URL, "discord_avatar_url": DISCORD_AVATAR_URL}}
+    if os.path.exists(CHATS_FILE):
+        try:
+            with open(CHATS_FILE, "r", encoding="utf-8") as f:
+                for chat_id, config in json.load(f).items():
+                    configs.setdefault(str(chat_id), {}).update(config)
+        except Exception as e:
+            logging.error(f"Ошибка при чтении {CHATS_FILE}: {e}")
+    return {chat_id: {**DEFAULT_CHAT_CONFIG, **config} for chat_id, config in configs.items()}
+
+chat_configs = load_chat_configs()                         # chat_id → настройки
+logging.info(f"Обслуживаемых чатов: {len(chat_configs)}")
+
+# Настройки чата или None, если бот в этом чате не работает
+def chat_config(chat_id):
+    return chat_configs.get(str(chat_id))
+
+# ==== ХРАНИЛИЩЕ СОСТОЯНИЯ ====
+# STATE_BACKEND=memory — игры живут в памяти, работает один процесс (bot.lock).
+# STATE_BACKEND=sqlite — состояние чатов, их таймеры и аренды лежат в общем SQLite-файле (общий том),
+# поэтому можно запускать несколько процессов. Рассылки по расписанию и игровые таймеры выполняет
+# только лидер — процесс, держащий аренду "scheduler"; при его остановке аренду через
+# LEADER_LEASE_TTL секунд забирает другой процесс.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")       # memory | sqlite
+STATE_DB_FILE = os.getenv("STATE_DB_FILE", "state.db")
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "30"))
+STATE_TIMER_POLL = 1                                       # Как часто лидер проверяет игровые таймеры (сек)
+CHAT_LEASE_TTL = 60                                        # Сколько сессия чата может держать его аренду (сек)
+CHAT_LEASE_POLL = 0.02                                     # Пауза между попытками взять занятую аренду чата (сек)
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+class MemoryStateBackend:
+    """Состояние чатов в памяти процесса (один экземпляр бота)."""
+
+    shared = False
+
+    def __init__(self):
+        self._states = {}
+        self._guard = threading.Lock()
+
+    # Состояние чата под его замком; factory создаёт состояние нового чата
+    @contextmanager
+    def chat_session(self, chat_id, factory):
+        state = self._states.get(chat_id)
+        if state is None:
+            with self._guard:
+                state = self._states.setdefault(chat_id, factory(chat_id))
+        with state.lock:
+            yield state
+
+    def due_chats(self, now):
+        return []
+
+    # Открыт ли в чате раунд викторины (без замка — только как быстрый фильтр)
+    def accepts_answers(self, chat_id):
+        state = self._states.get(chat_id)
+        return state is not None and state.accepts_answers()
+
+    def acquire_lease(self, name, ttl):
+        return True
+
+class SQLiteStateBackend:
+    """Состояние чатов в общем SQLite-файле. Сессию чата открывает аренда его строки в leases:
+    другие процессы ждут только этот чат. Состояние читается и записывается короткими запросами,
+    запросы к Telegram внутри сессии базу не блокируют. Запись — compare-and-set по версии:
+    если аренду забрали по истечении TTL и состояние уже перезаписано, устаревшая запись отбрасывается."""
+
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._chat_locks = {}
+        self._guard = threading.Lock()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS chat_state (chat_id TEXT PRIMARY KEY, data BLOB NOT NULL, next_due REAL, version INTEGER NOT NULL DEFAULT 0, answers_open INTEGER NOT NULL DEFAULT 0)")
+        conn.execute("CREATE INDEX IF NOT EXISTS chat_state_due ON chat_state (next_due)")
+        conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)")
+
+    # Своё соединение на поток; каждый запрос — отдельная короткая транзакция
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # Потоки этого процесса ждут чат на своём замке, а не опрашивают аренду в базе
+    def _chat_lock(self, chat_id):
+        lock = self._chat_locks.get(chat_id)
+        if lock is None:
+            with self._guard:
+                lock = self._chat_locks.setdefault(chat_id, threading.Lock())
+        return lock
+
+    @contextmanager
+    def chat_session(self, chat_id, factory):
+        lease = f"chat:{chat_id}"
+        with self._chat_lock(chat_id):
+            while not self.acquire_lease(lease, CHAT_LEASE_TTL):
+                time.sleep(CHAT_LEASE_POLL)                # Чат занят другим процессом
+            try:
+                conn = self._conn()
+                row = conn.execute("SELECT data, version FROM chat_state WHERE chat_id = ?", (chat_id,)).fetchone()
+                state = pickle.loads(row[0]) if row else factory(chat_id)
+                try:
+                    yield state
+                finally:
+                    # Как и в памяти: изменения сохраняются, даже если обработчик упал на середине
+                    self._save(conn, chat_id, state, row[1] if row else None)
+            finally:
+                self.release_lease(lease)
+
+    def _save(self, conn, chat_id, state, version):
+        values = (pickle.dumps(state), state.next_due(), int(state.accepts_answers()), chat_id)
+        if version is None:
+            saved = conn.execute("INSERT OR IGNORE INTO chat_state (data, next_due, answers_open, chat_id) VALUES (?, ?, ?, ?)", values).rowcount
+        else:
+            saved = conn.execute(
+                "UPDATE chat_state SET data = ?, next_due = ?, answers_open = ?, version = version + 1 WHERE chat_id = ? AND version = ?",
+                values + (version,)
+            ).rowcount
+        if not saved:
+            logging.warning(f"Состояние чата {chat_id} изменено другим процессом после истечения аренды — изменения сессии отброшены")
+
+    def accepts_answers(self, chat_id):
+        row = self._conn().execute("SELECT answers_open FROM chat_state WHERE chat_id = ?", (chat_id,)).fetchone()
+        return bool(row and row[0])
+
+    # Чаты, у которых наступил срок хотя бы одного таймера
+    def due_chats(self, now):
+        return [row[0] for row in self._conn().execute("SELECT chat_id FROM chat_state WHERE next_due <= ?", (now,))]
+
+    # Продлить свою аренду или забрать просроченную; True — аренда наша
+    def acquire_lease(self, name, ttl):
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) ON CONFLICT(name) DO UPDATE "
+            "SET owner = excluded.owner, expires = excluded.expires WHERE leases.owner = excluded.owner OR leases.expires < ?",
+            (name, INSTANCE_ID, now + ttl, now)
+        )
+        return conn.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()[0] == INSTANCE_ID
+
+    # Отдать аренду при штатной остановке, чтобы другой процесс не ждал TTL
+    def release_lease(self, name):
+        self._conn().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, INSTANCE_ID))
+
+if STATE_BACKEND == "sqlite":
+    state_backend = SQLiteStateBackend(STATE_DB_FILE)
+    logging.info(f"Общее хранилище состояния: {STATE_DB_FILE} (экземпляр {INSTANCE_ID})")
+else:
+    state_backend = MemoryStateBackend()
+
+_leader_until = 0.0                                        # До какого момента (monotonic) мы точно лидер
+
+def is_leader():
+    return not state_backend.shared or time.monotonic() < _leader_until
+
+def run_leader_election():
+    global _leader_until
+    while True:
+        was_leader = is_leader()
+        started = time.monotonic()
+        try:
+            if state_backend.acquire_lease("scheduler", LEADER_LEASE_TTL):
+                # Запас в треть TTL: перестаём считать себя лидером раньше, чем аренда истечёт в базе
+                _leader_until = started + LEADER_LEASE_TTL * 2 / 3
+            else:
+                _leader_until = 0.0
+        except Exception as e:
+            logging.error(f"Ошибка продления аренды лидера: {e}")
+        if is_leader() != was_leader:
+            logging.info(f"Экземпляр {INSTANCE_ID} {'стал лидером' if is_leader() else 'больше не лидер'}")
+        time.sleep(LEADER_LEASE_TTL / 3)
+
+# Задача по расписанию выполняется только у лидера
+def leader_only(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if is_leader():
+            return func(*args, **kwargs)
+    return wrapper
+
+# ==== ТАБЛИЦА ЛИДЕРОВ ====
+# Очки хранятся в SQLite (WAL). Начисление сразу меняет таблицу в памяти, а в базу изменения
+# пишутся пачкой (write-behind): по таймеру, после SCORE_FLUSH_EVERY начислений и при остановке.
+# Пачка пишется одной транзакцией, поэтому сбой не портит таблицу. У каждого чата свой лидерборд.
+SCORE_DB_FILE = os.getenv("SCORE_DB_FILE", "scores.db")
+SCORE_FILE = "scores.json"                                 # Старый формат, импортируется один раз
+SCORE_FLUSH_INTERVAL = float(os.getenv("SCORE_FLUSH_INTERVAL", "5"))
+SCORE_FLUSH_EVERY = int(os.getenv("SCORE_FLUSH_EVERY", "50"))
+PROFILE_TTL = int(os.getenv("PROFILE_TTL", "86400"))                 # Через сколько секунд профиль обновляется из Telegram
+PROFILE_REFRESH_BATCH = int(os.getenv("PROFILE_REFRESH_BATCH", "20"))  # Сколько профилей обновлять за один проход
+
+_score_lock = threading.Lock()                             # Таблица в памяти и несохранённые изменения
+_score_db_lock = threading.Lock()                          # Соединение с базой
+_score_deltas = {}                                         # (chat_id, user_id) → ещё не записанная прибавка
+_profile_dirty = {}                                        # user_id → ещё не записанный профиль
+_fastest_pending = {}                                      # (chat_id, user_id) → [лучшее время, побед] ещё не записанных
+_score_flush_needed = threading.Event()
+score_db = sqlite3.connect(SCORE_DB_FILE, check_same_thread=False)
+score_db.execute("PRAGMA journal_mode=WAL")
+score_db.execute("PRAGMA synchronous=NORMAL")
+score_db.execute("CREATE TABLE IF NOT EXISTS scores (user_id TEXT PRIMARY KEY, points INTEGER NOT NULL DEFAULT 0)")   # Старая общая таблица
+score_db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+score_db.execute("CREATE TABLE IF NOT EXISTS chat_scores (chat_id TEXT NOT NULL, user_id TEXT NOT NULL, points INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (chat_id, user_id))")
+score_db.execute("CREATE TABLE IF NOT EXISTS profiles (user_id TEXT PRIMARY KEY, username TEXT, first_name TEXT, updated_at REAL NOT NULL)")
+score_db.execute("CREATE TABLE IF NOT EXISTS trivia_fastest (chat_id TEXT NOT NULL, user_id TEXT NOT NULL, best INTEGER NOT NULL, wins INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (chat_id, user_id))")
+score_db.commit()
+
+# Однократный перенос scores.json в базу
+def migrate_json_scores():
+    if score_db.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+        return
+    imported = {}
     if os.path.exists(SCORE_FILE):
         with open(SCORE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
+            imported = json.load(f)
+    with score_db:
+        score_db.executemany(
+            "INSERT INTO scores (user_id, points) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET points = points + excluded.points",
+            [(str(user_id), int(points)) for user_id, points in imported.items()]
+        )
+        score_db.execute("INSERT INTO meta (key, value) VALUES ('json_imported', ?)", (str(time.time()),))
+    if imported:
+        logging.info(f"Импортировано {len(imported)} записей из {SCORE_FILE} в {SCORE_DB_FILE}.")
+
+# Однократный перенос общей таблицы (до поддержки нескольких чатов) в таблицу основного чата
+def migrate_chat_scores():
+    if not os.getenv("CHAT_ID"):                           # Некуда переносить — ждём запуска с CHAT_ID
+        return
+    if score_db.execute("SELECT 1 FROM meta WHERE key = 'chat_scores_migrated'").fetchone():
+        return
+    with score_db:
+        score_db.execute("INSERT OR IGNORE INTO chat_scores (chat_id, user_id, points) SELECT ?, user_id, points FROM scores", (CHAT_ID,))
+        score_db.execute("INSERT INTO meta (key, value) VALUES ('chat_scores_migrated', ?)", (str(time.time()),))
 
-# Сохраняем счёт
-def save_scores(scores):
-    with open(SCORE_FILE, "w", encoding="utf-8") as f:
-        json.dump(scores, f, ensure_ascii=False, indent=2)
+# Загружаем счёт: chat_id → {user_id: очки}
+def load_scores():
+    loaded = {}
+    for chat_id, user_id, points in score_db.execute("SELECT chat_id, user_id, points FROM chat_scores"):
+        loaded.setdefault(chat_id, {})[user_id] = points
+    return loaded
+
+# Индекс лидерборда каждого чата: отсортированный список (-очки, user_id), обновляется при каждом начислении.
+# Страница — срез, место игрока — бинарный поиск; полная сортировка не нужна.
+# Каждое изменение увеличивает leaderboard_version и помечает страницы, где сдвинулись места.
+LEADERBOARD_PAGE_SIZE = 10
+leaderboards = {}                                          # chat_id → [(-очки, user_id), ...]
+leaderboard_version = 0
+_page_invalidated = {}                                     # (chat_id, страница) → версия, на которой она изменилась
+_all_invalidated = 0                                       # Версия, на которой устарели все страницы
+
+def build_leaderboard():
+    global leaderboards
+    with _score_lock:
+        leaderboards = {
+            chat_id: sorted((-points, user_id) for user_id, points in table.items())
+            for chat_id, table in scores.items()
+        }
+
+# Помечаем страницы чата с местами first..last (с 0) как изменённые; вызывать под _score_lock
+def _invalidate_ranks(chat_id, first, last):
+    global leaderboard_version
+    leaderboard_version += 1
+    for page in range(first // LEADERBOARD_PAGE_SIZE, last // LEADERBOARD_PAGE_SIZE + 1):
+        _page_invalidated[(chat_id, page)] = leaderboard_version
+
+def _reindex_score(chat_id, user_id, old_points, new_points):
+    board = leaderboards.setdefault(chat_id, [])
+    old_index = None
+    if old_points is not None:
+        i = bisect.bisect_left(board, (-old_points, user_id))
+        if i < len(board) and board[i] == (-old_points, user_id):
+            del board[i]
+            old_index = i
+    new_index = bisect.bisect_left(board, (-new_points, user_id))
+    board.insert(new_index, (-new_points, user_id))
+    if old_index is None:
+        # Новый игрок сдвигает всех ниже и может добавить кнопку «Далее» предыдущей странице
+        _invalidate_ranks(chat_id, max(0, min(new_index, len(board) - 2)), len(board) - 1)
+    else:
+        _invalidate_ranks(chat_id, min(old_index, new_index), max(old_index, new_index))
+
+# Актуален ли рендер страницы, сделанный на версии version
+def leaderboard_page_fresh(chat_id, page, version):
+    return max(_page_invalidated.get((str(chat_id), page), 0), _all_invalidated) <= version
 
-# Глобальная таблица очков
+# Страница лидерборда чата: список (место, user_id, очки), общее число игроков и версия
+def leaderboard_page(chat_id, page, per_page=LEADERBOARD_PAGE_SIZE):
+    start = page * per_page
+    with _score_lock:
+        board = leaderboards.get(str(chat_id), [])
+        rows = board[start:start + per_page]
+        total = len(board)
+        version = leaderboard_version
+    return [(start + i + 1, user_id, -neg) for i, (neg, user_id) in enumerate(rows)], total, version
+
+# Место игрока в чате (с 1) и его очки; None, если очков у него нет
+def leaderboard_rank(chat_id, user_id):
+    chat_id, user_id = str(chat_id), str(user_id)
+    with _score_lock:
+        points = scores.get(chat_id, {}).get(user_id)
+        if points is None:
+            return None
+        return bisect.bisect_left(leaderboards[chat_id], (-points, user_id)) + 1, points
+
+def leaderboard_size(chat_id):
+    return len(leaderboards.get(str(chat_id), []))
+
+# Начисление очков в чате (в памяти, за микросекунды); возвращает новый счёт игрока
+def add_score(chat_id, user_id, points):
+    chat_id, user_id = str(chat_id), str(user_id)
+    key = (chat_id, user_id)
+    with _score_lock:
+        table = scores.setdefault(chat_id, {})
+        _reindex_score(chat_id, user_id, table.get(user_id), table.get(user_id, 0) + points)
+        table[user_id] = table.get(user_id, 0) + points
+        _score_deltas[key] = _score_deltas.get(key, 0) + points
+        if len(_score_deltas) >= SCORE_FLUSH_EVERY:
+            _score_flush_needed.set()
+        return table[user_id]
+
+# Лучшее время и победы игрока в буфер (вызывать под _score_lock)
+def _merge_fastest(key, best, wins):
+    pending = _fastest_pending.get(key)
+    if pending is None:
+        _fastest_pending[key] = [best, wins]
+    else:
+        pending[0] = min(pending[0], best)
+        pending[1] += wins
+
+# Запись накопленных изменений (очки, профили, быстрые ответы) в базу одной транзакцией
+def flush_scores():
+    global _score_deltas, _profile_dirty, _fastest_pending
+    with _score_db_lock:
+        with _score_lock:
+            deltas, _score_deltas = _score_deltas, {}
+            dirty, _profile_dirty = _profile_dirty, {}
+            fastest, _fastest_pending = _fastest_pending, {}
+        if not deltas and not dirty and not fastest:
+            return
+        try:
+            with score_db:
+                score_db.executemany(
+                    "INSERT INTO chat_scores (chat_id, user_id, points) VALUES (?, ?, ?) ON CONFLICT(chat_id, user_id) DO UPDATE SET points = points + excluded.points",
+                    [(chat_id, user_id, points) for (chat_id, user_id), points in deltas.items()]
+                )
+                score_db.executemany(
+                    "INSERT OR REPLACE INTO profiles (user_id, username, first_name, updated_at) VALUES (?, ?, ?, ?)",
+                    [(user_id,) + profile for user_id, profile in dirty.items()]
+                )
+                score_db.executemany(
+                    "INSERT INTO trivia_fastest (chat_id, user_id, best, wins) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(chat_id, user_id) DO UPDATE SET best = MIN(best, excluded.best), wins = wins + excluded.wins",
+                    [(chat_id, user_id, best, wins) for (chat_id, user_id), (best, wins) in fastest.items()]
+                )
+        except Exception as e:
+            # Возвращаем изменения обратно, запишем при следующей попытке
+            with _score_lock:
+                for key, points in deltas.items():
+                    _score_deltas[key] = _score_deltas.get(key, 0) + points
+                for user_id, profile in dirty.items():
+                    _profile_dirty.setdefault(user_id, profile)
+                for key, (best, wins) in fastest.items():
+                    _merge_fastest(key, best, wins)
+            logging.error(f"Ошибка при сохранении очков: {e}")
+            return
+    logging.debug(f"Сохранены очки {len(deltas)} игроков и {len(dirty)} профилей.")
+
+# Общее хранилище: подхватываем очки и профили, записанные другими процессами
+_score_data_version = None
+
+def reload_shared_scores():
+    global scores, profiles, leaderboards, leaderboard_version, _all_invalidated, _score_data_version
+    with _score_db_lock:
+        # data_version меняется только после записи из другого соединения
+        data_version = score_db.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == _score_data_version:
+            return
+        _score_data_version = data_version
+        loaded = load_scores()
+        loaded_profiles = load_profiles()
+        with _score_lock:
+            # Ещё не записанные свои начисления поверх прочитанного
+            for (chat_id, user_id), points in _score_deltas.items():
+                table = loaded.setdefault(chat_id, {})
+                table[user_id] = table.get(user_id, 0) + points
+            loaded_profiles.update(_profile_dirty)
+            scores, profiles = loaded, loaded_profiles
+            leaderboards = {
+                chat_id: sorted((-points, user_id) for user_id, points in table.items())
+                for chat_id, table in scores.items()
+            }
+            leaderboard_version += 1
+            _all_invalidated = leaderboard_version
+
+def run_score_flusher():
+    while True:
+        _score_flush_needed.wait(timeout=SCORE_FLUSH_INTERVAL)
+        _score_flush_needed.clear()
+        flush_scores()
+        if state_backend.shared:
+            try:
+                reload_shared_scores()
+            except Exception as e:
+                logging.error(f"Ошибка при чтении общих очков: {e}")
+
+# Данные не теряются при обычном завершении процесса
+atexit.register(flush_scores)
+
+# Таблицы очков чатов (копия базы в памяти для чтения)
+migrate_json_scores()
+migrate_chat_scores()
 scores = load_scores()
+build_leaderboard()
+
+# ==== ПРОФИЛИ ИГРОКОВ ====
+# Имена берутся из from_user каждого входящего обновления, поэтому лидерборду и /reroll
+# не нужны запросы get_chat_member. Профили общие для всех чатов и сохраняются в scores.db вместе с очками.
+def load_profiles():
+    return {
+        user_id: (username, first_name, updated_at)
+        for user_id, username, first_name, updated_at in score_db.execute("SELECT user_id, username, first_name, updated_at FROM profiles")
+    }
+
+profiles = load_profiles()                                 # user_id → (username, first_name, updated_at)
+
+# Запоминаем профиль; в базу пишем только изменения и устаревшие записи
+def remember_user(user):
+    if user is None:
+        return
+    user_id = str(user.id)
+    now = time.time()
+    with _score_lock:
+        cached = profiles.get(user_id)
+        if cached and cached[:2] == (user.username, user.first_name) and now - cached[2] < PROFILE_TTL:
+            return
+        profiles[user_id] = _profile_dirty[user_id] = (user.username, user.first_name, now)
+        # Сменилось имя игрока — его страницы в лидербордах нужно перерисовать
+        if cached and cached[:2] != (user.username, user.first_name):
+            for chat_id, table in scores.items():
+                if user_id in table:
+                    rank = bisect.bisect_left(leaderboards[chat_id], (-table[user_id], user_id))
+                    _invalidate_ranks(chat_id, rank, rank)
+
+def remember_update_user(update):
+    message = update.message or update.edited_message
+    if message:
+        remember_user(message.from_user)
+    if update.callback_query:
+        remember_user(update.callback_query.from_user)
+
+# Профиль из кэша; при промахе — один запрос к Telegram, дальше из кэша
+def get_profile(user_id, chat_id=None):
+    user_id = str(user_id)
+    cached = profiles.get(user_id)
+    if cached:
+        return cached[0], cached[1]
+    try:
+        user = bot.get_chat_member(chat_id or CHAT_ID, int(user_id)).user
+        remember_user(user)
+        return user.username, user.first_name
+    except Exception as e:
+        logging.warning(f"Не удалось получить профиль {user_id}: {e}")
+        return None, None
+
+# Имя для таблиц и сообщений
+def player_name(user_id, chat_id=None):
+    username, first_name = get_profile(user_id, chat_id)
+    return first_name or username or f"ID:{user_id}"
+
+# Фоновое обновление устаревших профилей игроков из лидербордов
+def refresh_stale_profiles():
+    now = time.time()
+    stale = {}                                             # user_id → чат, где он есть
+    with _score_lock:
+        for chat_id, table in scores.items():
+            for user_id in table:
+                if user_id not in stale and now - profiles.get(user_id, (None, None, 0))[2] >= PROFILE_TTL:
+                    stale[user_id] = chat_id
+    for user_id, chat_id in list(stale.items())[:PROFILE_REFRESH_BATCH]:
+        try:
+            remember_user(bot.get_chat_member(chat_id, int(user_id)).user)
+        except Exception as e:
+            # Игрок мог покинуть чат — не спрашиваем снова до следующего TTL
+            with _score_lock:
+                username, first_name, _ = profiles.get(user_id, (None, None, 0))
+                profiles[user_id] = _profile_dirty[user_id] = (username, first_name, now)
+            logging.debug(f"Профиль {user_id} не обновлён: {e}")
+
+schedule.every(10).minutes.do(leader_only(refresh_stale_profiles))
 
 def is_process_running(pid):
     return psutil.pid_exists(pid)
 
-if os.path.exists(LOCK_FILE):
-    with open(LOCK_FILE, "r") as f:
-        try:
-            pid = int(f.read())
-            if is_process_running(pid):
-                logging.error(f"❌ Бот уже запущен с PID {pid}. Выход.")
-                sys.exit(1)
-            else:
-                logging.warning("Найден старый lock-файл от неактивного процесса. Продолжаем.")
-        except ValueError:
-            logging.warning("Поврежденный lock-файл. Продолжаем.")
+# Проверяем, что бот не запущен второй раз, и пишем текущий PID в файл.
+# С общим хранилищем процессов может быть несколько — lock-файл не нужен
+def acquire_lock_file():
+    if state_backend.shared:
+        return
+    if os.path.exists(LOCK_FILE):
+        with open(LOCK_FILE, "r") as f:
+            try:
+                pid = int(f.read())
+                if is_process_running(pid):
+                    logging.error(f"❌ Бот уже запущен с PID {pid}. Выход.")
+                    sys.exit(1)
+                else:
+                    logging.warning("Найден старый lock-файл от неактивного процесса. Продолжаем.")
+            except ValueError:
+                logging.warning("Поврежденный lock-файл. Продолжаем.")
+    with open(LOCK_FILE, "w") as f:
+        f.write(str(os.getpid()))
 
 # ==== СПИСОК ВОПРОСВ TRIVIA ====
 TRIVIA_FILE = "trivia_questions.txt"
 
-# Пишем текущий PID в файл
-with open(LOCK_FILE, "w") as f:
-    f.write(str(os.getpid()))
-
-# Инициализируем клиента
-bot = telebot.TeleBot(TOKEN)
+# Инициализируем клиента (обработчики запускает наш диспетчер, а не пул потоков TeleBot)
+bot = telebot.TeleBot(TOKEN, threaded=False)
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip("/") + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL.rstrip("/") + "/file/bot{0}/{1}"
 
 # === ФУНКЦИЯ ДЛЯ ФИЛЬТРАЦИИ СТАРЫХ СООБЩЕНИЙ ===
 def is_recent(message):
@@ -120,142 +650,797 @@ def is_recent(message):
     return (now - msg_time).total_seconds() < 30           # Не обрабатывать сообщения старше 30 секунд
 
 # ==== ПОЛУЧЕНИЕ ЦЕНЫ ====
-def get_btc_price():
+PRICE_TTL = float(os.getenv("PRICE_TTL", "30"))              # Сколько секунд цена считается свежей
+PRICE_MAX_STALE = float(os.getenv("PRICE_MAX_STALE", "300"))  # Дольше этого устаревшую цену не отдаём
+
+http_session = requests.Session()                          # Общий пул соединений (keep-alive)
+
+_price_lock = threading.Lock()
+_price_value = 0.0
+_price_time = 0.0                                          # time.monotonic() последнего успешного ответа
+_price_timestamp = 0.0                                     # то же время в unix-секундах (для снимка)
+_price_refresh = None                                      # Event текущего запроса к API (single-flight)
+
+# ==== ПРОВАЙДЕРЫ ЦЕНЫ ====
+# имя → (url, разбор JSON-ответа); URL можно подменить локальной заглушкой через env
+PRICE_PROVIDERS = {
+    "coingecko": (
+        os.getenv("COINGECKO_URL", "https://api.coingecko.com/api/v3/simple/price?ids=bitcoin&vs_currencies=usd"),
+        lambda data: data["bitcoin"]["usd"]
+    ),
+    "binance": (
+        os.getenv("BINANCE_URL", "https://api.binance.com/api/v3/ticker/price?symbol=BTCUSDT"),
+        lambda data: data["price"]
+    ),
+    "kraken": (
+        os.getenv("KRAKEN_URL", "https://api.kraken.com/0/public/Ticker?pair=XBTUSD"),
+        lambda data: next(iter(data["result"].values()))["c"][0]
+    ),
+}
+PRICE_PROVIDER_ORDER = [name.strip() for name in os.getenv("PRICE_PROVIDERS", "coingecko,binance,kraken").split(",") if name.strip() in PRICE_PROVIDERS]
+PRICE_HEDGE_DELAY = float(os.getenv("PRICE_HEDGE_DELAY", "1.5"))   # Через сколько секунд дублируем запрос к следующему провайдеру
+PROVIDER_MAX_FAILS = 3                                     # После стольких ошибок подряд провайдер уходит в конец очереди
+
+_provider_lock = threading.Lock()
+provider_stats = {name: {"latency": None, "ok": 0, "errors": 0, "fail_streak": 0} for name in PRICE_PROVIDER_ORDER}
+price_executor = ThreadPoolExecutor(max_workers=max(2, len(PRICE_PROVIDER_ORDER)), thread_name_prefix="price")
+
+# Учёт задержки (скользящее среднее) и ошибок провайдера; latency=None — ошибка
+def record_provider_result(name, latency):
+    with _provider_lock:
+        stats = provider_stats[name]
+        if latency is None:
+            stats["errors"] += 1
+            stats["fail_streak"] += 1
+        else:
+            stats["ok"] += 1
+            stats["fail_streak"] = 0
+            stats["latency"] = latency if stats["latency"] is None else 0.8 * stats["latency"] + 0.2 * latency
+
+# Здоровые провайдеры — по возрастанию задержки, ошибавшиеся — ниже, упавшие — в конце
+def ranked_providers():
+    with _provider_lock:
+        def rank(item):
+            index, name = item
+            stats = provider_stats[name]
+            latency = stats["latency"] if stats["latency"] is not None else PRICE_HEDGE_DELAY
+            return (stats["fail_streak"] >= PROVIDER_MAX_FAILS, stats["fail_streak"], latency, index)
+        return [name for _, name in sorted(enumerate(PRICE_PROVIDER_ORDER), key=rank)]
+
+# Запрос к одному провайдеру
+def fetch_from_provider(name):
+    url, parse = PRICE_PROVIDERS[name]
+    started = time.perf_counter()
     try:
-        url = "https://api.coingecko.com/api/v3/simple/price?ids=bitcoin&vs_currencies=usd"
-        response = requests.get(url, timeout=10)
+        response = http_session.get(url, timeout=10)
         if response.status_code != 200:
-            logging.error(f"Ошибка ответа CoinGecko: {response.status_code}")
-            return 0.0
-        data = response.json()
-        return round(data["bitcoin"]["usd"], 2)
+            raise ValueError(f"HTTP {response.status_code}")
+        price = round(float(parse(response.json())), 2)
+        if price <= 0:
+            raise ValueError(f"некорректная цена {price}")
     except Exception as e:
-        logging.error(f"Ошибка при получении цены BTC: {e}")
-        return 0.0
+        record_provider_result(name, None)
+        logging.warning(f"[PRICE] Ошибка провайдера {name}: {e}")
+        raise
+    record_provider_result(name, time.perf_counter() - started)
+    return price
+
+# Хеджированный запрос: если провайдер молчит дольше PRICE_HEDGE_DELAY или ошибся — подключаем следующий
+def fetch_btc_price():
+    candidates = ranked_providers()
+    pending = set()
+    launched = 0
+
+    def launch_next():
+        nonlocal launched
+        pending.add(price_executor.submit(fetch_from_provider, candidates[launched]))
+        launched += 1
+
+    if candidates:
+        launch_next()
+    while pending:
+        timeout = PRICE_HEDGE_DELAY if launched < len(candidates) else None
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+        if launched < len(candidates):
+            launch_next()
+
+    logging.error("Ошибка при получении цены BTC: ни один провайдер не ответил")
+    return 0.0
+
+# Запись свежей цены в снимок (вызывать под _price_lock)
+def _store_price(price):
+    global _price_value, _price_time, _price_timestamp
+    _price_value = price
+    _price_time = time.monotonic()
+    _price_timestamp = time.time()
+
+def set_price_snapshot(price):
+    with _price_lock:
+        _store_price(price)
+
+# Последняя известная цена и её время (unix)
+def get_price_snapshot():
+    with _price_lock:
+        return _price_value, _price_timestamp
+
+# Обновление кэша цены; done будит всех, кто ждал этот же запрос
+def refresh_btc_price(done):
+    global _price_refresh
+    price = 0.0
+    try:
+        price = fetch_btc_price()
+    finally:
+        with _price_lock:
+            if price:
+                _store_price(price)
+            _price_refresh = None
+        done.set()
+
+# Цена из кэша: свежая — сразу, устаревшая — сразу + фоновое обновление, нет — ждём один общий запрос
+def get_btc_price():
+    global _price_refresh
+    with _price_lock:
+        age = time.monotonic() - _price_time
+        if _price_value and age < PRICE_TTL:
+            return _price_value
+
+        stale = _price_value if age < PRICE_MAX_STALE else 0.0
+        event = _price_refresh
+        leader = event is None
+        if leader:
+            event = _price_refresh = threading.Event()
+
+    if stale:
+        if leader:
+            threading.Thread(target=refresh_btc_price, args=(event,), daemon=True).start()
+        return stale
+
+    if leader:
+        refresh_btc_price(event)
+    else:
+        event.wait(timeout=15)
+
+    with _price_lock:
+        return _price_value if time.monotonic() - _price_time < PRICE_MAX_STALE else 0.0
+
+# ==== ФОНОВЫЙ ТИКЕР ЦЕНЫ ====
+# PRICE_TICKER=1 — держим снимок цены свежим в фоне, /price читает его из памяти.
+# PRICE_STREAM_URL — ws(s):// (нужен websocket-client) или http(s):// с потоком JSON-строк / SSE;
+# без него или при обрыве потока работает опрос раз в PRICE_POLL_INTERVAL секунд.
+PRICE_TICKER = os.getenv("PRICE_TICKER", "0") == "1"
+PRICE_STREAM_URL = os.getenv("PRICE_STREAM_URL", "")
+PRICE_POLL_INTERVAL = float(os.getenv("PRICE_POLL_INTERVAL", "15"))
+PRICE_STREAM_TIMEOUT = 60                                  # Переподключаемся, если поток молчит дольше
+
+# Цена из сообщения потока: {"price": ...}, {"p": ...} (trade) или {"c": ...} (miniTicker)
+def parse_stream_price(raw):
+    try:
+        data = json.loads(raw)
+        for key in ("price", "p", "c"):
+            if key in data:
+                price = round(float(data[key]), 2)
+                return price if price > 0 else 0.0
+    except (ValueError, TypeError, AttributeError):
+        logging.debug(f"[TICKER] Непонятное сообщение потока: {raw!r}")
+    return 0.0
+
+# Чтение потока до обрыва соединения
+def stream_prices(url):
+    if url.startswith(("ws://", "wss://")):
+        if websocket is None:
+            raise RuntimeError("для ws:// нужен пакет websocket-client")
+        ws = websocket.create_connection(url, timeout=PRICE_STREAM_TIMEOUT)
+        try:
+            while True:
+                price = parse_stream_price(ws.recv())
+                if price:
+                    set_price_snapshot(price)
+        finally:
+            ws.close()
+
+    with http_session.get(url, stream=True, timeout=(10, PRICE_STREAM_TIMEOUT)) as response:
+        if response.status_code != 200:
+            raise ValueError(f"HTTP {response.status_code}")
+        for raw in response.iter_lines(chunk_size=1):          # Без буферизации: каждая строка — сразу в снимок
+            line = raw.decode("utf-8", "replace")
+            if line.startswith("data:"):
+                line = line[5:]
+            price = parse_stream_price(line) if line else 0.0
+            if price:
+                set_price_snapshot(price)
+    raise ConnectionError("поток закрыт сервером")
+
+def run_price_ticker():
+    while True:
+        if PRICE_STREAM_URL:
+            try:
+                logging.info(f"[TICKER] Подключаемся к потоку цены {PRICE_STREAM_URL}")
+                stream_prices(PRICE_STREAM_URL)
+            except Exception as e:
+                logging.warning(f"[TICKER] Поток цены прерван: {e}. Опрашиваем API до переподключения.")
+
+        price = fetch_btc_price()
+        if price:
+            set_price_snapshot(price)
+        time.sleep(PRICE_POLL_INTERVAL)
+
+# ==== ДВИЖОК РЕНДЕРИНГА ====
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "32"))   # Сколько готовых картинок держим в памяти
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", "85"))
+JPEG_PROGRESSIVE = os.getenv("JPEG_PROGRESSIVE", "1") == "1"
+JPEG_OPTIMIZE = os.getenv("JPEG_OPTIMIZE", "1") == "1"
+LEADERBOARD_CARD_TOP = int(os.getenv("LEADERBOARD_CARD_TOP", "10"))             # Сколько игроков на карточке /top
+LEADERBOARD_RENDER_BUDGET_MS = float(os.getenv("LEADERBOARD_RENDER_BUDGET_MS", "250"))  # Предупреждение, если рендер дольше
+# Имена игроков рисуются не SpicyRice (в нём только латиница), а этими шрифтами по очереди:
+# каждый символ — первым шрифтом, где он есть (кириллица, эмодзи). Отсутствующие файлы пропускаются
+NAME_FONT_PATHS = os.getenv("NAME_FONT_PATHS", "NotoSans-Bold.ttf,NotoEmoji-Regular.ttf").split(",")
+
+MAIN_COLOR = (255, 0, 0)          # красный основной текст
+SHADOW_COLOR = (0, 0, 0)          # чёрная тень
+OUTLINE_COLOR = (255, 215, 0)     # золотой контур
+SHADOW_OFFSET = 4                 # смещение тени
+OUTLINE_WIDTH = 2                 # толщина контура
+
+CARD_WIDTH = 1058                 # ширина карточки лидерборда (как у background.jpg)
+CARD_HEADER = 130                 # высота заголовка
+CARD_ROW = 66                     # высота строки игрока
+CARD_MARGIN = 40                  # поля слева и справа
+CARD_SHADE = 110                  # затемнение фона под таблицей (0–255)
+MEDAL_COLORS = {1: (255, 215, 0), 2: (192, 192, 192), 3: (205, 127, 50)}
+PLACE_COLOR = (60, 60, 60)        # кружок места для остальных игроков
+NAME_COLOR = (255, 255, 255)
+
+_render_lock = threading.Lock()
+_background_cache = {}            # путь → декодированный фон
+_font_cache = {}                  # размер → шрифт
+_name_font_cache = {}             # размер → список шрифтов для имён
+_glyph_cache = {}                 # (файл шрифта, символ) → есть ли глиф
+_render_cache = OrderedDict()     # (шаблон, текст) → готовый JPEG (LRU)
+
+# Фон декодируется один раз и дальше только копируется
+def get_background(path):
+    with _render_lock:
+        img = _background_cache.get(path)
+        if img is None:
+            with Image.open(path) as src:
+                img = src.convert("RGB")
+            _background_cache[path] = img
+        return img
+
+# Шрифт загружается один раз на каждый размер
+def get_font(size):
+    with _render_lock:
+        font = _font_cache.get(size)
+        if font is None:
+            font = ImageFont.truetype(FONT_PATH, size)
+            _font_cache[size] = font
+        return font
+
+# Шрифты для имён игроков; если ни одного нет — SpicyRice, чтобы карточка всё равно рисовалась
+def get_name_fonts(size):
+    with _render_lock:
+        fonts = _name_font_cache.get(size)
+        if fonts is None:
+            fonts = [ImageFont.truetype(path, size) for path in NAME_FONT_PATHS if path and os.path.exists(path)]
+            if not fonts and not _name_font_cache:         # Предупреждаем один раз, а не на каждый размер
+                logging.warning(f"[RENDER] Не найден ни один шрифт из NAME_FONT_PATHS — имена рисуются {FONT_PATH}")
+            _name_font_cache[size] = fonts
+    return fonts or [get_font(size)]
+
+# Глиф есть, если символ рисуется не так, как заведомо отсутствующий (квадратик .notdef)
+def has_glyph(font, char):
+    key = (font.path, char)
+    found = _glyph_cache.get(key)
+    if found is None:
+        mask, missing = font.getmask(char), font.getmask("\U0010FFFF")
+        found = (mask.size, mask.histogram()) != (missing.size, missing.histogram())
+        _glyph_cache[key] = found
+    return found
+
+# Текст → [(кусок, шрифт)]: каждый символ первым шрифтом, где он есть; символы, которых нет
+# ни в одном шрифте, пропускаются вместо квадратиков. Модификаторы (вариации эмодзи,
+# соединители) идут вместе с предыдущим символом
+def font_runs(text, fonts):
+    runs = []
+    for char in text:
+        if not runs and (char.isspace() or unicodedata.category(char) in ("Mn", "Me", "Cf")):
+            continue                                       # Не начинаем с пробела от пропущенного эмодзи
+        if unicodedata.category(char) in ("Mn", "Me", "Cf"):
+            font = runs[-1][1]
+        else:
+            font = next((font for font in fonts if has_glyph(font, char)), None)
+            if font is None:
+                continue
+        if runs and runs[-1][1] is font:
+            runs[-1][0] += char
+        else:
+            runs.append([char, font])
+    return runs
+
+def runs_width(runs):
+    return sum(font.getlength(text) for text, font in runs)
+
+# Укорачиваем по ширине в пикселях, а не по числу символов
+def fit_runs(text, fonts, max_width):
+    runs = font_runs(text, fonts)
+    if runs_width(runs) <= max_width:
+        return runs
+    while text:
+        text = text[:-1].rstrip()
+        runs = font_runs(text + "…", fonts)
+        if runs_width(runs) <= max_width:
+            return runs
+    return font_runs("…", fonts)
+
+# Имя без единого рисуемого символа (например, кириллица без NotoSans-Bold.ttf) — @username или ID
+def fallback_name(user_id):
+    username = profiles.get(str(user_id), (None,))[0]
+    return f"@{username}" if username else f"ID:{user_id}"
+
+# Маска текста и расширенная (dilate) маска контура — вместо 17 проходов draw.text
+def render_text_masks(text, font):
+    pad = OUTLINE_WIDTH
+    probe = ImageDraw.Draw(Image.new("L", (1, 1)))
+    left, top, right, bottom = probe.textbbox((0, 0), text, font=font)
+
+    mask = Image.new("L", (right - left + 2 * pad, bottom - top + 2 * pad), 0)
+    ImageDraw.Draw(mask).text((pad - left, pad - top), text, font=font, fill=255)
+    outline = mask.filter(ImageFilter.MaxFilter(2 * pad + 1))
+    return mask, outline, (left - pad, top - pad)
+
+# Кодирование в JPEG прямо в память
+def encode_jpeg(img):
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=JPEG_QUALITY, progressive=JPEG_PROGRESSIVE, optimize=JPEG_OPTIMIZE)
+    return buffer.getvalue()
+
+# Рисуем текст с тенью и контуром на фоне, готовый JPEG кэшируется по (шаблон, текст)
+def render_text_image(background_file, text, font_size, position):
+    key = (background_file, font_size, position, text)
+    with _render_lock:
+        cached = _render_cache.get(key)
+        if cached is not None:
+            _render_cache.move_to_end(key)
+            return cached
+
+    started = time.perf_counter()
+    img = get_background(background_file).copy()
+    mask, outline, (dx, dy) = render_text_masks(text, get_font(font_size))
+    x, y = position[0] + dx, position[1] + dy
+
+    # Тень, контур и основной текст — по одному проходу на слой
+    img.paste(SHADOW_COLOR, (x + SHADOW_OFFSET, y + SHADOW_OFFSET), mask)
+    img.paste(OUTLINE_COLOR, (x, y), outline)
+    img.paste(MAIN_COLOR, (x, y), mask)
+    data = encode_jpeg(img)
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    logging.info(f"[RENDER] {background_file}: {len(data) // 1024} КБ за {elapsed_ms:.1f} мс (quality={JPEG_QUALITY})")
+
+    with _render_lock:
+        _render_cache[key] = data
+        _render_cache.move_to_end(key)
+        while len(_render_cache) > RENDER_CACHE_SIZE:
+            _render_cache.popitem(last=False)
+    return data
+
+# Цвет аватара-инициалов зависит только от user_id — у игрока он всегда один
+def avatar_color(user_id):
+    digest = hashlib.md5(str(user_id).encode()).digest()
+    return tuple(80 + b % 150 for b in digest[:3])
+
+# Текст с тенью (для строк карточки достаточно тени, контур — только у заголовка)
+def draw_shadowed_text(draw, position, text, font, fill, anchor="lm"):
+    x, y = position
+    draw.text((x + 2, y + 2), text, font=font, fill=SHADOW_COLOR, anchor=anchor)
+    draw.text((x, y), text, font=font, fill=fill, anchor=anchor)
+
+# Текст из кусков разными шрифтами, от левого края по средней линии
+def draw_shadowed_runs(draw, position, runs, fill):
+    x, y = position
+    for text, font in runs:
+        draw_shadowed_text(draw, (x, y), text, font, fill)
+        x += font.getlength(text)
+
+# Кружок с текстом по центру: медаль места или аватар с инициалами.
+# font может быть списком шрифтов — тогда текст рисуется с подбором шрифта по символам
+def draw_badge(draw, center, radius, color, text, font, text_color):
+    cx, cy = center
+    draw.ellipse((cx - radius, cy - radius, cx + radius, cy + radius), fill=color, outline=SHADOW_COLOR, width=2)
+    if isinstance(font, list):
+        runs = font_runs(text, font) or font_runs("?", font)
+        x = cx - runs_width(runs) / 2
+        for part, part_font in runs:
+            draw.text((x, cy), part, font=part_font, fill=text_color, anchor="lm")
+            x += part_font.getlength(part)
+    else:
+        draw.text((cx, cy), text, font=font, fill=text_color, anchor="mm")
+
+# Карточка топа: rows — список (место, user_id, имя, очки). Кэшируется по содержимому,
+# поэтому перерисовывается, только когда меняется сам топ
+def render_leaderboard_card(rows, background_file=BACKGROUND_PATH):
+    key = ("leaderboard", background_file, tuple(rows))
+    with _render_lock:
+        cached = _render_cache.get(key)
+        if cached is not None:
+            _render_cache.move_to_end(key)
+            return cached
+
+    started = time.perf_counter()
+    size = (CARD_WIDTH, CARD_HEADER + CARD_ROW * len(rows) + CARD_MARGIN // 2)
+    img = ImageOps.fit(get_background(background_file), size)
+    img.paste(SHADOW_COLOR, (0, CARD_HEADER - 10, size[0], size[1]), Image.new("L", (size[0], size[1] - CARD_HEADER + 10), CARD_SHADE))
+
+    # Заголовок — тем же способом, что цена на картинке /price
+    mask, outline, (dx, dy) = render_text_masks("TOP PLAYERS", get_font(72))
+    x, y = (size[0] - mask.width) // 2 + dx, 25 + dy
+    img.paste(SHADOW_COLOR, (x + SHADOW_OFFSET, y + SHADOW_OFFSET), mask)
+    img.paste(OUTLINE_COLOR, (x, y), outline)
+    img.paste(MAIN_COLOR, (x, y), mask)
+
+    draw = ImageDraw.Draw(img)
+    row_font = get_font(38)
+    badge_font = get_font(26)
+    name_fonts = get_name_fonts(34)
+    initials_fonts = get_name_fonts(24)
+    radius = CARD_ROW // 2 - 6
+    name_x = CARD_MARGIN + 4 * radius + 36
+    for index, (place, user_id, name, points) in enumerate(rows):
+        cy = CARD_HEADER + CARD_ROW * index + CARD_ROW // 2
+        medal = MEDAL_COLORS.get(place)
+        draw_badge(draw, (CARD_MARGIN + radius, cy), radius, medal or PLACE_COLOR, str(place), badge_font, SHADOW_COLOR if medal else NAME_COLOR)
+        initials = "".join(part[0] for part in name.split()[:2]).upper() or "?"
+        draw_badge(draw, (CARD_MARGIN + 3 * radius + 16, cy), radius, avatar_color(user_id), initials, initials_fonts, NAME_COLOR)
+        points_text = f"{points} $LEG"
+        points_x = size[0] - CARD_MARGIN - draw.textlength(points_text, font=row_font)
+        name_width = points_x - 24 - name_x
+        runs = fit_runs(name, name_fonts, name_width)
+        if not "".join(text for text, _ in runs).strip("… "):
+            runs = fit_runs(fallback_name(user_id), name_fonts, name_width)
+        draw_shadowed_runs(draw, (name_x, cy), runs, NAME_COLOR)
+        draw_shadowed_text(draw, (size[0] - CARD_MARGIN, cy), points_text, row_font, OUTLINE_COLOR, anchor="rm")
+    data = encode_jpeg(img)
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if elapsed_ms > LEADERBOARD_RENDER_BUDGET_MS:
+        logging.warning(f"[RENDER] Карточка лидерборда рендерилась {elapsed_ms:.1f} мс (бюджет {LEADERBOARD_RENDER_BUDGET_MS:.0f} мс)")
+    else:
+        logging.info(f"[RENDER] Карточка лидерборда: {len(data) // 1024} КБ за {elapsed_ms:.1f} мс")
+
+    with _render_lock:
+        _render_cache[key] = data
+        _render_cache.move_to_end(key)
+        while len(_render_cache) > RENDER_CACHE_SIZE:
+            _render_cache.popitem(last=False)
+    return data
 
 # ==== СОЗДАНИЕ ИЗОБРАЖЕНИЯ ====
-def create_price_image(price):
+# Возвращает BytesIO с готовым JPEG или None при ошибке
+def create_price_image(price, background_file=BACKGROUND_PATH):
     # Проверка наличия фонового изображения и шрифта
-    if not os.path.exists(BACKGROUND_PATH):
-        logging.error(f"❌ Фоновое изображение {BACKGROUND_PATH} не найдено.")
-        return False
+    if not os.path.exists(background_file):
+        logging.error(f"❌ Фоновое изображение {background_file} не найдено.")
+        return None
 
     if not os.path.exists(FONT_PATH):
         logging.error("❌ Шрифт SpicyRice-Regular.ttf не найден.")
-        return False
+        return None
 
     try:
-        # Загрузка фонового изображения
-        img = Image.open(BACKGROUND_PATH)
-        draw = ImageDraw.Draw(img)
-
-        now = datetime.datetime.now().strftime("%d.%m.%Y %H:%M")
         text = f"BTC\n${price}"
-        
-        # Настройка шрифта
-        font = ImageFont.truetype(FONT_PATH, 140)
-        
-        x, y = 35, 20  # Позиция текста
-
-        # Цвета
-        main_color = (255, 0, 0)          # красный основной текст
-        shadow_color = (0, 0, 0)          # чёрная тень
-        outline_color = (255, 215, 0)     # золотой контур
-
-        # Рисуем ТЕНЬ (смещённый текст)
-        draw.text((x+4, y+4), text, font=font, fill=shadow_color)
-        
-        # Рисуем КОНТУР (обводку) — вокруг текста
-        for dx in [-2, -1, 1, 2]:
-            for dy in [-2, -1, 1, 2]:
-                if dx != 0 or dy != 0:
-                    draw.text((x+dx, y+dy), text, font=font, fill=outline_color)
-        
-        # Рисуем САМ ТЕКСТ
-        draw.text((x, y), text, font=font, fill=main_color)
-
-        # Сохраняем результат
-        img.save("btc_price_output.jpg")
-        return True
+        return io.BytesIO(render_text_image(background_file, text, 140, (35, 20)))
     except Exception as e:
         logging.error(f"Ошибка при создании изображения: {e}")
-        return False
+        return None
 
-def create_greeting_image(text, background_file, output_file):
+def create_greeting_image(text, background_file):
     if not os.path.exists(background_file):
         logging.error(f"Файл фона {background_file} не найден.")
-        return False
+        return None
 
     if not os.path.exists(FONT_PATH):
         logging.error("❌ Шрифт SpicyRice-Regular.ttf не найден.")
-        return False
+        return None
 
     try:
-        img = Image.open(background_file)
-        draw = ImageDraw.Draw(img)
-        font = ImageFont.truetype(FONT_PATH, 90)
-
-        x, y = 40, 570
-        main_color = (255, 0, 0)          # красный основной текст
-        shadow_color = (0, 0, 0)          # чёрная тень
-        outline_color = (255, 215, 0)     # золотой контур
-
-        # Тень
-        draw.text((x+4, y+4), text, font=font, fill=shadow_color)
+        return io.BytesIO(render_text_image(background_file, text, 90, (40, 570)))
+    except Exception as e:
+        logging.error(f"Ошибка при создании поздравительной картинки: {e}")
+        return None
 
-        # Контур
-        for dx in [-2, -1, 1, 2]:
-            for dy in [-2, -1, 1, 2]:
-                if dx != 0 or dy != 0:
-                    draw.text((x+dx, y+dy), text, font=font, fill=outline_color)
+def create_leaderboard_image(rows, background_file=BACKGROUND_PATH):
+    if not os.path.exists(background_file):
+        logging.error(f"❌ Фоновое изображение {background_file} не найдено.")
+        return None
 
-        # Основной текст
-        draw.text((x, y), text, font=font, fill=main_color)
+    if not os.path.exists(FONT_PATH):
+        logging.error("❌ Шрифт SpicyRice-Regular.ttf не найден.")
+        return None
 
-        img.save(output_file)
-        return True
+    try:
+        return io.BytesIO(render_leaderboard_card(rows, background_file))
     except Exception as e:
-        logging.error(f"Ошибка при создании поздравительной картинки: {e}")
-        return False
+        logging.error(f"Ошибка при создании карточки лидерборда: {e}")
+        return None
 
 # ==== ПЕРЕСЫЛКА В DISCORD ====
-# Пересылка текстового сообщения
-def send_to_discord(text, username="RPDAO Telegram", avatar_url=None):
-    if not DISCORD_WEBHOOK_URL:
+# Сообщения записываются в постоянный outbox (SQLite) и отправляются фоновыми потоками:
+# polling не ждёт Discord, а неотправленное переживает падение Discord и перезапуск бота
+DISCORD_OUTBOX_FILE = "discord_outbox.db"
+DISCORD_QUEUE_SIZE = int(os.getenv("DISCORD_QUEUE_SIZE", "10000"))   # Сколько неотправленных сообщений храним максимум
+DISCORD_WORKERS = int(os.getenv("DISCORD_WORKERS", "1"))  # Больше одного потока — порядок сообщений не гарантирован
+DISCORD_MAX_LENGTH = 2000                                  # Лимит длины сообщения Discord
+DISCORD_MAX_RETRIES = 5                                    # Повторы на 429 внутри одной попытки
+DISCORD_MAX_BACKOFF = 300                                  # Максимальная пауза между попытками (сек)
+DISCORD_MAX_ATTEMPTS = int(os.getenv("DISCORD_MAX_ATTEMPTS", "20"))  # После стольких неудачных попыток (≈ час) сообщение отбрасывается
+DISCORD_CLAIM_TIMEOUT = 120                                # Через сколько секунд взятая, но не завершённая задача снова доступна
+DISCORD_KEEP_DELIVERED = 24 * 3600                         # Сколько хранить отправленные (для защиты от дублей)
+PHOTO_MAX_BYTES = int(os.getenv("PHOTO_MAX_BYTES", "0"))   # Фото больше этого размера пережимаются перед отправкой (0 — никогда)
+PHOTO_MAX_SIDE = int(os.getenv("PHOTO_MAX_SIDE", "1600"))  # Максимальная сторона пережатого фото
+PHOTO_CHUNK_SIZE = 64 * 1024                               # Размер куска при потоковой пересылке
+
+discord_session = requests.Session()
+_outbox_lock = threading.Lock()
+_outbox_ready = threading.Condition(_outbox_lock)
+_discord_stats_lock = threading.Lock()
+discord_stats = {"sent": 0, "failed": 0, "dropped": 0, "rejected": 0, "duplicates": 0, "coalesced": 0, "last_lag": 0.0, "max_lag": 0.0}
+
+outbox_db = sqlite3.connect(DISCORD_OUTBOX_FILE, check_same_thread=False)
+outbox_db.execute("PRAGMA journal_mode=WAL")
+outbox_db.execute("PRAGMA synchronous=NORMAL")
+outbox_db.execute("""
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source_id TEXT UNIQUE,                             -- chat_id:message_id из Telegram (дедупликация)
+        kind TEXT NOT NULL,
+        content TEXT,
+        username TEXT,
+        avatar_url TEXT,
+        file_id TEXT,                                      -- фото из Telegram: скачивается в момент отправки
+        webhook_url TEXT,                                  -- вебхук чата (NULL — DISCORD_WEBHOOK_URL)
+        queued_at REAL NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt REAL NOT NULL DEFAULT 0,
+        delivered_at REAL                                  -- задача закрыта: доставлена или отброшена после ошибок
+    )
+""")
+_outbox_columns = [column[1] for column in outbox_db.execute("PRAGMA table_info(outbox)")]
+for _column in ("file_id", "webhook_url"):
+    if _column not in _outbox_columns:
+        outbox_db.execute(f"ALTER TABLE outbox ADD COLUMN {_column} TEXT")
+outbox_db.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (delivered_at, next_attempt, id)")
+
+# Повтор после перезапуска: все недоставленные задачи снова доступны сразу
+outbox_db.execute("UPDATE outbox SET next_attempt = 0 WHERE delivered_at IS NULL")
+outbox_db.commit()
+_outbox_pending = outbox_db.execute("SELECT COUNT(*) FROM outbox WHERE delivered_at IS NULL").fetchone()[0]
+if _outbox_pending:
+    logging.info(f"[DC] В outbox {_outbox_pending} неотправленных сообщений — отправим повторно")
+
+# Запись задачи в outbox без ожидания Discord
+def enqueue_discord_job(kind, content, username, avatar_url, file_id=None, source_id=None, webhook_url=None):
+    global _outbox_pending
+    if not (webhook_url or DISCORD_WEBHOOK_URL):
         logging.warning("DISCORD_WEBHOOK_URL не задан")
         return
-    try:
-        payload = {
-            "content": text,
-            "username": username,
-            "avatar_url": avatar_url or DISCORD_AVATAR_URL         # путь к кастомной аватарке
-        }
-        response = requests.post(DISCORD_WEBHOOK_URL, json=payload)
-        if response.status_code != 204:
-            logging.warning(f"Ошибка отправки текста в Discord: {response.status_code} - {response.text}")
-    except Exception as e:
-        logging.error(f"Ошибка при отправке текста в Discord: {e}")
-
-# Пересылка фото с подписью
-def send_photo_to_discord(caption, photo_path, username=None, avatar_url=None):
-    try:
-        webhook = DiscordWebhook(
-            url=DISCORD_WEBHOOK_URL,
-            content=caption,
-            username=username or "Telegram",
-            avatar_url=avatar_url or DISCORD_AVATAR_URL
+    with _outbox_lock:
+        if _outbox_pending >= DISCORD_QUEUE_SIZE:
+            with _discord_stats_lock:
+                discord_stats["dropped"] += 1
+            logging.warning(f"[DC] Outbox переполнен ({DISCORD_QUEUE_SIZE}), сообщение отброшено")
+            return
+        cursor = outbox_db.execute(
+            "INSERT OR IGNORE INTO outbox (source_id, kind, content, username, avatar_url, file_id, webhook_url, queued_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (source_id, kind, content, username, avatar_url, file_id, webhook_url, time.time())
         )
-        with open(photo_path, 'rb') as f:
-            webhook.add_file(file=f.read(), filename="photo.jpg")
-
-        response = webhook.execute()
-        logging.info(f"[DC] Фото отправлено. Статус: {response.status_code}")
+        outbox_db.commit()
+        if cursor.rowcount == 0:
+            with _discord_stats_lock:
+                discord_stats["duplicates"] += 1
+            logging.info(f"[DC] Сообщение {source_id} уже в outbox, дубль пропущен")
+            return
+        _outbox_pending += 1
+        _outbox_ready.notify()
 
-        if response.status_code not in [200, 204]:
-            logging.warning(f"Ошибка отправки фото в Discord: {response.status_code} - {response.text}")
+# Пересылка текстового сообщения
+def send_to_discord(text, username="RPDAO Telegram", avatar_url=None, source_id=None, webhook_url=None):
+    enqueue_discord_job("text", text, username, avatar_url or DISCORD_AVATAR_URL, source_id=source_id, webhook_url=webhook_url)   # путь к кастомной аватарке
+
+# Пересылка фото из Telegram: в outbox только file_id, байты идут потоком при отправке
+def relay_telegram_photo(caption, file_id, username=None, avatar_url=None, source_id=None, webhook_url=None):
+    enqueue_discord_job("tg_photo", caption, username or "Telegram", avatar_url or DISCORD_AVATAR_URL, file_id=file_id, source_id=source_id, webhook_url=webhook_url)
+
+# Поток multipart/form-data: payload_json, затем файл кусками — без сборки тела в памяти
+def multipart_stream(payload, chunks, boundary):
+    yield (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="payload_json"\r\n'
+        f"Content-Type: application/json\r\n\r\n"
+        f"{json.dumps(payload)}\r\n"
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="files[0]"; filename="photo.jpg"\r\n'
+        f"Content-Type: image/jpeg\r\n\r\n"
+    ).encode("utf-8")
+    yield from chunks
+    yield f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+# Уменьшение большого фото перед отправкой
+def downscale_photo(data):
+    with Image.open(io.BytesIO(data)) as img:
+        img = img.convert("RGB")
+        img.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+        return encode_jpeg(img)
+
+# Источник фото для отправки: bytes или функция, открывающая поток кусков (вызывается на каждую попытку)
+def telegram_photo_source(file_id):
+    file_info = bot.get_file(file_id)
+    url = (telebot.apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(TOKEN, file_info.file_path)
+
+    if PHOTO_MAX_BYTES and (file_info.file_size or 0) > PHOTO_MAX_BYTES:
+        response = http_session.get(url, timeout=30)
+        response.raise_for_status()
+        data = downscale_photo(response.content)
+        logging.info(f"[DC] Фото пережато: {file_info.file_size // 1024} КБ → {len(data) // 1024} КБ")
+        return data
+
+    def open_chunks():
+        with http_session.get(url, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            yield from response.iter_content(PHOTO_CHUNK_SIZE)
+    return open_chunks
+
+# Discord отклонил сообщение (4xx кроме 429) — повтор ничего не изменит
+class DiscordRejected(Exception):
+    pass
+
+# POST в вебхук с учётом 429 (retry_after); True — доставлено, False — повторить позже, DiscordRejected — не повторять.
+# photo — bytes или функция, возвращающая итератор кусков файла (потоковая отправка)
+def post_to_discord(payload, photo=None, webhook_url=None):
+    webhook_url = webhook_url or DISCORD_WEBHOOK_URL
+    for attempt in range(DISCORD_MAX_RETRIES):
+        if photo is None:
+            response = discord_session.post(webhook_url, json=payload, timeout=15)
+        elif callable(photo):
+            boundary = uuid.uuid4().hex
+            response = discord_session.post(
+                webhook_url,
+                data=multipart_stream(payload, photo(), boundary),
+                headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+                timeout=30
+            )
+        else:
+            response = discord_session.post(
+                webhook_url,
+                data={"payload_json": json.dumps(payload)},
+                files={"files[0]": ("photo.jpg", photo, "image/jpeg")},
+                timeout=30
+            )
+
+        if response.status_code == 429:
+            try:
+                retry_after = float(response.json().get("retry_after", 1))
+            except ValueError:
+                retry_after = float(response.headers.get("Retry-After", 1))
+            logging.warning(f"[DC] Лимит Discord (429), ждём {retry_after:.2f} с (попытка {attempt + 1})")
+            time.sleep(retry_after)
+            continue
+
+        # Корзина лимита исчерпана — выдерживаем паузу до её сброса
+        if response.headers.get("X-RateLimit-Remaining") == "0":
+            time.sleep(float(response.headers.get("X-RateLimit-Reset-After", 0)))
+
+        if response.status_code in [200, 204]:
+            return True
+        if 400 <= response.status_code < 500:
+            raise DiscordRejected(f"{response.status_code} - {response.text[:200]}")
+        logging.warning(f"Ошибка отправки в Discord: {response.status_code} - {response.text}")
+        return False
+    return False
+
+# Берём ближайшие задачи: текст склеивается с идущими следом текстами того же автора в тот же вебхук (до 2000 символов).
+# Возвращает (задачи, секунды до следующей задачи); вызывать под _outbox_lock
+def claim_outbox_jobs():
+    now = time.time()
+    rows = outbox_db.execute(
+        "SELECT id, kind, content, username, avatar_url, queued_at, attempts, file_id, webhook_url FROM outbox "
+        "WHERE delivered_at IS NULL AND next_attempt <= ? ORDER BY id LIMIT 50",
+        (now,)
+    ).fetchall()
+    if not rows:
+        nxt = outbox_db.execute("SELECT MIN(next_attempt) FROM outbox WHERE delivered_at IS NULL").fetchone()[0]
+        return [], (max(0.0, nxt - now) if nxt is not None else None)
+
+    jobs = [rows[0]]
+    if rows[0][1] == "text":
+        length = len(rows[0][2] or "")
+        for row in rows[1:]:
+            if row[1] != "text" or row[3:5] != rows[0][3:5] or row[8] != rows[0][8] or length + 1 + len(row[2] or "") > DISCORD_MAX_LENGTH:
+                break
+            jobs.append(row)
+            length += 1 + len(row[2] or "")
+
+    outbox_db.executemany("UPDATE outbox SET next_attempt = ? WHERE id = ?", [(now + DISCORD_CLAIM_TIMEOUT, job[0]) for job in jobs])
+    outbox_db.commit()
+    return jobs, 0.0
+
+# Итог попытки: доставленные помечаем, недоставленные откладываем с экспоненциальной паузой.
+# Отклонённые Discord и исчерпавшие DISCORD_MAX_ATTEMPTS закрываются без доставки; возвращает их число
+def finish_outbox_jobs(jobs, delivered, rejected=False):
+    global _outbox_pending
+    now = time.time()
+    with _outbox_lock:
+        closed = jobs if delivered or rejected else [job for job in jobs if job[6] + 1 >= DISCORD_MAX_ATTEMPTS]
+        retry = [job for job in jobs if job not in closed]
+        outbox_db.executemany(
+            "UPDATE outbox SET attempts = attempts + ?, delivered_at = ? WHERE id = ?",
+            [(0 if delivered else 1, now, job[0]) for job in closed]
+        )
+        outbox_db.executemany(
+            "UPDATE outbox SET attempts = attempts + 1, next_attempt = ? WHERE id = ?",
+            [(now + min(DISCORD_MAX_BACKOFF, 2 ** job[6]), job[0]) for job in retry]
+        )
+        outbox_db.commit()
+        _outbox_pending -= len(closed)
+    if closed and not delivered and not rejected:
+        logging.error(f"[DC] {len(closed)} сообщ. не доставлены за {DISCORD_MAX_ATTEMPTS} попыток и отброшены (id {closed[0][0]}…)")
+    return 0 if delivered else len(closed)
 
-    except Exception as e:
-        logging.error(f"Ошибка при отправке фото в Discord: {e}")
+def discord_worker():
+    while True:
+        with _outbox_lock:
+            jobs, wait_for = claim_outbox_jobs()
+            if not jobs:
+                _outbox_ready.wait(timeout=min(wait_for, 60) if wait_for is not None else 60)
+                continue
+
+        first = jobs[0]
+        payload = {"content": first[2], "username": first[3], "avatar_url": first[4]}
+        rejected = False
+        try:
+            if first[1] == "text":
+                payload["content"] = "\n".join(job[2] or "" for job in jobs)[:DISCORD_MAX_LENGTH]
+                delivered = post_to_discord(payload, webhook_url=first[8])
+            else:
+                delivered = post_to_discord(payload, photo=telegram_photo_source(first[7]), webhook_url=first[8])
+                logging.info(f"[DC] Фото из Telegram отправлено: {delivered}")
+        except DiscordRejected as e:
+            logging.error(f"[DC] Discord отклонил сообщение {first[0]}, повторять не будем: {e}")
+            delivered, rejected = False, True
+        except Exception as e:
+            logging.error(f"Ошибка при отправке в Discord: {e}")
+            delivered = False
+        given_up = finish_outbox_jobs(jobs, delivered, rejected)
+
+        lag = time.time() - first[5]
+        with _discord_stats_lock:
+            discord_stats["sent" if delivered else "failed"] += len(jobs)
+            discord_stats["rejected"] += given_up
+            if delivered:
+                discord_stats["coalesced"] += len(jobs) - 1
+                discord_stats["last_lag"] = lag
+                discord_stats["max_lag"] = max(discord_stats["max_lag"], lag)
+
+# Чистим старые отправленные записи (нужны только для дедупликации)
+def purge_discord_outbox():
+    with _outbox_lock:
+        outbox_db.execute("DELETE FROM outbox WHERE delivered_at IS NOT NULL AND delivered_at < ?", (time.time() - DISCORD_KEEP_DELIVERED,))
+        outbox_db.commit()
+
+# Метрики outbox: глубина и задержка доставки
+def log_discord_metrics():
+    with _discord_stats_lock:
+        stats = dict(discord_stats)
+        discord_stats["max_lag"] = 0.0
+    logging.info(
+        f"[DC] Outbox: {_outbox_pending} | отправлено {stats['sent']}, склеено {stats['coalesced']}, ошибок {stats['failed']}, "
+        f"не доставлено {stats['rejected']}, дублей {stats['duplicates']}, отброшено {stats['dropped']} | задержка {stats['last_lag']:.2f} с (макс. {stats['max_lag']:.2f} с)"
+    )
+
+schedule.every(1).hours.do(purge_discord_outbox)
+schedule.every(10).minutes.do(log_discord_metrics)
 
 # === БЕЗОПАСНОЕ УДАЛЕНИЕ СООБЩЕНИЙ ===
 def safe_delete_message(chat_id, message_id):
@@ -269,28 +1454,200 @@ def safe_delete_message(chat_id, message_id):
     except Exception as e:
         logging.warning(f"Ошибка при удалении сообщения {message_id} из чата {chat_id}: {e}")
 
+# ==== ПЛАНИРОВЩИК УДАЛЕНИЯ СООБЩЕНИЙ ====
+# Один поток и куча (heap) вместо threading.Timer на каждое сообщение.
+# Созревшие удаления группируются по чату и удаляются пачкой через deleteMessages.
+PENDING_DELETIONS_FILE = "pending_deletions.json"
+DELETION_BATCH_SIZE = 100                                  # Лимит deleteMessages за один запрос
+DELETION_SAVE_INTERVAL = 5                                 # Не чаще чем раз в столько секунд сохраняем очередь на диск
+
+_deletion_ready = threading.Condition()
+_deletion_heap = []                                        # (время удаления, chat_id, message_id)
+_deletions_dirty = False
+
+def schedule_delete(chat_id, message_id, delay):
+    global _deletions_dirty
+    with _deletion_ready:
+        heapq.heappush(_deletion_heap, (time.time() + delay, str(chat_id), message_id))
+        _deletions_dirty = True
+        _deletion_ready.notify()
+
+def pending_deletions_count():
+    with _deletion_ready:
+        return len(_deletion_heap)
+
+# Сохраняем очередь атомарно (вызывать под _deletion_ready)
+def save_pending_deletions():
+    global _deletions_dirty
+    try:
+        tmp_path = PENDING_DELETIONS_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(_deletion_heap, f)
+        os.replace(tmp_path, PENDING_DELETIONS_FILE)
+        _deletions_dirty = False
+    except OSError as e:
+        logging.warning(f"Не удалось сохранить {PENDING_DELETIONS_FILE}: {e}")
+
+# Восстанавливаем удаления, запланированные до перезапуска
+def load_pending_deletions():
+    if not os.path.exists(PENDING_DELETIONS_FILE):
+        return
+    try:
+        with open(PENDING_DELETIONS_FILE, "r", encoding="utf-8") as f:
+            entries = [tuple(entry) for entry in json.load(f)]
+    except (OSError, ValueError) as e:
+        logging.warning(f"Не удалось прочитать {PENDING_DELETIONS_FILE}: {e}")
+        return
+    with _deletion_ready:
+        _deletion_heap.extend(entries)
+        heapq.heapify(_deletion_heap)
+    if entries:
+        logging.info(f"Восстановлено {len(entries)} запланированных удалений сообщений.")
+
+# Пачка удалений в одном чате; если массовое удаление недоступно — по одному
+def delete_messages_batch(chat_id, message_ids):
+    for start in range(0, len(message_ids), DELETION_BATCH_SIZE):
+        chunk = message_ids[start:start + DELETION_BATCH_SIZE]
+        if len(chunk) > 1:
+            try:
+                bot.delete_messages(chat_id, chunk)
+                continue
+            except Exception as e:
+                logging.debug(f"deleteMessages не сработал в чате {chat_id}, удаляем по одному: {e}")
+        for message_id in chunk:
+            safe_delete_message(chat_id, message_id)
+
+def run_deletion_scheduler():
+    global _deletions_dirty
+    last_save = 0.0
+    while True:
+        with _deletion_ready:
+            now = time.time()
+            due = []
+            while _deletion_heap and _deletion_heap[0][0] <= now:
+                due.append(heapq.heappop(_deletion_heap))
+            if due:
+                _deletions_dirty = True
+
+            if _deletions_dirty and now - last_save >= DELETION_SAVE_INTERVAL:
+                save_pending_deletions()
+                last_save = now
+
+            if not due:
+                timeout = _deletion_heap[0][0] - now if _deletion_heap else 60
+                if _deletions_dirty:
+                    timeout = min(timeout, last_save + DELETION_SAVE_INTERVAL - now)
+                _deletion_ready.wait(timeout=max(0.0, min(timeout, 60)))
+                continue
+
+        by_chat = defaultdict(list)
+        for _, chat_id, message_id in due:
+            by_chat[chat_id].append(message_id)
+        for chat_id, message_ids in by_chat.items():
+            delete_messages_batch(chat_id, message_ids)
+
+load_pending_deletions()
+
+# ==== КЭШ FILE_ID ДЛЯ ПОВТОРНОЙ ОТПРАВКИ ФОТО ====
+FILE_ID_CACHE_FILE = "file_id_cache.json"
+FILE_ID_TTL = int(os.getenv("FILE_ID_TTL", str(7 * 24 * 3600)))   # Сколько секунд живёт запись (по умолчанию неделя)
+
+_file_id_lock = threading.Lock()
+
+# Загружаем кэш, сразу отбрасывая устаревшие записи
+def load_file_id_cache():
+    if not os.path.exists(FILE_ID_CACHE_FILE):
+        return {}
+    try:
+        with open(FILE_ID_CACHE_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Не удалось прочитать {FILE_ID_CACHE_FILE}: {e}")
+        return {}
+    now = time.time()
+    return {digest: entry for digest, entry in data.items() if now - entry["ts"] < FILE_ID_TTL}
+
+# Сохраняем атомарно (вызывать под _file_id_lock)
+def save_file_id_cache():
+    try:
+        tmp_path = FILE_ID_CACHE_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(file_id_cache, f)
+        os.replace(tmp_path, FILE_ID_CACHE_FILE)
+    except OSError as e:
+        logging.warning(f"Не удалось сохранить {FILE_ID_CACHE_FILE}: {e}")
+
+file_id_cache = load_file_id_cache()                       # sha256 содержимого → {"file_id", "ts"}
+
+# Запись кэша для картинки или None, если её ещё не отправляли (или запись устарела)
+def cached_file_id(digest, now):
+    with _file_id_lock:
+        entry = file_id_cache.get(digest)
+        if entry and now - entry["ts"] >= FILE_ID_TTL:
+            del file_id_cache[digest]
+            entry = None
+        return entry
+
+def remember_file_id(digest, file_id, now):
+    with _file_id_lock:
+        file_id_cache[digest] = {"file_id": file_id, "ts": now}
+        for old in [d for d, e in file_id_cache.items() if now - e["ts"] >= FILE_ID_TTL]:
+            del file_id_cache[old]
+        save_file_id_cache()
+
+# Отправка фото: одинаковая картинка повторно уходит по file_id без загрузки
+def send_cached_photo(chat_id, photo, caption=None):
+    data = photo.getvalue()
+    digest = hashlib.sha256(data).hexdigest()
+    now = time.time()
+
+    entry = cached_file_id(digest, now)
+    if entry:
+        try:
+            msg = bot.send_photo(chat_id, entry["file_id"], caption=caption)
+            logging.info(f"[FILE_ID] Фото отправлено из кэша ({len(data) // 1024} КБ не загружено)")
+            return msg
+        except ApiTelegramException as e:
+            logging.warning(f"[FILE_ID] file_id больше не принимается, загружаем заново: {e}")
+            with _file_id_lock:
+                file_id_cache.pop(digest, None)
+
+    msg = bot.send_photo(chat_id, io.BytesIO(data), caption=caption)
+    if msg.photo:
+        remember_file_id(digest, msg.photo[-1].file_id, now)
+    return msg
+
 # ==== ОТПРАВКА ИЗОБРАЖЕНИЯ ====
+# Рассылка во все чаты с price_updates; картинка рендерится один раз на фон
 def send_price_image():
     try:
         price = get_btc_price()
         if price == 0.0:
             logging.warning("Цена BTC не получена. Пропуск отправки.")
             return
-
-        if create_price_image(price):
-            with open("btc_price_output.jpg", "rb") as photo:
-                bot.send_photo(CHAT_ID, photo, caption=f"Greetings Adventurers! Current #price $BTC: ${price}")
-            logging.info("Сообщение отправлено.")
     except Exception as e:
         logging.error(f"Ошибка при отправке: {e}")
+        return
+
+    for chat_id, config in list(chat_configs.items()):
+        if not config["price_updates"]:
+            continue
+        try:
+            photo = create_price_image(price, config["background"])
+            if photo:
+                send_cached_photo(chat_id, photo, caption=f"Greetings Adventurers! Current #price $BTC: ${price}")
+                logging.info(f"Сообщение отправлено в чат {chat_id}.")
+        except Exception as e:
+            logging.error(f"Ошибка при отправке в чат {chat_id}: {e}")
 
 # === УДАЛЕНИЕ СЛЭШ-КОМАНД ===
 def delete_command_after(func):
+    @functools.wraps(func)
     def wrapper(message):
         try:
             func(message)
         finally:
-            threading.Timer(5, lambda: safe_delete_message(message.chat.id, message.message_id)).start()
+            schedule_delete(message.chat.id, message.message_id, 5)
     return wrapper
 
 # ==== ОБРАБОТЧИК КОМАНДЫ /price ====
@@ -298,71 +1655,619 @@ def delete_command_after(func):
 @delete_command_after
 def handle_price_command(message):    
     try:
-        if str(message.chat.id) == CHAT_ID:
+        config = chat_config(message.chat.id)
+        if config:
             price = get_btc_price()
             if price == 0.0:
                 bot.reply_to(message, "Не удалось получить цену BTC.")
                 return
-            if create_price_image(price):
-                with open("btc_price_output.jpg", "rb") as photo:
-                    bot.send_photo(CHAT_ID, photo, caption=f"Greetings Adventurers! Current #price $BTC: ${price}")
+            photo = create_price_image(price, config["background"])
+            if photo:
+                send_cached_photo(message.chat.id, photo, caption=f"Greetings Adventurers! Current #price $BTC: ${price}")
                 logging.info(f"{message.from_user.username or message.from_user.id} использовал команду /price. Цена BTC: ${price}")
     except Exception as e:
         logging.error(f"Ошибка в обработчике /price: {e}")
 
+# ==== ИГРОВЫЕ ЧАСЫ ====
+# Все игровые таймеры (подсказки, следующий вопрос, конец раунда /roll) живут в одной куче.
+# Поток часов только достаёт наступившие таймеры и раздаёт их GAME_CLOCK_WORKERS потокам по замку:
+# таймеры одного чата идут по порядку в одном потоке, а сотни чатов не ждут отправки друг друга.
+# Состояние игр чата меняется только под его замком (ChatState.lock);
+# таймеры, созданные без замка, выполняются под общим game_lock.
+GAME_CLOCK_WORKERS = int(os.getenv("GAME_CLOCK_WORKERS", "8"))  # Потоков выполнения игровых таймеров
+game_lock = threading.RLock()
+
+class GameTimer:
+    __slots__ = ("due", "callback", "args", "lock", "cancelled")
+
+    def __init__(self, due, callback, args, lock=None):
+        self.due = due
+        self.callback = callback
+        self.args = args
+        self.lock = lock or game_lock
+        self.cancelled = False
+
+    # Отмена за O(1): запись остаётся в куче и пропускается при извлечении
+    def cancel(self):
+        self.cancelled = True
+
+class GameClock:
+    """Планировщик игровых таймеров. virtual=True — время двигается только через advance()
+    (для прогона целой викторины за миллисекунды)."""
+
+    def __init__(self, virtual=False):
+        self.virtual = virtual
+        self._time = 0.0
+        self._heap = []
+        self._seq = itertools.count()
+        self._ready = threading.Condition()
+
+    def now(self):
+        return self._time if self.virtual else time.monotonic()
+
+    def call_later(self, delay, callback, *args, lock=None):
+        timer = GameTimer(self.now() + delay, callback, args, lock)
+        with self._ready:
+            heapq.heappush(self._heap, (timer.due, next(self._seq), timer))
+            self._ready.notify()
+        return timer
+
+    def pending(self):
+        with self._ready:
+            return sum(1 for _, _, timer in self._heap if not timer.cancelled)
+
+    # Ближайший не отменённый таймер, срок которого наступил к моменту until (вызывать под _ready)
+    def _pop_due(self, until):
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+        if self._heap and self._heap[0][0] <= until:
+            return heapq.heappop(self._heap)[2]
+        return None
+
+    def _fire(self, timer):
+        with timer.lock:
+            if timer.cancelled:
+                return
+            timer.cancelled = True                         # Сработавший таймер больше не отменяется
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                logging.error(f"Ошибка в игровом таймере {getattr(timer.callback, '__name__', timer.callback)}: {e}")
+
+    # Виртуальное время: выполнить все таймеры на ближайшие seconds секунд
+    def advance(self, seconds):
+        target = self._time + seconds
+        while True:
+            with self._ready:
+                timer = self._pop_due(target)
+                if timer is None:
+                    self._time = target
+                    return
+                self._time = max(self._time, timer.due)
+            self._fire(timer)
+
+    def _run_worker(self, timers):
+        while True:
+            self._fire(timers.get())
+
+    def run_forever(self, workers=1):
+        queues = [queue.Queue() for _ in range(workers)]
+        for timers in queues:
+            threading.Thread(target=self._run_worker, args=(timers,), daemon=True).start()
+        # Замок → поток по кругу: hash(замка) — его адрес, и остаток от деления собирает чаты в немногих потоках
+        shards = {}
+        while True:
+            with self._ready:
+                timer = self._pop_due(self.now())
+                if timer is None:
+                    timeout = self._heap[0][0] - self.now() if self._heap else None
+                    self._ready.wait(timeout=timeout)
+                    continue
+            shard = shards.setdefault(timer.lock, len(shards) % workers)
+            queues[shard].put(timer)
+
+game_clock = GameClock()
+
+# ==== СОСТОЯНИЕ ЧАТОВ ====
+# Игры каждого чата изолированы: своё состояние, свой замок, свои таймеры.
+# Состояние берётся из state_backend: в памяти — один запрос к словарю, в SQLite — одна строка.
+class SharedTimer:
+    """Игровой таймер в общем хранилище: лежит в состоянии чата, срабатывает у лидера."""
+
+    def __init__(self, due, callback, args):
+        self.due = due                                     # time.time(), а не monotonic — общий для процессов
+        self.callback = callback.__name__                  # Функция модуля, вызывается как callback(state, *args)
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class ChatState:
+    """Состояние викторины, /roll и /reroll одного чата."""
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.lock = threading.RLock()
+
+        # Викторина
+        self.trivia_running = False                        # Викторина запущена администратором
+        self.trivia_active = False                         # Текущий вопрос принимает ответы
+        self.current_trivia = None
+        self.current_mask = None
+        self.hint_index = 0
+        self.hint_timer = None                             # Таймер следующей подсказки
+        self.next_trivia_timer = None                      # Таймер следующего вопроса
+        self.trivia_category = None                        # Фильтр вопросов (None — любые)
+        self.trivia_difficulty = None
+        self.trivia_question_id = 0                        # Номер текущего вопроса (для compare-and-set победы)
+        self.trivia_message_id = 0                         # Сообщение с вопросом: ответы до него не считаются
+        self.trivia_asked_at = 0                           # Дата вопроса по часам Telegram
+        self.trivia_winner = None
+        self.trivia_answers = {}                           # user_id: время верного ответа, с
+
+        # /roll
+        self.roll_round_active = False
+        self.roll_results = {}                             # user_id: (score, display_name, username)
+        self.roll_timer = None
+
+        # /reroll
+        self.reroll_enabled = False
+        self.reroll_temp_players = set()
+        self.reroll_mode = 'free'                          # 'tournament' или 'free'
+        self.reroll_duel_queue = []                        # Очередь игроков
+        self.current_duel_players = set()                  # Пара для текущей дуэли
+        self.game_state = {}                               # Храним одного игрока
+        self.timers = []                                   # SharedTimer (только в общем хранилище)
+
+    # Замок не сохраняется в хранилище, после загрузки создаётся новый
+    def __getstate__(self):
+        data = self.__dict__.copy()
+        del data["lock"]
+        return data
+
+    def __setstate__(self, data):
+        self.__init__(data["chat_id"])                     # Поля, добавленные позже, получают значения по умолчанию
+        self.__dict__.update(data)
+        self.lock = threading.RLock()
+
+    # Таймер игры этого чата: срабатывает под замком чата (в общем хранилище — у лидера)
+    def call_later(self, delay, callback, *args):
+        if state_backend.shared:
+            timer = SharedTimer(time.time() + delay, callback, args)
+            self.timers.append(timer)
+            return timer
+        return game_clock.call_later(delay, callback, self, *args, lock=self.lock)
+
+    # Принимаются ли сейчас ответы: вопрос идёт или победитель уже есть, но раунд ещё не закрыт
+    def accepts_answers(self):
+        return bool(self.current_trivia) and (self.trivia_active or self.trivia_winner is not None)
+
+    # Срок ближайшего таймера (для выборки из хранилища)
+    def next_due(self):
+        return min((timer.due for timer in self.timers if not timer.cancelled), default=None)
+
+# Сессия чата: состояние под замком (в SQLite — под арендой чата); None, если бот в этом чате не работает
+@contextmanager
+def chat_session(chat_id):
+    if chat_config(chat_id) is None:
+        yield None
+        return
+    with state_backend.chat_session(str(chat_id), ChatState) as state:
+        yield state
+
+# Обработчик игры: выполняется только в обслуживаемых чатах, в сессии чата, получает его состояние
+def with_chat_state(func):
+    @functools.wraps(func)
+    def wrapper(message):
+        with chat_session(message.chat.id) as state:
+            if state is None:
+                return
+            return func(message, state)
+    return wrapper
+
+# Лидер выполняет наступившие таймеры из общего хранилища
+def fire_shared_timers():
+    for chat_id in state_backend.due_chats(time.time()):
+        with chat_session(chat_id) as state:
+            if state is None:
+                continue
+            now = time.time()
+            due = sorted((timer for timer in state.timers if not timer.cancelled and timer.due <= now), key=lambda timer: timer.due)
+            state.timers = [timer for timer in state.timers if not timer.cancelled and timer.due > now]
+            for timer in due:
+                if timer.cancelled:                        # Отменён предыдущим таймером этого же прохода
+                    continue
+                timer.cancelled = True
+                try:
+                    globals()[timer.callback](state, *timer.args)
+                except Exception as e:
+                    logging.error(f"Ошибка в игровом таймере {timer.callback}: {e}")
+
+def run_shared_timers():
+    while True:
+        if is_leader():
+            try:
+                fire_shared_timers()
+            except Exception as e:
+                logging.error(f"Ошибка обработки общих таймеров: {e}")
+        time.sleep(STATE_TIMER_POLL)
+
 # === ДОБАВЛЯЕМ ВИКТОРИНУ TRIVIA ===
-trivia_active = False
-current_trivia = None
-current_mask = None
-hint_index = 0
-hint_timer = None
-
-# Загружаем список вопросов
-def load_trivia_questions():
-    if os.path.exists(TRIVIA_FILE):
-        with open(TRIVIA_FILE, "r", encoding="utf-8") as f:
-            questions = [line.strip() for line in f if line.strip() and ':' in line]
-        return [tuple(q.split(':', 1)) for q in questions]
-    return []
-
-trivia_questions = load_trivia_questions()
+# ==== БАНК ВОПРОСОВ ====
+# Вопросы не держатся в памяти: индекс хранит смещение каждой строки-вопроса (8 байт) и номер раздела,
+# сам вопрос читается с диска по смещению. Индекс сохраняется рядом с файлом и пересобирается
+# только после изменения файла — в фоновом потоке, игра в это время идёт по старому индексу.
+# Формат файла:
+#   [категория:сложность]    — заголовок раздела, действует до следующего заголовка
+#   Вопрос:Ответ
+TRIVIA_INDEX_FILE = TRIVIA_FILE + ".idx"
+TRIVIA_RELOAD_INTERVAL = int(os.getenv("TRIVIA_RELOAD_INTERVAL", "10"))   # Как часто проверять изменения файла (сек)
+TRIVIA_SECTION_RE = re.compile(r"^\[([^:\]]*)(?::([^\]]*))?\]$")
+TRIVIA_MAX_LINE = 4096                                     # Максимальная длина строки вопроса (байт)
+
+# Подпись файла: изменилась — индекс устарел
+def file_signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+class QuestionBank:
+    """Индекс файла вопросов: случайный доступ к любому вопросу за одно чтение с диска."""
+
+    def __init__(self, path, signature, offsets, sections, section_names):
+        self.path = path
+        self.signature = signature
+        self.offsets = offsets                             # array('Q'): смещение строки вопроса
+        self.sections = sections                           # array('H'): номер раздела вопроса
+        self.section_names = section_names                 # [(категория, сложность), ...]
+        # Файл остаётся открытым: при замене файла на новый старый индекс читает старое содержимое
+        self._file = open(path, "rb")
+
+    @classmethod
+    def open(cls, path):
+        signature = file_signature(path)
+        try:
+            with open(TRIVIA_INDEX_FILE, "rb") as f:
+                header = json.loads(f.readline())
+                if header["signature"] == signature:
+                    offsets = array.array("Q")
+                    offsets.frombytes(f.read(header["count"] * offsets.itemsize))
+                    sections = array.array("H")
+                    sections.frombytes(f.read(header["count"] * sections.itemsize))
+                    return cls(path, signature, offsets, sections, [tuple(s) for s in header["sections"]])
+        except (OSError, ValueError, KeyError):
+            pass
+
+        started = time.perf_counter()
+        offsets, sections, section_names = array.array("Q"), array.array("H"), [("", "")]
+        section = 0
+        with open(path, "rb") as f:
+            offset = 0
+            for raw in f:
+                line = raw.strip().decode("utf-8", errors="replace")
+                header = TRIVIA_SECTION_RE.match(line)
+                if header:
+                    name = (header.group(1).strip().lower(), (header.group(2) or "").strip().lower())
+                    if name not in section_names:
+                        section_names.append(name)
+                    section = section_names.index(name)
+                elif ':' in line and not line.startswith('#'):
+                    offsets.append(offset)
+                    sections.append(section)
+                offset += len(raw)
+
+        # Сохраняем индекс атомарно: временный файл + переименование
+        tmp_path = TRIVIA_INDEX_FILE + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps({"signature": signature, "count": len(offsets), "sections": section_names}).encode("utf-8") + b"\n")
+            f.write(offsets.tobytes())
+            f.write(sections.tobytes())
+        os.replace(tmp_path, TRIVIA_INDEX_FILE)
+        logging.info(f"[TRIVIA] Индекс {path}: {len(offsets)} вопросов, {len(section_names)} разделов за {(time.perf_counter() - started) * 1000:.0f} мс")
+        return cls(path, signature, offsets, sections, section_names)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # Вопрос и ответ по номеру; None, если строка повреждена (файл правят на месте)
+    def get(self, index):
+        data = os.pread(self._file.fileno(), TRIVIA_MAX_LINE, self.offsets[index])
+        line = data.split(b"\n", 1)[0].strip().decode("utf-8", errors="replace")
+        if ':' not in line:
+            return None
+        question, answer = line.split(':', 1)
+        return question, answer
+
+    def section(self, index):
+        return self.section_names[self.sections[index]]
+
+    # Подходит ли вопрос под фильтр чата (None — любая категория/сложность)
+    def matches(self, index, category=None, difficulty=None):
+        return self.section_matches(self.section_names[self.sections[index]], category, difficulty)
+
+    @staticmethod
+    def section_matches(name, category=None, difficulty=None):
+        return (category is None or name[0] == category) and (difficulty is None or name[1] == difficulty)
+
+    # Есть ли в файле раздел под фильтр (проверка аргументов /rpdao_trivia)
+    def has_section(self, category=None, difficulty=None):
+        return any(self.section_matches(name, category, difficulty) for name in self.section_names)
+
+def open_question_bank():
+    if not os.path.exists(TRIVIA_FILE):
+        return None
+    try:
+        return QuestionBank.open(TRIVIA_FILE)
+    except Exception as e:
+        logging.error(f"Ошибка при загрузке вопросов: {e}")
+        return None
 
-# Отправка следующего вопроса
-def start_next_trivia():
-    global current_trivia, current_mask, hint_index, trivia_active
+question_bank = open_question_bank()
+
+# Следим за файлом вопросов; новый индекс подменяет старый одним присваиванием
+def run_trivia_watcher():
+    global question_bank
+    while True:
+        time.sleep(TRIVIA_RELOAD_INTERVAL)
+        try:
+            signature = file_signature(TRIVIA_FILE) if os.path.exists(TRIVIA_FILE) else None
+            if signature != (question_bank.signature if question_bank else None):
+                question_bank = open_question_bank()
+                logging.info(f"[TRIVIA] Файл вопросов перезагружен: {len(question_bank) if question_bank else 0} вопросов")
+        except Exception as e:
+            logging.error(f"Ошибка при перезагрузке вопросов: {e}")
+
+# Ротация без повторов: позиция p даёт вопрос shuffled_index(p) — псевдослучайная перестановка
+# всех n номеров (сеть Фейстеля на 4 раунда + cycle walking), без хранения самой перестановки.
+# Соседние позиции дают несвязанные номера, поэтому порядок не угадывается и не повторяет
+# группировку файла. Состояние (seed, p) каждого чата и фильтра хранится в scores.db и переживает
+# перезапуск; новый цикл — новый seed.
+FEISTEL_ROUNDS = 4
+_MASK64 = (1 << 64) - 1
+
+score_db.execute("CREATE TABLE IF NOT EXISTS trivia_shuffle (key TEXT PRIMARY KEY, size INTEGER NOT NULL, seed INTEGER NOT NULL, position INTEGER NOT NULL)")
+score_db.commit()
+
+def new_rotation():
+    return random.getrandbits(62), 0
+
+def _feistel_round(value, key):
+    value = ((value ^ key) * 0xBF58476D1CE4E5B9) & _MASK64
+    return value ^ (value >> 31)
+
+# Биекция range(n) → range(n): Фейстель на 2^bits >= n, значения за пределами n прогоняются ещё раз
+def shuffled_index(position, n, seed):
+    half = max(1, ((n - 1).bit_length() + 1) // 2)
+    mask = (1 << half) - 1
+    keys = [(seed * (2 * i + 1) * 0x9E3779B97F4A7C15) & _MASK64 for i in range(FEISTEL_ROUNDS)]
+    value = position
+    while True:
+        left, right = value >> half, value & mask
+        for key in keys:
+            left, right = right, left ^ (_feistel_round(right, key) & mask)
+        value = (left << half) | right
+        if value < n:
+            return value
+
+# Следующий подходящий вопрос чата: (вопрос, ответ, (категория, сложность)) или None.
+# Поиск по фильтру идёт без замка базы — замок берётся только на чтение и запись позиции
+def next_trivia_question(state):
+    bank = question_bank
+    if not bank:
+        return None
+    n = len(bank)
+    key = f"{state.chat_id}|{state.trivia_category or ''}|{state.trivia_difficulty or ''}"
+    with _score_db_lock:
+        row = score_db.execute("SELECT size, seed, position FROM trivia_shuffle WHERE key = ?", (key,)).fetchone()
+    seed, position = row[1:] if row and row[0] == n else new_rotation()
+    found = None
+    for _ in range(n):                                     # Не больше одного полного цикла
+        if position >= n:
+            seed, position = new_rotation()
+        index = shuffled_index(position, n, seed)
+        position += 1
+        if bank.matches(index, state.trivia_category, state.trivia_difficulty):
+            question = bank.get(index)
+            if question:
+                found = question + (bank.section(index),)
+                break
+    with _score_db_lock:
+        with score_db:
+            score_db.execute("INSERT OR REPLACE INTO trivia_shuffle (key, size, seed, position) VALUES (?, ?, ?, ?)", (key, n, seed, position))
+    return found
+
+# ==== СРАВНЕНИЕ ОТВЕТОВ ====
+# Ответ и сообщение нормализуются (регистр, ё/е, пунктуация, пробелы), опечатки допускаются
+# по расстоянию Левенштейна. В файле вопросов несколько верных ответов пишутся через '|':
+#   Столица Франции:Париж|Paris
+# Проверка одного сообщения — нормализация O(длина сообщения) и полоса шириной 2k+1 в таблице
+# расстояний; сообщения, длина которых сильно отличается от ответа, отсекаются сразу.
+TRIVIA_FUZZY = os.getenv("TRIVIA_FUZZY", "1") == "1"       # 0 — принимать только точный ответ (после нормализации)
+_NON_WORD_RE = re.compile(r"[\W_]+")
+
+def normalize_answer(text):
+    text = unicodedata.normalize("NFKC", text).casefold().replace("ё", "е")
+    return " ".join(_NON_WORD_RE.sub(" ", text).split())
+
+# Основной ответ — первый из перечисленных (для подсказок и объявления победителя)
+def primary_answer(answer):
+    return answer.split('|', 1)[0].strip()
+
+# Сколько опечаток прощаем: числа (годы, суммы) и короткие слова — только точно,
+# иначе «1962» засчитывается за «1961», а «Мари» — за «Марс»
+def answer_tolerance(answer):
+    if not TRIVIA_FUZZY or len(answer) <= 5 or any(char.isdigit() for char in answer):
+        return 0
+    return 1 if len(answer) <= 9 else 2
+
+# Расстояние Левенштейна, если оно не больше k, иначе k + 1.
+# Считается только диагональная полоса, выход сразу, как только вся строка таблицы больше k
+def bounded_distance(a, b, k):
+    if abs(len(a) - len(b)) > k:
+        return k + 1
+    if len(a) > len(b):
+        a, b = b, a
+    over = k + 1
+    prev = [j if j <= k else over for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        cur = [over] * (len(b) + 1)
+        cur[0] = i if i <= k else over
+        row_min = cur[0]
+        char = a[i - 1]
+        for j in range(max(1, i - k), min(len(b), i + k) + 1):
+            value = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (char != b[j - 1]))
+            cur[j] = value
+            if value < row_min:
+                row_min = value
+        if row_min > k:
+            return over
+        prev = cur
+    return min(prev[len(b)], over)
+
+class AnswerMatcher:
+    """Скомпилированные варианты ответа одного вопроса."""
+
+    def __init__(self, answer):
+        parts = [part.strip() for part in answer.split('|') if part.strip()]
+        self.variants = [(text, answer_tolerance(text)) for text in map(normalize_answer, parts) if text]
+        self.exact = {text for text, _ in self.variants}
+        # Ответ только из знаков или эмодзи («?!», «🍕») нормализуется в пустую строку — его сравниваем как есть
+        self.raw = {part.casefold() for part in parts if not normalize_answer(part)}
+        self.max_length = max([len(text) + k for text, k in self.variants] + [len(text) for text in self.raw], default=0)
+
+    def matches(self, message_text):
+        # Заведомо длинное сообщение не нормализуем целиком
+        if len(message_text) > 4 * self.max_length + 16:
+            return False
+        if self.raw and message_text.strip().casefold() in self.raw:
+            return True
+        text = normalize_answer(message_text)
+        if text in self.exact:
+            return True
+        return any(k and bounded_distance(text, variant, k) <= k for variant, k in self.variants)
+
+# Компиляция один раз на вопрос
+@functools.lru_cache(maxsize=256)
+def compile_answer(answer):
+    return AnswerMatcher(answer)
+
+# ==== СКОРОСТЬ ОТВЕТОВ ====
+# Время ответа считается по часам Telegram: дата сообщения с ответом минус дата сообщения с вопросом,
+# поэтому очередь и задержки бота на него не влияют (точность — секунда, как у message.date).
+# Порядок ответов — порядок message_id в чате; обновления одного чата обрабатываются по очереди.
+# Лучшие времена (таблица trivia_fastest) копятся в памяти и пишутся вместе с очками в flush_scores.
+
+# Победу получает только первый верный ответ: compare-and-set по номеру вопроса
+def claim_trivia(state, question_id, user_id):
+    if not state.trivia_active or state.trivia_question_id != question_id:
+        return False
+    state.trivia_active = False
+    state.trivia_winner = user_id
+    return True
 
-    if trivia_question_pending:
-        return                                             # Защита от повторного запуска
-    trivia_question_pending = False                        # Сброс
+# Время верного ответа (в секундах); учитывается первый верный ответ каждого игрока, в том числе после победителя
+def record_trivia_answer(state, message):
+    user_id = message.from_user.id
+    if user_id not in state.trivia_answers:
+        state.trivia_answers[user_id] = max(0, message.date - state.trivia_asked_at)
+    return state.trivia_answers[user_id]
+
+# Статистика раунда: (ответов, быстрейший, медиана) или None, если верных ответов не было
+def trivia_round_stats(state):
+    times = sorted(state.trivia_answers.values())
+    if not times:
+        return None
+    middle = len(times) // 2
+    median = times[middle] if len(times) % 2 else (times[middle - 1] + times[middle]) / 2
+    return len(times), times[0], median
+
+def close_trivia_round(state):
+    if state.trivia_question_id:
+        stats = trivia_round_stats(state)
+        if stats:
+            logging.info(f"[TRIVIA] Чат {state.chat_id}, вопрос #{state.trivia_question_id}: верных ответов {stats[0]}, быстрейший {stats[1]} с, медиана {stats[2]} с")
+        else:
+            logging.info(f"[TRIVIA] Чат {state.chat_id}, вопрос #{state.trivia_question_id}: верных ответов нет")
+    state.trivia_answers = {}
+    state.trivia_winner = None
+
+def record_fastest(chat_id, user_id, seconds):
+    with _score_lock:
+        _merge_fastest((str(chat_id), str(user_id)), seconds, 1)
+
+# Лучшие времена чата: [(место, user_id, секунды, побед)], с ещё не записанными победами.
+# Из базы берём limit + k строк (k — игроков в буфере) и строки самих игроков из буфера:
+# игрок из настоящего топа без изменений в буфере обязательно попадает в первые limit + k
+def fastest_answers(chat_id, limit=10):
+    chat_id = str(chat_id)
+    with _score_lock:
+        pending = {user_id: tuple(value) for (pending_chat, user_id), value in _fastest_pending.items() if pending_chat == chat_id}
+    with _score_db_lock:
+        rows = score_db.execute(
+            "SELECT user_id, best, wins FROM trivia_fastest WHERE chat_id = ? ORDER BY best, wins DESC LIMIT ?",
+            (chat_id, limit + len(pending))
+        ).fetchall()
+        if pending:
+            marks = ",".join("?" * len(pending))
+            rows += score_db.execute(f"SELECT user_id, best, wins FROM trivia_fastest WHERE chat_id = ? AND user_id IN ({marks})", (chat_id, *pending)).fetchall()
+    merged = {user_id: (best, wins) for user_id, best, wins in rows}
+    for user_id, (best, wins) in pending.items():
+        stored = merged.get(user_id)
+        merged[user_id] = (min(stored[0], best), stored[1] + wins) if stored else (best, wins)
+    top = sorted(merged.items(), key=lambda item: (item[1][0], -item[1][1]))[:limit]
+    return [(place, int(user_id), best, wins) for place, (user_id, (best, wins)) in enumerate(top, start=1)]
+
+# Планируем следующий вопрос (повторный вызов переносит уже запланированный)
+def schedule_next_trivia(state, delay):
+    if state.next_trivia_timer:
+        state.next_trivia_timer.cancel()
+    state.next_trivia_timer = state.call_later(delay, start_next_trivia)
 
-    if not trivia_questions:
-        msg = bot.send_message(CHAT_ID, f"❌ The list of questions is empty.\n\n❌ Список вопросов пуст.")
-        threading.Timer(30, lambda: safe_delete_message(CHAT_ID, msg.message_id)).start()
+# Отправка следующего вопроса
+def start_next_trivia(state):
+    state.next_trivia_timer = None
+    if not state.trivia_running or state.trivia_active:
+        return                                             # Викторину остановили или вопрос уже идёт
+
+    picked = next_trivia_question(state)
+    if not picked:
+        state.trivia_running = False
+        msg = bot.send_message(state.chat_id, f"❌ The list of questions is empty.\n\n❌ Список вопросов пуст.")
+        schedule_delete(state.chat_id, msg.message_id, 30)
         return
 
-    current_trivia = random.choice(trivia_questions)
-    question, answer = current_trivia
-    current_mask = ['-' for _ in answer]
-    hint_index = 0
-    trivia_active = True
-
-    msg = bot.send_message(CHAT_ID, f"🧠 Викторина началась!\n\n\n{question}")
-    trivia_question_pending = True
-    threading.Timer(180, lambda: safe_delete_message(CHAT_ID, msg.message_id)).start()
-    schedule_hint()
+    question, answer, (category, difficulty) = picked
+    close_trivia_round(state)
+    state.trivia_question_id += 1
+    state.current_trivia = (question, answer)
+    state.current_mask = ['-' for _ in primary_answer(answer)]
+    state.hint_index = 0
+    state.trivia_active = True
+
+    section = " · ".join(part for part in (category, difficulty) if part)
+    msg = bot.send_message(state.chat_id, f"🧠 Викторина началась!{f' [{section}]' if section else ''}\n\n\n{question}")
+    state.trivia_message_id = msg.message_id
+    state.trivia_asked_at = msg.date
+    schedule_delete(state.chat_id, msg.message_id, 180)
+    schedule_hint(state)
 
 # Подсказки
-def schedule_hint():
-    global hint_timer
-    hint_timer = Timer(15, send_hint)                      # Подсказка каждые 15 секунд
-    hint_timer.start()
-
-def send_hint():
-    global hint_index, current_trivia, trivia_active
-    if not trivia_active or not current_trivia:
+def schedule_hint(state):
+    state.hint_timer = state.call_later(15, send_hint)     # Подсказка каждые 15 секунд
+
+# Никто не угадал — показываем ответ и через 30 секунд следующий вопрос
+def finish_unanswered_trivia(state, answer):
+    state.trivia_active = False
+    bot.send_message(state.chat_id, f"❌ Никто не угадал!\n\nОтвет был: {answer}")
+    schedule_next_trivia(state, 30)
+
+def send_hint(state):
+    if not state.trivia_active or not state.current_trivia:
         return                                # Не отправляем подсказку, если викторина не активна
 
-    question, answer = current_trivia
+    question, answer = state.current_trivia
+    answer = primary_answer(answer)
+    current_mask = state.current_mask
 
     # Найдём все скрытые позиции
     hidden_indices = [i for i, char in enumerate(current_mask) if char == '-']
@@ -372,29 +2277,23 @@ def send_hint():
         random_index = random.choice(hidden_indices)
         current_mask[random_index] = answer[random_index]
 
-        msg = bot.send_message(CHAT_ID, f"🕵️‍♂️ Подсказка:\n\n{''.join(current_mask)}")
-        threading.Timer(20, lambda: safe_delete_message(CHAT_ID, msg.message_id)).start()
+        msg = bot.send_message(state.chat_id, f"🕵️‍♂️ Подсказка:\n\n{''.join(current_mask)}")
+        schedule_delete(state.chat_id, msg.message_id, 20)
 
         # Планируем следующую подсказку, если есть ещё скрытые буквы
         if '-' in current_mask:
-            schedule_hint()
+            schedule_hint(state)
         else:
-            bot.send_message(CHAT_ID, f"❌ Никто не угадал!\n\nОтвет был: {answer}")
-            start_next_trivia()
+            finish_unanswered_trivia(state, answer)
     else:
         # Нет скрытых букв — завершаем
-        bot.send_message(CHAT_ID, f"❌ Никто не угадал!\n\nОтвет был: {answer}")
-        trivia_active = False
-        trivia_question_pending = True
-        threading.Timer(30, start_next_trivia).start()     # Запуск следующего вопроса через 15 сек
+        finish_unanswered_trivia(state, answer)
 
 # === ЗАПУСК ВИКТОРИНЫ (только админ) ===
 @bot.message_handler(commands=['rpdao_trivia'])
 @delete_command_after
-def handle_trivia_start(message):
-    global trivia_active
-    if str(message.chat.id) != CHAT_ID:
-        return
+@with_chat_state
+def handle_trivia_start(message, state):
     user_id = message.from_user.id
 
     # Получаем username без @, либо user_id
@@ -404,30 +2303,44 @@ def handle_trivia_start(message):
         member = bot.get_chat_member(message.chat.id, user_id)
         if not (member.status in ['administrator', 'creator']):
             msg = bot.reply_to(message, f"⛔ Only an administrator can start a Trivia.\n\n⛔ Только администратор может запустить викторину.")
-            threading.Timer(10, lambda: safe_delete_message(CHAT_ID, msg.message_id)).start()
+            schedule_delete(state.chat_id, msg.message_id, 10)
             return
     except:
         return
 
-    if trivia_active:
-        msg = bot.send_message(CHAT_ID, f"⚠️ The Trivia has already been launched.\n\n⚠️ Викторина уже запущена.")
-        threading.Timer(10, lambda: safe_delete_message(CHAT_ID, msg.message_id)).start()
+    if state.trivia_running:
+        msg = bot.send_message(state.chat_id, f"⚠️ The Trivia has already been launched.\n\n⚠️ Викторина уже запущена.")
+        schedule_delete(state.chat_id, msg.message_id, 10)
+        return
+
+    # Необязательный фильтр: /rpdao_trivia [категория] [сложность]
+    args = [arg.lower() for arg in message.text.split()[1:3]]
+    category = args[0] if args and args[0] != '*' else None
+    difficulty = args[1] if len(args) > 1 and args[1] != '*' else None
+    bank = question_bank
+    if bank and not bank.has_section(category, difficulty):
+        sections = ", ".join(":".join(part for part in name if part) for name in bank.section_names if name[0]) or "—"
+        msg = bot.reply_to(
+            message,
+            f"⚠️ No questions for «{category or '*'}:{difficulty or '*'}». Sections: {sections}\n\n"
+            f"⚠️ Нет вопросов для «{category or '*'}:{difficulty or '*'}». Разделы: {sections}"
+        )
+        schedule_delete(state.chat_id, msg.message_id, 30)
         return
+    state.trivia_category, state.trivia_difficulty = category, difficulty
 
-    trivia_active = True
-    bot.send_message(CHAT_ID, f"🔎 The Trivia has started! Get ready to answer!\n\n🔎 Викторина запущена! Готовьтесь отвечать!")
-    logging.info(f"{username} запустил Trivia")
+    state.trivia_running = True
+    bot.send_message(state.chat_id, f"🔎 The Trivia has started! Get ready to answer!\n\n🔎 Викторина запущена! Готовьтесь отвечать!")
+    logging.info(f"{username} запустил Trivia в чате {state.chat_id} (раздел: {state.trivia_category or '*'}:{state.trivia_difficulty or '*'})")
 
     # Старт первого вопроса через 60 секунд
-    threading.Timer(60, start_next_trivia).start()
+    schedule_next_trivia(state, 60)
 
 # === ОСТАНОВКА ВИКТОРИНЫ (только админ) ===
 @bot.message_handler(commands=['rpdao_trivia_off'])
 @delete_command_after
-def handle_trivia_stop(message):
-    global trivia_active, current_trivia, current_mask, hint_index, hint_timer
-    if str(message.chat.id) != CHAT_ID:
-        return
+@with_chat_state
+def handle_trivia_stop(message, state):
     user_id = message.from_user.id
 
     # Получаем username без @, либо user_id
@@ -437,26 +2350,29 @@ def handle_trivia_stop(message):
         member = bot.get_chat_member(message.chat.id, user_id)
         if not (member.status in ['administrator', 'creator']):
             msg = bot.reply_to(message, f"⛔ Only an administrator can start a Trivia.\n\n⛔ Только администратор может остановить викторину.")
-            threading.Timer(10, lambda: safe_delete_message(CHAT_ID, msg.message_id)).start()
+            schedule_delete(state.chat_id, msg.message_id, 10)
             return
     except:
         return
 
-    trivia_active = False
-    current_trivia = None
-    current_mask = None
-    hint_index = 0
-    if hint_timer:
-        hint_timer.cancel()
-
-    bot.send_message(CHAT_ID, f"🛑 The Trivia has been stopped.\n\n🛑 Викторина остановлена.")
-    logging.info(f"{username} завершил Trivia")
+    state.trivia_running = False
+    state.trivia_active = False
+    close_trivia_round(state)
+    state.current_trivia = None
+    state.current_mask = None
+    state.hint_index = 0
+    if state.hint_timer:
+        state.hint_timer.cancel()
+    if state.next_trivia_timer:
+        state.next_trivia_timer.cancel()
+        state.next_trivia_timer = None
+
+    bot.send_message(state.chat_id, f"🛑 The Trivia has been stopped.\n\n🛑 Викторина остановлена.")
+    logging.info(f"{username} завершил Trivia в чате {state.chat_id}")
 
 # === ОБРАБОТКА ОТВЕТОВ TRIVIA ===
 @bot.message_handler(func=lambda m: m.text and not m.text.startswith('/'), content_types=['text'])
 def handle_text_messages(message):
-    global trivia_active, current_trivia, hint_timer
-    
     # Пропускаем старые сообщения (например, после запуска бота)
     if not is_recent(message):
         logging.info(f"[SKIP] Старое текстовое сообщение пропущено: {message.text}")
@@ -464,46 +2380,55 @@ def handle_text_messages(message):
 
     logging.info(f"[ALL_MSG] Текст от {message.from_user.username or message.from_user.id}")
 
-    if str(message.chat.id) != CHAT_ID:
+    config = chat_config(message.chat.id)
+    if config is None:
         return
 
     # === 1. TRIVIA логика ===
-    if trivia_active and current_trivia:
-        answer = current_trivia[1].strip().lower()
-        user_answer = message.text.strip().lower()
+    # Сессию чата открываем, только если в нём идёт раунд: обычная переписка состояние не трогает
+    if state_backend.accepts_answers(str(message.chat.id)):
+        with chat_session(message.chat.id) as state:
+            if state.accepts_answers() and message.message_id > state.trivia_message_id:
+                answer = state.current_trivia[1]
+                question_id = state.trivia_question_id
 
-        if user_answer == answer:
-            # === Отключаем викторину сразу, чтобы принять только 1 ответ ===
-            trivia_active = False
+                matched = compile_answer(answer).matches(message.text)
+                if matched:
+                    seconds = record_trivia_answer(state, message)
 
-            if hint_timer:
-                hint_timer.cancel()
+                # === Принимаем только 1 ответ на вопрос ===
+                if matched and claim_trivia(state, question_id, message.from_user.id):
+                    answer = primary_answer(answer).lower()
 
-            user_id = message.from_user.id
-            display_name = message.from_user.first_name or "Игрок"
+                    if state.hint_timer:
+                        state.hint_timer.cancel()
 
-            # Получаем username без @, либо user_id
-            username = message.from_user.username if message.from_user.username else str(user_id)
+                    user_id = message.from_user.id
+                    display_name = message.from_user.first_name or "Игрок"
 
-            scores[str(user_id)] = scores.get(str(user_id), 0) + 5
-            save_scores(scores)
+                    # Получаем username без @, либо user_id
+                    username = message.from_user.username if message.from_user.username else str(user_id)
 
-            bot.send_message(CHAT_ID, f"🎉 {display_name} угадал слово\n\n-----{answer}-----\n\nи получает 5 $LEG!")
-            logging.info(f"Победитель викторины: {username}, +5 очков")
+                    add_score(state.chat_id, user_id, 5)
+                    record_fastest(state.chat_id, user_id, seconds)
 
-            # Запуск следующего вопроса через 15 секунд
-            global trivia_question_pending
-            trivia_question_pending = True
-            threading.Timer(15, start_next_trivia).start()
-            return                                         # ❗ Не продолжаем дальше    
+                    bot.send_message(state.chat_id, f"🎉 {display_name} угадал слово за {seconds} с\n\n-----{answer}-----\n\nи получает 5 $LEG!")
+                    logging.info(f"Победитель викторины: {username}, +5 очков, ответ за {seconds} с")
+
+                    # Запуск следующего вопроса через 15 секунд
+                    schedule_next_trivia(state, 15)
+                    return                                     # ❗ Не продолжаем дальше
 
     # === 2. Пересылка текста в Discord ===
+    if not config["discord_webhook_url"]:
+        return
+
 	# Обработка обычных текстовых сообщений (не команд)
     # Получаем имя пользователя для отображения
     user_display = message.from_user.full_name or f"@{message.from_user.username}" if message.from_user.username else "Unknown"
     
-	# Аватарка (одна общая кастомная)
-    avatar_url = DISCORD_AVATAR_URL
+	# Аватарка (одна общая кастомная на чат)
+    avatar_url = config["discord_avatar_url"]
 
     # Проверка, является ли сообщение ответом
     if message.reply_to_message:
@@ -514,45 +2439,24 @@ def handle_text_messages(message):
         quoted = ""
 
     full_text = f"{quoted}{message.text}"
-    send_to_discord(full_text, username=user_display, avatar_url=avatar_url)
-
-# ==== ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ДЛЯ РЕЖИМА /roll ====
-roll_round_active = False
-roll_results = {}                                          # user_id: (score, display_name, username)
-roll_timer = None
+    send_to_discord(full_text, username=user_display, avatar_url=avatar_url, source_id=f"{message.chat.id}:{message.message_id}", webhook_url=config["discord_webhook_url"])
 
-# === ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ДЛЯ РЕЖИМА /reroll ===
-reroll_enabled = False
-reroll_temp_players = set()
-
-# Новый режим: 'tournament' или 'free'
-reroll_mode = 'free'                                       # по умолчанию свободный
-
-# Очередь для дуэлей в режиме 'tournament'
-reroll_duel_queue = []                                     # Очередь игроков
-current_duel_players = set()                               # Пара для текущей дуэли
-
-def start_roll_round(chat_id):
-    global roll_round_active, roll_results, roll_timer
-
-    if roll_round_active:
+def start_roll_round(state):
+    if state.roll_round_active:
         return False                                        # Раунд уже идёт
 
-    roll_round_active = True
-    roll_results = {}
-    roll_timer = Timer(120, finish_roll_round)               # 2 минуты
-    roll_timer.start()
+    state.roll_round_active = True
+    state.roll_results = {}
+    state.roll_timer = state.call_later(120, finish_roll_round)   # 2 минуты
 
-    bot.send_message(chat_id, f"🎲 The round has begun! Use /roll to roll a number from 0 to 100. You have 2 minutes!\n\n🎲 Раунд начался! Используйте /roll, чтобы бросить число от 0 до 100. У вас 2 минуты!")
+    bot.send_message(state.chat_id, f"🎲 The round has begun! Use /roll to roll a number from 0 to 100. You have 2 minutes!\n\n🎲 Раунд начался! Используйте /roll, чтобы бросить число от 0 до 100. У вас 2 минуты!")
     return True
 
 # ==== ОБРАБОТЧИК КОМАНДЫ /start_roll ====
 @bot.message_handler(commands=['start_roll'])
 @delete_command_after
-def handle_start_roll(message):
-    if str(message.chat.id) != CHAT_ID:
-        return
-
+@with_chat_state
+def handle_start_roll(message, state):
     user_id = message.from_user.id
     username = message.from_user.username or str(user_id)
 
@@ -561,34 +2465,30 @@ def handle_start_roll(message):
         member = bot.get_chat_member(message.chat.id, user_id)
         if not (member.status in ['administrator', 'creator']):
             msg = bot.reply_to(message, f"⛔ Only the administrator can start a round.\n\n⛔ Только администратор может запустить раунд.")
-            threading.Timer(30, lambda: safe_delete_message(message.chat.id, msg.message_id)).start()
+            schedule_delete(message.chat.id, msg.message_id, 30)
             return
     except Exception as e:
         logging.error(f"Ошибка при проверке прав администратора: {e}")
         msg = bot.reply_to(message, f"❌ Unable to verify rights.\n\n❌ Не удалось проверить права.")
-        threading.Timer(30, lambda: safe_delete_message(message.chat.id, msg.message_id)).start()
+        schedule_delete(message.chat.id, msg.message_id, 30)
         return
 
     # Запускаем раунд
-    if start_roll_round(message.chat.id):
+    if start_roll_round(state):
         logging.info(f"{username} запустил раунд через /start_roll")
     else:
         msg = bot.reply_to(message, f"⚠️ The round has already been launched.\n\n⚠️ Раунд уже запущен.")
-        threading.Timer(30, lambda: safe_delete_message(message.chat.id, msg.message_id)).start()
+        schedule_delete(message.chat.id, msg.message_id, 30)
 
 # ==== ОБРАБОТЧИК КОМАНДЫ /roll ====
 @bot.message_handler(commands=['roll'])
 @delete_command_after
-def handle_roll_command(message):
-    global roll_round_active, roll_results
-
-    if str(message.chat.id) != CHAT_ID:
-        return
-
+@with_chat_state
+def handle_roll_command(message, state):
     # Блокировка использования от имени ботов и каналов
     if message.from_user is None or message.from_user.is_bot:
         msg = bot.reply_to(message, f"⛔ Bots and channels cannot use this command.\n\n⛔ Боты и каналы не могут использовать эту команду.")
-        threading.Timer(30, lambda: safe_delete_message(message.chat.id, msg.message_id)).start()
+        schedule_delete(message.chat.id, msg.message_id, 30)
         return
 
     user_id = message.from_user.id
@@ -596,38 +2496,37 @@ def handle_roll_command(message):
     username = message.from_user.username or str(user_id)
 
     # Старт раунда, если он не начат
-    if not roll_round_active:
+    if not state.roll_round_active:
         msg = bot.reply_to(message, f"⚠️ Round has not started. Wait for the administrator to start it.\n\n⚠️ Раунд не начался. Ожидайте запуска от администратора.")
-        threading.Timer(30, lambda: safe_delete_message(message.chat.id, msg.message_id)).start()
+        schedule_delete(message.chat.id, msg.message_id, 30)
         return
 
     # Игрок уже бросал
-    if str(user_id) in roll_results:
+    if str(user_id) in state.roll_results:
         msg = bot.reply_to(message, f"⛔ You have already rolled a number this round.\n\n⛔ Вы уже бросили число в этом раунде.")
-        threading.Timer(30, lambda: safe_delete_message(message.chat.id, msg.message_id)).start()
+        schedule_delete(message.chat.id, msg.message_id, 30)
         return
 
     # Генерация числа
     score = random.randint(0, 100)
-    roll_results[str(user_id)] = (score, display_name, username)
+    state.roll_results[str(user_id)] = (score, display_name, username)
     msg = bot.reply_to(message, f"{display_name} 🎲 {score}")
     logging.info(f"{username} использовал /roll: {score}")
 
     # Удаляем сообщение через 2.5 минуты
-    threading.Timer(150, lambda: safe_delete_message(message.chat.id, msg.message_id)).start()
+    schedule_delete(message.chat.id, msg.message_id, 150)
 
 # ==== Завершение раунда Roll ====
-def finish_roll_round():
-    global roll_round_active, roll_results
+def finish_roll_round(state):
 
-    if not roll_results:
-        bot.send_message(CHAT_ID, f"⏱ There were no participants in the /roll round.\n\n⏱ В раунде /roll не было участников.")
-        roll_round_active = False
+    if not state.roll_results:
+        bot.send_message(state.chat_id, f"⏱ There were no participants in the /roll round.\n\n⏱ В раунде /roll не было участников.")
+        state.roll_round_active = False
         return
 
     # Ищем наибольшее число
-    max_score = max(score for score, _, _ in roll_results.values())
-    winners = [(uid, name, username) for uid, (score, name, username) in roll_results.items() if score == max_score]
+    max_score = max(score for score, _, _ in state.roll_results.values())
+    winners = [(uid, name, username) for uid, (score, name, username) in state.roll_results.items() if score == max_score]
 
     mentions_for_msg = []
     mentions_for_log = []
@@ -650,43 +2549,37 @@ def finish_roll_round():
     if len(winners) == 1:
         # Победитель один
         winner_id, winner_name, winner_username = winners[0]
-        scores[str(winner_id)] = scores.get(str(winner_id), 0) + 1
-        save_scores(scores)
+        add_score(state.chat_id, winner_id, 1)
         mention = f"@{winner_username}" if winner_username else winner_name
-        msg = bot.send_message(CHAT_ID, f"🏆 Round winner: {mention} with {max_score}!\n\n🏆 Победитель раунда: {mention} с результатом {max_score}!")
+        msg = bot.send_message(state.chat_id, f"🏆 Round winner: {mention} with {max_score}!\n\n🏆 Победитель раунда: {mention} с результатом {max_score}!")
         logging.info(f"Победитель /roll: {winner_username} ({winner_id}) ({max_score})")
         
     else:
         # Ничья
-        global reroll_enabled, reroll_mode, reroll_duel_queue, current_duel_players
         
         # В случае ничьей:
-        reroll_enabled = True
-        reroll_mode = 'tournament'
-        reroll_duel_queue = [int(uid) for uid, _, _ in winners]
-        first_id = reroll_duel_queue.pop(0)
-        second_id = reroll_duel_queue.pop(0)
-        current_duel_players = {first_id, second_id}
+        state.reroll_enabled = True
+        state.reroll_mode = 'tournament'
+        state.reroll_duel_queue = [int(uid) for uid, _, _ in winners]
+        first_id = state.reroll_duel_queue.pop(0)
+        second_id = state.reroll_duel_queue.pop(0)
+        state.current_duel_players = {first_id, second_id}
         bot.send_message(
-            CHAT_ID,
+            state.chat_id,
             f"🤝 Tie between: {', '.join(mentions_for_msg)} with score {max_score}!\n\n/reroll enabled for tie-breaker.\n\n🤝 Ничья между: {', '.join(mentions_for_msg)} с результатом {max_score}!\n\n/reroll включён для определения победителя.\n\n"
             f"⚔️ First duel: {name_by_uid[first_id]} vs {name_by_uid[second_id]}\n⚔️ Первая дуель: {name_by_uid[first_id]} против {name_by_uid[second_id]}"
         )    
         logging.info(f"Ничья в /roll между: {', '.join(mentions_for_log)} ({max_score})")
 
     # Сброс раунда
-    roll_results.clear()
-    roll_round_active = False
+    state.roll_results.clear()
+    state.roll_round_active = False
 
 # ==== ОБРАБОТЧИК КОМАНДЫ /stop_roll ====
 @bot.message_handler(commands=['stop_roll'])
 @delete_command_after
-def handle_stop_roll(message):
-    global roll_round_active, roll_results, reroll_enabled, reroll_temp_players, current_duel_players, reroll_duel_queue, reroll_mode
-
-    if str(message.chat.id) != CHAT_ID:
-        return
-
+@with_chat_state
+def handle_stop_roll(message, state):
     user_id = message.from_user.id
 
     # Проверка: только админ может остановить
@@ -694,22 +2587,25 @@ def handle_stop_roll(message):
         member = bot.get_chat_member(message.chat.id, user_id)
         if member.status not in ['administrator', 'creator']:
             msg = bot.reply_to(message, f"⛔ Only the administrator can stop the tournament.\n\n⛔ Только администратор может остановить турнир.")
-            threading.Timer(30, lambda: safe_delete_message(message.chat.id, msg.message_id)).start()
+            schedule_delete(message.chat.id, msg.message_id, 30)
             return
     except Exception as e:
         logging.error(f"Ошибка при проверке прав администратора: {e}")
         msg = bot.reply_to(message, f"❌ Unable to verify rights.\n\n❌ Не удалось проверить права.")
-        threading.Timer(30, lambda: safe_delete_message(message.chat.id, msg.message_id)).start()
+        schedule_delete(message.chat.id, msg.message_id, 30)
         return
 
     # Сбрасываем все переменные турнира
-    roll_round_active = False
-    roll_results.clear()
-    reroll_enabled = False
-    reroll_temp_players.clear()
-    current_duel_players.clear()
-    reroll_duel_queue.clear()
-    reroll_mode = 'free'
+    if state.roll_timer:
+        state.roll_timer.cancel()
+        state.roll_timer = None
+    state.roll_round_active = False
+    state.roll_results.clear()
+    state.reroll_enabled = False
+    state.reroll_temp_players.clear()
+    state.current_duel_players.clear()
+    state.reroll_duel_queue.clear()
+    state.reroll_mode = 'free'
 
     bot.send_message(message.chat.id, f"🛑 The /roll round and tournament have been forcibly stopped.\n\n🛑 Раунд и турнир /roll были принудительно остановлены.")
     logging.info(f"{message.from_user.username or message.from_user.id} остановил раунд и турнир /roll через /stop_roll.")
@@ -717,58 +2613,51 @@ def handle_stop_roll(message):
 # ==== ОБРАБОТЧИК КОМАНДЫ /reroll_on ====
 @bot.message_handler(commands=['reroll_on'])
 @delete_command_after
-def handle_reroll_on(message):
-    global reroll_enabled, reroll_mode, reroll_temp_players, current_duel_players, reroll_duel_queue
-    if str(message.chat.id) != CHAT_ID:
-        return
-
+@with_chat_state
+def handle_reroll_on(message, state):
     try:
         member = bot.get_chat_member(message.chat.id, message.from_user.id)
         if member.status not in ['administrator', 'creator']:
             msg = bot.reply_to(message, f"⛔ Available to administrators only.\n\n⛔ Доступно только администраторам.")
-            threading.Timer(30, lambda: safe_delete_message(message.chat.id, msg.message_id)).start()
+            schedule_delete(message.chat.id, msg.message_id, 30)
             return
     except Exception as e:
         logging.error(f"Ошибка при проверке прав администратора: {e}")
         msg = bot.reply_to(message, f"❌ Unable to verify rights.\n\n❌ Не удалось проверить права.")
-        threading.Timer(30, lambda: safe_delete_message(message.chat.id, msg.message_id)).start()
+        schedule_delete(message.chat.id, msg.message_id, 30)
         return
 
-    reroll_enabled = True
-    reroll_mode = 'free'
-    reroll_temp_players.clear()
-    current_duel_players.clear()
-    reroll_duel_queue.clear()
+    state.reroll_enabled = True
+    state.reroll_mode = 'free'
+    state.reroll_temp_players.clear()
+    state.current_duel_players.clear()
+    state.reroll_duel_queue.clear()
     bot.reply_to(message, f"✅ The /reroll command is now enabled.\n\n✅ Команда /reroll теперь включена.")
     logging.info(f"{message.from_user.username or message.from_user.id} включил использование команды /reroll (режим: free)")
 
 # ==== ОБРАБОТЧИК КОМАНДЫ /reroll_off ====
 @bot.message_handler(commands=['reroll_off'])
 @delete_command_after
-def handle_reroll_off(message):
-    global reroll_enabled
-    if str(message.chat.id) != CHAT_ID:
-        return
-
+@with_chat_state
+def handle_reroll_off(message, state):
     try:
         member = bot.get_chat_member(message.chat.id, message.from_user.id)
         if member.status not in ['administrator', 'creator']:
             msg = bot.reply_to(message, f"⛔ Available to administrators only.\n\n⛔ Доступно только администраторам.")
-            threading.Timer(30, lambda: safe_delete_message(message.chat.id, msg.message_id)).start()
+            schedule_delete(message.chat.id, msg.message_id, 30)
             return
     except Exception as e:
         logging.error(f"Ошибка при проверке прав администратора: {e}")
         msg = bot.reply_to(message, f"❌ Unable to verify rights.\n\n❌ Не удалось проверить права.")
-        threading.Timer(30, lambda: safe_delete_message(message.chat.id, msg.message_id)).start()
+        schedule_delete(message.chat.id, msg.message_id, 30)
         return
 
-    reroll_enabled = False
-    reroll_temp_players.clear()
+    state.reroll_enabled = False
+    state.reroll_temp_players.clear()
     bot.reply_to(message, f"⛔ The /reroll command is now disabled.\n\n⛔ Команда /reroll теперь отключена.")
     logging.info(f"{message.from_user.username or message.from_user.id} отключил использование команды /reroll")
 
-# === ПАМЯТЬ ДЛЯ ИГРЫ ===
-game_state = {}                                             # Храним одного игрока
+# === ВАРИАНТЫ ДЛЯ /reroll ===
 CHOICES = {
     '🪨': 'Камень',
     '✂️': 'Ножницы',
@@ -783,29 +2672,24 @@ BEATS = {
 # ==== ОБРАБОТЧИК КОМАНДЫ /reroll ====
 @bot.message_handler(commands=['reroll'])
 @delete_command_after
-def handle_reroll_command(message):
+@with_chat_state
+def handle_reroll_command(message, state):
     try:
-        global reroll_enabled, reroll_temp_players, reroll_mode
-        global current_duel_players, reroll_duel_queue
-
-        if str(message.chat.id) != CHAT_ID:
-            return
-
         user_id = message.from_user.id
         username = message.from_user.username
         display_name = message.from_user.first_name or "Игрок"
         mention = f"@{username}" if username else display_name
 
         # === Проверка доступа к команде ===
-        if not reroll_enabled:
+        if not state.reroll_enabled:
             msg = bot.reply_to(message, "⛔ The /reroll command is temporarily disabled.\n\n⛔ Команда /reroll временно отключена.")
-            threading.Timer(30, lambda: safe_delete_message(message.chat.id, msg.message_id)).start()
+            schedule_delete(message.chat.id, msg.message_id, 30)
             return
 
         # Если active duel идёт (после /roll), разрешены только игроки из current_duel_players
-        if reroll_mode == 'tournament' and user_id not in current_duel_players:
+        if state.reroll_mode == 'tournament' and user_id not in state.current_duel_players:
             msg = bot.reply_to(message, "⛔ Only current duel participants can use /reroll.\n⛔ Только участники текущей дуэли могут использовать /reroll.")
-            threading.Timer(30, lambda: safe_delete_message(message.chat.id, msg.message_id)).start()
+            schedule_delete(message.chat.id, msg.message_id, 30)
             return
 
         # === Генерация выбора ===
@@ -813,14 +2697,14 @@ def handle_reroll_command(message):
         name = CHOICES[emoji]                                 # Название выбора
 
         # Первый игрок
-        if not game_state:
-            game_state[user_id] = (name, emoji, display_name, username)
+        if not state.game_state:
+            state.game_state[user_id] = (name, emoji, display_name, username)
             msg = bot.reply_to(message, f"{emoji}\n\nWaiting for the second player...\nЖдём второго игрока...")
-            threading.Timer(60, lambda: safe_delete_message(message.chat.id, msg.message_id)).start()
+            schedule_delete(message.chat.id, msg.message_id, 60)
             return
 
         # Если второй игрок - сравнение
-        for opponent_id, (opp_name, opp_emoji, opp_display, opp_username) in list(game_state.items()):
+        for opponent_id, (opp_name, opp_emoji, opp_display, opp_username) in list(state.game_state.items()):
             if opponent_id == user_id:
                 bot.reply_to(message, f"⛔ You have already played. We are waiting for another player.\n\n⛔ Вы уже сыграли. Ждём другого игрока.")
                 return
@@ -830,7 +2714,7 @@ def handle_reroll_command(message):
             logging.info(f"{opp_username or opponent_id} бросил: {opp_name}")
 
             # Второй игрок сыграл
-            game_state.clear()
+            state.game_state.clear()
 
             player1_line = f"{opp_display} {opp_emoji}"
             player2_line = f"{emoji} {display_name}"
@@ -841,14 +2725,14 @@ def handle_reroll_command(message):
                 result += "🤝 It's a draw!\n🤝 Ничья!"
                 logging.info("Результат игры: Ничья!")
 
-                if reroll_mode == 'tournament':
+                if state.reroll_mode == 'tournament':
                     # Те же игроки снова
-                    current_duel_players = {user_id, opponent_id}
+                    state.current_duel_players = {user_id, opponent_id}
                     msg = bot.send_message(message.chat.id, result + "\n\n⚔️ Use /reroll again.\n⚔️ Используйте /reroll снова.")
                 else:
-                    reroll_temp_players = {user_id, opponent_id}
+                    state.reroll_temp_players = {user_id, opponent_id}
                     msg = bot.send_message(message.chat.id, result + "\n\n⚔️ Use /reroll again to resolve tie.\n⚔️ Используйте /reroll снова для определения победителя.")
-                threading.Timer(60, lambda: safe_delete_message(message.chat.id, msg.message_id)).start()
+                schedule_delete(message.chat.id, msg.message_id, 60)
                 return
 
             # === Победитель ===
@@ -866,21 +2750,16 @@ def handle_reroll_command(message):
 
             result += f"🎉 Winner: {winner_mention}!\n🎉 Победитель: {winner_mention}!\n"
 
-            scores[str(winner_id)] = scores.get(str(winner_id), 0) + 1
-            save_scores(scores)
+            add_score(state.chat_id, winner_id, 1)
 
             logging.info(f"Победитель: {winner_log_name} ({winner_id})")
 
-            if reroll_mode == 'tournament':
-                if reroll_duel_queue:
-                    next_id = reroll_duel_queue.pop(0)
-                    current_duel_players = {winner_id, next_id}
+            if state.reroll_mode == 'tournament':
+                if state.reroll_duel_queue:
+                    next_id = state.reroll_duel_queue.pop(0)
+                    state.current_duel_players = {winner_id, next_id}
 
-                    try:
-                        next_user = bot.get_chat_member(message.chat.id, next_id).user
-                        next_name = next_user.first_name or f"ID:{next_id}"
-                    except:
-                        next_name = f"ID:{next_id}"
+                    next_name = player_name(next_id, message.chat.id)
 
                     # Используем display_name победителя (winner_mention был first_name ранее)
                     current_name = winner_display or f"ID:{winner_id}"
@@ -891,24 +2770,21 @@ def handle_reroll_command(message):
                     )
                     bot.send_message(message.chat.id, result)
                 else:
-                    try:
-                        final_user = bot.get_chat_member(message.chat.id, winner_id).user
-                        final_username = f"{final_user.username}" if final_user.username else final_user.first_name or f"ID:{final_user.id}"
-                        final_name = final_user.first_name or f"ID:{winner_id}"
-                    except:
-                        final_name = f"ID:{winner_id}"
+                    final_username, final_first_name = get_profile(winner_id, message.chat.id)
+                    final_name = final_first_name or f"ID:{winner_id}"
+                    final_username = final_username or final_name
 
                     result += (
                         f"\n\n🏆 Grand Champion: {final_name}\n"
                         f"🏆 Финальный победитель турнира: {final_name}"
                     )
                     bot.send_message(message.chat.id, result)
-                    logging.info(f"Победитель /roll: {final_username} ({final_user.id})")
-                    reroll_enabled = False
-                    current_duel_players.clear()
+                    logging.info(f"Победитель /roll: {final_username} ({winner_id})")
+                    state.reroll_enabled = False
+                    state.current_duel_players.clear()
 
             else:
-                reroll_temp_players.clear()
+                state.reroll_temp_players.clear()
                 bot.send_message(message.chat.id, result)
                 return
 
@@ -924,90 +2800,172 @@ def escape_md(text):
 @bot.message_handler(commands=['score'])
 @delete_command_after
 def handle_score_command(message):
+    if chat_config(message.chat.id) is None:
+        return
     username = message.from_user.username or message.from_user.first_name or str(message.from_user.id)
     show_score_page(message.chat.id, page=0, reply_to=message.message_id, username=username)
 
-# Общая функция отображения страницы лидерборда
-def show_score_page(chat_id, page=0, reply_to=None, username="unknown"):
+# Кэш готовых страниц: (chat_id, страница) → (версия, текст, кнопки)
+_score_page_cache = {}
+
+# Текст и кнопки страницы лидерборда чата; None, если страница пуста
+def render_score_page(page, chat_id):
+    cached = _score_page_cache.get((str(chat_id), page))
+    if cached and leaderboard_page_fresh(chat_id, page, cached[0]):
+        return cached[1], cached[2]
+
+    per_page = LEADERBOARD_PAGE_SIZE
+    page_scores, total, version = leaderboard_page(chat_id, page, per_page)
+    end = (page + 1) * per_page
+    if not page_scores:
+        return None
+
+    rows = []
+
+    # Эмодзи для топ-3
+    for i, user_id, points in page_scores:
+        if i == 1:
+            place = "🥇"
+        elif i == 2:
+            place = "🥈"
+        elif i == 3:
+            place = "🥉"
+        else:
+            place = f"{i}."
 
-    per_page = 10
-    sorted_scores = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+        rows.append((place, player_name(user_id, chat_id), f"{points} $LEG"))
 
-    start = page * per_page
-    end = start + per_page
-    page_scores = sorted_scores[start:end]
+    # Вычисляем максимальные ширины
+    col1 = max(len(r[0]) for r in rows)
+    col2 = max(len(r[1]) for r in rows)
+    col3 = max(len(r[2]) for r in rows)
 
-    try:
-        if not page_scores:
-            msg = bot.send_message(chat_id, "🏆 There are no winners yet.")
-            threading.Timer(30, lambda: safe_delete_message(message.chat.id, msg.message_id)).start()
-            return
+    # Строим таблицу
+    lines = []
+    lines.append("#".ljust(col1) + " | " + "Purtorican".ljust(col2) + " | " + "Score".rjust(col3))
+    lines.append("-" * (col1 + col2 + col3 + 6))
+    for place, name, score in rows:
+        line = place.ljust(col1) + " | " + name.ljust(col2) + " | " + score.rjust(col3)
+        lines.append(line)
 
-        rows = []
+    text = "*🏆 Top players:*\n\n```" + "\n".join(lines) + "```"
 
-        # Эмодзи для топ-3
-        for i, (user_id, points) in enumerate(page_scores, start=1 + start):
-            if i == 1:
-                place = "🥇"
-            elif i == 2:
-                place = "🥈"
-            elif i == 3:
-                place = "🥉"
-            else:
-                place = f"{i}."
+    # Кнопки: Назад | В начало | Вперёд
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"score_{page-1}"))
+    if page > 1:
+        buttons.append(InlineKeyboardButton("⏮️ В начало", callback_data="score_0"))
+    if end < total:
+        buttons.append(InlineKeyboardButton("➡️ Далее", callback_data=f"score_{page+1}"))
 
-            try:
-                user = bot.get_chat_member(chat_id, int(user_id)).user
-                name = f"@{user.username}" if user.username else user.first_name
-                display_name = user.first_name or f"ID:{user_id}"
-            except:
-                name = f"ID:{user_id}"
-                display_name = f"ID:{user_id}"
-
-            rows.append((place, display_name, f"{points} $LEG"))
-
-        # Вычисляем максимальные ширины
-        col1 = max(len(r[0]) for r in rows)
-        col2 = max(len(r[1]) for r in rows)
-        col3 = max(len(r[2]) for r in rows)
-
-        # Строим таблицу
-        lines = []
-        lines.append("#".ljust(col1) + " | " + "Purtorican".ljust(col2) + " | " + "Score".rjust(col3))
-        lines.append("-" * (col1 + col2 + col3 + 6))
-        for place, name, score in rows:
-            line = place.ljust(col1) + " | " + name.ljust(col2) + " | " + score.rjust(col3)
-            lines.append(line)
-
-        text = "*🏆 Top players:*\n\n```" + "\n".join(lines) + "```"
-
-        # Кнопки: Назад | В начало | Вперёд
-        buttons = []
-        if page > 0:
-            buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"score_{page-1}"))
-        if page > 1:
-            buttons.append(InlineKeyboardButton("⏮️ В начало", callback_data="score_0"))
-        if end < len(sorted_scores):
-            buttons.append(InlineKeyboardButton("➡️ Далее", callback_data=f"score_{page+1}"))
-
-        markup = InlineKeyboardMarkup()
-        if buttons:
-            markup.row(*buttons)
+    markup = InlineKeyboardMarkup()
+    if buttons:
+        markup.row(*buttons)
+
+    _score_page_cache[(str(chat_id), page)] = (version, text, markup)
+    return text, markup
 
+# Общая функция отображения страницы лидерборда
+def show_score_page(chat_id, page=0, reply_to=None, username="unknown"):
+    try:
+        rendered = render_score_page(page, chat_id)
+        if rendered is None:
+            msg = bot.send_message(chat_id, "🏆 There are no winners yet.")
+            schedule_delete(chat_id, msg.message_id, 30)
+            return
+
+        text, markup = rendered
         msg = bot.send_message(chat_id, text, parse_mode="Markdown", reply_markup=markup, reply_to_message_id=reply_to)
-        threading.Timer(300, lambda: safe_delete_message(chat_id, msg.message_id)).start()
+        schedule_delete(chat_id, msg.message_id, 300)
         logging.info(f"{username} использует команду /score")
 
     except Exception as e:
         logging.error(f"Ошибка в /score: {e}")
 
+# Команда /myrank — место игрока в лидерборде
+@bot.message_handler(commands=['myrank'])
+@delete_command_after
+def handle_myrank_command(message):
+    if chat_config(message.chat.id) is None:
+        return
+    user_id = message.from_user.id
+    username = message.from_user.username or message.from_user.first_name or str(user_id)
+    try:
+        found = leaderboard_rank(message.chat.id, user_id)
+        if found is None:
+            text = "🏆 You have no points yet. Play TRIVIA or ROLL to get on the leaderboard!"
+        else:
+            rank, points = found
+            text = f"🏆 Your rank: *{rank}* of {leaderboard_size(message.chat.id)} — {points} $LEG"
+        msg = bot.send_message(message.chat.id, text, parse_mode="Markdown", reply_to_message_id=message.message_id)
+        schedule_delete(message.chat.id, msg.message_id, 30)
+        logging.info(f"{username} использует команду /myrank")
+    except Exception as e:
+        logging.error(f"Ошибка в /myrank: {e}")
+
+# Команда /top — карточка с лучшими игроками
+@bot.message_handler(commands=['top'])
+@delete_command_after
+def handle_top_command(message):
+    config = chat_config(message.chat.id)
+    if config is None:
+        return
+    username = message.from_user.username or message.from_user.first_name or str(message.from_user.id)
+    try:
+        page_scores, _, _ = leaderboard_page(message.chat.id, 0, LEADERBOARD_CARD_TOP)
+        if not page_scores:
+            msg = bot.send_message(message.chat.id, "🏆 There are no winners yet.")
+            schedule_delete(message.chat.id, msg.message_id, 30)
+            return
+
+        rows = [(place, user_id, player_name(user_id, message.chat.id), points) for place, user_id, points in page_scores]
+        photo = create_leaderboard_image(rows, config["background"])
+        if photo:
+            # Тот же топ — те же байты, поэтому повторная отправка идёт по file_id без загрузки
+            msg = send_cached_photo(message.chat.id, photo, caption="🏆 Top players")
+            schedule_delete(message.chat.id, msg.message_id, 300)
+        logging.info(f"{username} использует команду /top")
+    except Exception as e:
+        logging.error(f"Ошибка в /top: {e}")
+
+# Команда /fastest — самые быстрые верные ответы в викторине
+@bot.message_handler(commands=['fastest'])
+@delete_command_after
+def handle_fastest_command(message):
+    if chat_config(message.chat.id) is None:
+        return
+    username = message.from_user.username or message.from_user.first_name or str(message.from_user.id)
+    try:
+        rows = fastest_answers(message.chat.id)
+        if not rows:
+            text = "⚡ No trivia answers yet.\n\n⚡ В викторине ещё никто не отвечал."
+        else:
+            lines = [f"{place}. {player_name(user_id, message.chat.id)} — {best} s ({wins} 🏅)" for place, user_id, best, wins in rows]
+            text = "⚡ Fastest trivia answers / Самые быстрые ответы:\n\n" + "\n".join(lines)
+        msg = bot.send_message(message.chat.id, text, reply_to_message_id=message.message_id)
+        schedule_delete(message.chat.id, msg.message_id, 60)
+        logging.info(f"{username} использует команду /fastest")
+    except Exception as e:
+        logging.error(f"Ошибка в /fastest: {e}")
+
 # Обработка кнопок
 @bot.callback_query_handler(func=lambda call: call.data.startswith("score_"))
 def handle_score_pagination(call: CallbackQuery):
     try:
         page = int(call.data.split("_")[1])
-        bot.delete_message(call.message.chat.id, call.message.message_id)
-        show_score_page(call.message.chat.id, page)
+        rendered = render_score_page(page, call.message.chat.id)
+        if rendered is None:
+            bot.answer_callback_query(call.id, "🏆 There are no winners yet.")
+            return
+        text, markup = rendered
+        try:
+            bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode="Markdown", reply_markup=markup)
+        except ApiTelegramException as e:
+            # Страница не изменилась — Telegram отвечает ошибкой, это не сбой
+            if "message is not modified" not in str(e):
+                raise
+        bot.answer_callback_query(call.id)
     except Exception as e:
         logging.error(f"Ошибка в пагинации лидерборда: {e}")
 
@@ -1033,11 +2991,12 @@ GOOD_NIGHT_PHRASES = [
 @delete_command_after
 def handle_gm_command(message):
     try:
-        if str(message.chat.id) == CHAT_ID:
+        config = chat_config(message.chat.id)
+        if config:
             text = random.choice(GOOD_MORNING_PHRASES)
-            if create_greeting_image(text, "morning.jpg", "gm_output.jpg"):
-                with open("gm_output.jpg", "rb") as photo:
-                    bot.send_photo(message.chat.id, photo, caption=f"Всем бодрого утра, друзья! ☕\nGood morning to all, friends! ☕")
+            photo = create_greeting_image(text, config["morning_background"])
+            if photo:
+                send_cached_photo(message.chat.id, photo, caption=f"Всем бодрого утра, друзья! ☕\nGood morning to all, friends! ☕")
                 logging.info(f"{message.from_user.username or message.from_user.id} использовал /gm: {text}")
     except Exception as e:
         logging.error(f"Ошибка в /gm: {e}")
@@ -1047,11 +3006,12 @@ def handle_gm_command(message):
 @delete_command_after
 def handle_gn_command(message):
     try:
-        if str(message.chat.id) == CHAT_ID:
+        config = chat_config(message.chat.id)
+        if config:
             text = random.choice(GOOD_NIGHT_PHRASES)
-            if create_greeting_image(text, "night.jpg", "gn_output.jpg"):
-                with open("gn_output.jpg", "rb") as photo:
-                    bot.send_photo(message.chat.id, photo, caption=f"Спокойной ночи, Легенды! 🌌\nGood night, Legends! 🌌")
+            photo = create_greeting_image(text, config["night_background"])
+            if photo:
+                send_cached_photo(message.chat.id, photo, caption=f"Спокойной ночи, Легенды! 🌌\nGood night, Legends! 🌌")
                 logging.info(f"{message.from_user.username or message.from_user.id} использовал /gn: {text}")
     except Exception as e:
         logging.error(f"Ошибка в /gn: {e}")
@@ -1066,14 +3026,15 @@ def handle_photo_message(message):
         logging.info("[SKIP] Старое фото сообщение пропущено.")
         return
 
-    if str(message.chat.id) != CHAT_ID:
+    config = chat_config(message.chat.id)
+    if not config or not config["discord_webhook_url"]:
         return
 
     # Получаем имя пользователя для отображения
     user_display = message.from_user.full_name or f"@{message.from_user.username}" if message.from_user.username else "Unknown"
 
-	# Аватарка (одна общая кастомная)
-    avatar_url = DISCORD_AVATAR_URL
+	# Аватарка (одна общая кастомная на чат)
+    avatar_url = config["discord_avatar_url"]
 
     if message.reply_to_message:
         reply_author = message.reply_to_message.from_user.full_name or "Unknown"
@@ -1083,54 +3044,452 @@ def handle_photo_message(message):
         quoted = ""
 
     try:
-        file_info = bot.get_file(message.photo[-1].file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-
-        # Создаём временный файл и сохраняем туда фото
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp_file:
-            temp_path = tmp_file.name
-            logging.info(f"[TEMP FILE] Сохраняем фото во временный файл: {temp_path}")
-            tmp_file.write(downloaded_file)
-
         caption = message.caption or ""
         full_caption = f"{quoted}{caption}"
-        send_photo_to_discord(full_caption, temp_path, username=user_display, avatar_url=avatar_url)
+        relay_telegram_photo(full_caption, message.photo[-1].file_id, username=user_display, avatar_url=avatar_url, source_id=f"{message.chat.id}:{message.message_id}", webhook_url=config["discord_webhook_url"])
 
     except Exception as e:
         logging.error(f"Ошибка при обработке фото: {e}")
 
-    finally:
-        try:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-        except Exception as e:
-            logging.warning(f"❗ Не удалось удалить временный файл: {e}")
-
 # ==== НАСТРОЙКА РАСПИСАНИЯ (1 раз в 4 часа) ====
-schedule.every(4).hours.do(send_price_image)
+schedule.every(4).hours.do(leader_only(send_price_image))
 
 def run_scheduler():
     while True:
         schedule.run_pending()
         time.sleep(60)
 
-# ==== ЗАПУСК ====
-logging.info("Бот запущен.")
+# ==== ДИСПЕТЧЕР ОБНОВЛЕНИЙ ====
+# Обновления раскладываются по DISPATCH_WORKERS очередям по chat_id: разные чаты обрабатываются
+# параллельно, а внутри одного чата — строго по порядку (ответы викторины судятся в порядке прихода).
+# Полная очередь блокирует источник обновлений (backpressure).
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "8"))
+DISPATCH_QUEUE_SIZE = int(os.getenv("DISPATCH_QUEUE_SIZE", "100"))   # На каждый поток
+LATENCY_BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+dispatch_queues = [queue.Queue(maxsize=DISPATCH_QUEUE_SIZE) for _ in range(DISPATCH_WORKERS)]
+_latency_lock = threading.Lock()
+handler_latency = {}                                       # имя обработчика → {"buckets", "count", "total", "max"}
+
+# Ключ упорядочивания: чат обновления (без чата — само обновление)
+def update_chat_id(update):
+    message = update.message or update.edited_message or update.channel_post
+    if message is None and update.callback_query:
+        message = update.callback_query.message
+    return message.chat.id if message else update.update_id
+
+# Постановка в очередь; timeout=None — ждать места, иначе queue.Full по истечении
+def dispatch_update(update, timeout=None):
+    dispatch_queues[hash(update_chat_id(update)) % DISPATCH_WORKERS].put(update, timeout=timeout)
+
+def dispatch_worker(updates):
+    while True:
+        update = updates.get()
+        try:
+            remember_update_user(update)
+            bot.process_new_updates([update])
+        except Exception as e:
+            logging.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+        finally:
+            updates.task_done()
+
+def record_handler_latency(name, elapsed_ms):
+    with _latency_lock:
+        stats = handler_latency.setdefault(name, {"buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1), "count": 0, "total": 0.0, "max": 0.0})
+        index = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if elapsed_ms <= bound), len(LATENCY_BUCKETS_MS))
+        stats["buckets"][index] += 1
+        stats["count"] += 1
+        stats["total"] += elapsed_ms
+        stats["max"] = max(stats["max"], elapsed_ms)
+
+def timed_handler(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record_handler_latency(func.__name__, (time.perf_counter() - started) * 1000)
+    return wrapper
+
+# Оборачиваем все зарегистрированные обработчики замером времени
+def instrument_handlers():
+    for handler in bot.message_handlers + bot.callback_query_handlers:
+        handler["function"] = timed_handler(handler["function"])
+
+# Гистограммы задержек обработчиков и глубина очередей
+def log_handler_latency():
+    with _latency_lock:
+        snapshot = {name: dict(stats, buckets=list(stats["buckets"])) for name, stats in handler_latency.items()}
+    labels = [f"≤{bound}" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}"]
+    for name, stats in sorted(snapshot.items()):
+        histogram = " ".join(f"{label}:{count}" for label, count in zip(labels, stats["buckets"]) if count)
+        logging.info(f"[LATENCY] {name}: n={stats['count']} avg={stats['total'] / stats['count']:.1f} мс max={stats['max']:.1f} мс | {histogram}")
+    logging.info(f"[DISPATCH] Очереди: {[q.qsize() for q in dispatch_queues]}")
+    logging.info(f"[TIMERS] Игровых таймеров: {game_clock.pending()}, сообщений к удалению: {pending_deletions_count()}")
+
+schedule.every(10).minutes.do(log_handler_latency)
+
+# Long polling: обновления забираем сами и отдаём диспетчеру
+# С общим хранилищем getUpdates вызывает только лидер (иначе Telegram ответит 409), остальные ждут.
+# Telegram считает пачку подтверждённой только при следующем запросе с новым offset, поэтому offset
+# переживает перезапуск цикла после ошибки — иначе уже обработанная пачка пришла бы второй раз
+update_offset = None
+
+def wait_for_leadership():
+    while not is_leader():
+        time.sleep(1)
+
+def poll_updates():
+    global update_offset
+    wait_for_leadership()
+    bot.remove_webhook()
+    logging.info("Стартуем polling...")
+    while is_leader():
+        for update in bot.get_updates(offset=update_offset, timeout=60, long_polling_timeout=60):
+            update_offset = update.update_id + 1
+            dispatch_update(update)
+
+# ==== АСИНХРОННЫЙ РЕЖИМ ====
+# BOT_RUNTIME=async — обновления забираются через aiohttp в одном event loop с общим пулом соединений.
+# /price обрабатывается прямо в event loop: цена — через aiohttp (те же провайдеры и хеджирование),
+# картинка рендерится в пуле потоков, фото уходит через aiohttp. Поэтому сотня /price одновременно —
+# это сотня запросов в полёте, а не очередь в одном потоке диспетчера. Остальные обработчики
+# по-прежнему выполняют потоки диспетчера. Сравнение режимов: python bench_runtime.py
+BOT_RUNTIME = os.getenv("BOT_RUNTIME", "threaded")         # threaded | async
+ASYNC_MAX_TASKS = int(os.getenv("ASYNC_MAX_TASKS", "100"))  # Сколько /price одновременно обрабатывается в event loop
+
+_price_task = None                                         # Текущий запрос цены в event loop (single-flight)
+
+def remove_lock_file():
+    if os.path.exists(LOCK_FILE):
+        os.remove(LOCK_FILE)
+        logging.info("Lock-файл удалён. Бот завершил работу.")
+
+# Вызов метода Bot API; возвращает result, ошибку Telegram поднимает как ValueError
+async def telegram_api(session, method, **kwargs):
+    api_url = telebot.apihelper.API_URL or "https://api.telegram.org/bot{0}/{1}"
+    async with session.post(api_url.format(TOKEN, method), **kwargs) as response:
+        data = await response.json(content_type=None)
+    if not data.get("ok"):
+        raise ValueError(f"{method}: {data.get('description')}")
+    return data["result"]
+
+async def fetch_from_provider_async(session, name):
+    url, parse = PRICE_PROVIDERS[name]
+    started = time.perf_counter()
+    try:
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+            if response.status != 200:
+                raise ValueError(f"HTTP {response.status}")
+            price = round(float(parse(await response.json(content_type=None))), 2)
+        if price <= 0:
+            raise ValueError(f"некорректная цена {price}")
+    except Exception as e:
+        record_provider_result(name, None)
+        logging.warning(f"[PRICE] Ошибка провайдера {name}: {e}")
+        raise
+    record_provider_result(name, time.perf_counter() - started)
+    return price
+
+# То же хеджирование, что в fetch_btc_price, но задачами event loop
+async def fetch_btc_price_async(session):
+    candidates = ranked_providers()
+    pending = set()
+    launched = 0
+
+    def launch_next():
+        nonlocal launched
+        pending.add(asyncio.ensure_future(fetch_from_provider_async(session, candidates[launched])))
+        launched += 1
+
+    if candidates:
+        launch_next()
+    try:
+        while pending:
+            timeout = PRICE_HEDGE_DELAY if launched < len(candidates) else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+            if launched < len(candidates):
+                launch_next()
+    finally:
+        for task in pending:
+            task.cancel()
+
+    logging.error("Ошибка при получении цены BTC: ни один провайдер не ответил")
+    return 0.0
 
-# Поток для schedule
-threading.Thread(target=run_scheduler, daemon=True).start()
+async def refresh_btc_price_async(session):
+    global _price_task
+    try:
+        price = await fetch_btc_price_async(session)
+        if price:
+            set_price_snapshot(price)
+    finally:
+        _price_task = None
+
+# Как get_btc_price: свежая цена — сразу, устаревшая — сразу + обновление, нет — ждём один общий запрос
+async def get_btc_price_async(session):
+    global _price_task
+    with _price_lock:
+        value, age = _price_value, time.monotonic() - _price_time
+    if value and age < PRICE_TTL:
+        return value
+
+    if _price_task is None:
+        _price_task = asyncio.ensure_future(refresh_btc_price_async(session))
+    task = _price_task
+    if value and age < PRICE_MAX_STALE:
+        return value
 
-# Основной поток - polling с автоматическим перезапуском
-while True:
     try:
-        bot.remove_webhook()
-        logging.info("Стартуем polling...")
-        bot.polling(none_stop=True, timeout=60, long_polling_timeout=60)
+        await asyncio.wait_for(asyncio.shield(task), timeout=15)
+    except asyncio.TimeoutError:
+        pass
+    with _price_lock:
+        return _price_value if time.monotonic() - _price_time < PRICE_MAX_STALE else 0.0
+
+# send_cached_photo для event loop
+async def send_cached_photo_async(session, chat_id, photo, caption=None):
+    data = photo.getvalue()
+    digest = hashlib.sha256(data).hexdigest()
+    now = time.time()
+
+    entry = cached_file_id(digest, now)
+    if entry:
+        try:
+            result = await telegram_api(session, "sendPhoto", json={"chat_id": chat_id, "photo": entry["file_id"], "caption": caption})
+            logging.info(f"[FILE_ID] Фото отправлено из кэша ({len(data) // 1024} КБ не загружено)")
+            return result
+        except ValueError as e:
+            logging.warning(f"[FILE_ID] file_id больше не принимается, загружаем заново: {e}")
+            with _file_id_lock:
+                file_id_cache.pop(digest, None)
+
+    form = aiohttp.FormData()
+    form.add_field("chat_id", str(chat_id))
+    if caption:
+        form.add_field("caption", caption)
+    form.add_field("photo", data, filename="photo.jpg", content_type="image/jpeg")
+    result = await telegram_api(session, "sendPhoto", data=form)
+    if result.get("photo"):
+        remember_file_id(digest, result["photo"][-1]["file_id"], now)
+    return result
+
+# /price в event loop: ожидание цены и Telegram не занимает потоки, рендер — в пуле потоков
+async def handle_price_async(session, message):
+    started = time.perf_counter()
+    try:
+        config = chat_config(message.chat.id)
+        if config:
+            price = await get_btc_price_async(session)
+            if price == 0.0:
+                await telegram_api(session, "sendMessage", json={"chat_id": message.chat.id, "text": "Не удалось получить цену BTC.", "reply_to_message_id": message.message_id})
+                return
+            photo = await asyncio.get_running_loop().run_in_executor(None, create_price_image, price, config["background"])
+            if photo:
+                await send_cached_photo_async(session, message.chat.id, photo, caption=f"Greetings Adventurers! Current #price $BTC: ${price}")
+                logging.info(f"{message.from_user.username or message.from_user.id} использовал команду /price. Цена BTC: ${price}")
     except Exception as e:
-        logging.error(f"[POLLING ERROR] {e}")
-        time.sleep(15)                               # Подождать 15 секунд перед повтором
+        logging.error(f"Ошибка в обработчике /price: {e}")
     finally:
-        # Удаляем lock-файл при аварийном завершении
-        if os.path.exists(LOCK_FILE):
-            os.remove(LOCK_FILE)
-            logging.info("Lock-файл удалён. Бот завершил работу.")
+        schedule_delete(message.chat.id, message.message_id, 5)
+        record_handler_latency("handle_price_async", (time.perf_counter() - started) * 1000)
+
+def is_price_command(update):
+    message = update.message
+    return message is not None and message.content_type == "text" and telebot.util.extract_command(message.text) == "price"
+
+async def poll_updates_async():
+    global update_offset
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(ASYNC_MAX_TASKS)
+    tasks = set()
+    webhook_removed = False
+    delay = 1
+
+    def task_done(task):
+        tasks.discard(task)
+        slots.release()
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=90)) as session:
+        logging.info("Стартуем асинхронный polling...")
+        while True:
+            if not is_leader():
+                await asyncio.sleep(1)
+                continue
+            try:
+                if not webhook_removed:
+                    await telegram_api(session, "deleteWebhook")
+                    webhook_removed = True
+                params = {"timeout": 60}
+                if update_offset is not None:
+                    params["offset"] = update_offset
+                updates = await telegram_api(session, "getUpdates", json=params)
+                delay = 1
+            except Exception as e:
+                logging.error(f"[POLLING ERROR] {e}")
+                await asyncio.sleep(delay)                 # Пауза растёт при повторных ошибках
+                delay = min(delay * 2, 60)
+                continue
+
+            for raw in updates:
+                update_offset = raw["update_id"] + 1
+                update = telebot.types.Update.de_json(raw)
+                if is_price_command(update):
+                    remember_update_user(update)
+                    await slots.acquire()                  # Не больше ASYNC_MAX_TASKS одновременно
+                    task = asyncio.create_task(handle_price_async(session, update.message))
+                    tasks.add(task)
+                    task.add_done_callback(task_done)
+                    continue
+                await loop.run_in_executor(None, dispatch_update, update)   # Ждём, если очередь чата полна
+
+# ==== РЕЖИМ WEBHOOK ====
+# BOT_MODE=webhook — Telegram сам присылает обновления на встроенный HTTP-сервер.
+# Сервер проверяет секрет, сразу отвечает 200 и передаёт обновление диспетчеру.
+BOT_MODE = os.getenv("BOT_MODE", "polling")               # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")                 # Публичный адрес, например https://app.herokuapp.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_ENQUEUE_TIMEOUT = 5                                # Сколько ждать места в очереди до ответа 503
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.send_response(404)
+            self.end_headers()
+            return
+        token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            logging.warning(f"[WEBHOOK] Запрос с неверным секретом от {self.client_address[0]}")
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            dispatch_update(telebot.types.Update.de_json(body.decode("utf-8")), timeout=WEBHOOK_ENQUEUE_TIMEOUT)
+        except ValueError as e:
+            logging.warning(f"[WEBHOOK] Некорректное обновление: {e}")
+            self.send_response(400)
+            self.end_headers()
+            return
+        except queue.Full:
+            # Telegram повторит доставку позже
+            logging.warning("[WEBHOOK] Очередь обновлений переполнена, отвечаем 503")
+            self.send_response(503)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug(f"[WEBHOOK] {self.client_address[0]} {format % args}")
+
+def run_webhook():
+    global WEBHOOK_SECRET
+    if not WEBHOOK_URL:
+        logging.critical("BOT_MODE=webhook, но WEBHOOK_URL не задан.")
+        sys.exit(1)
+
+    # Без секрета любой, кто узнал адрес, мог бы присылать поддельные обновления
+    if not WEBHOOK_SECRET:
+        if state_backend.shared:
+            # Секрет общий для всех экземпляров — случайный у каждого свой, и set_webhook перетирал бы чужой
+            logging.critical("BOT_MODE=webhook с общим хранилищем требует WEBHOOK_SECRET.")
+            sys.exit(1)
+        WEBHOOK_SECRET = secrets.token_urlsafe(32)
+        logging.info("WEBHOOK_SECRET не задан — сгенерирован случайный секрет до перезапуска")
+
+    bot.remove_webhook()
+    bot.set_webhook(url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    server = ThreadingHTTPServer(("0.0.0.0", WEBHOOK_PORT), WebhookHandler)
+    logging.info(f"Стартуем webhook на порту {WEBHOOK_PORT}...")
+    server.serve_forever()
+
+# ==== ЗАПУСК ====
+# Только при запуске скриптом: импорт модуля (например, в тестах) не запускает потоки и polling
+if __name__ == "__main__":
+    acquire_lock_file()
+    logging.info("Бот запущен.")
+
+    # Поток для schedule
+    threading.Thread(target=run_scheduler, daemon=True).start()
+
+    # Поток записи очков в базу
+    threading.Thread(target=run_score_flusher, daemon=True).start()
+
+    # Общее хранилище: выборы лидера и игровые таймеры
+    if state_backend.shared:
+        threading.Thread(target=run_leader_election, daemon=True).start()
+        threading.Thread(target=run_shared_timers, daemon=True).start()
+
+    # SIGTERM (перезапуск на хостинге): сохраняем очки и выходим штатно
+    def handle_sigterm(signum, frame):
+        logging.info("Получен SIGTERM, сохраняем данные и завершаем работу.")
+        flush_scores()
+        if state_backend.shared:
+            state_backend.release_lease("scheduler")           # Новый экземпляр станет лидером сразу
+        remove_lock_file()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    # Потоки диспетчера обновлений
+    instrument_handlers()
+    for updates in dispatch_queues:
+        threading.Thread(target=dispatch_worker, args=(updates,), daemon=True).start()
+
+    # Потоки пересылки в Discord
+    for _ in range(DISCORD_WORKERS):
+        threading.Thread(target=discord_worker, daemon=True).start()
+
+    # Поток игровых часов (викторина, /roll)
+    threading.Thread(target=game_clock.run_forever, args=(GAME_CLOCK_WORKERS,), daemon=True).start()
+
+    # Поток перезагрузки файла вопросов
+    threading.Thread(target=run_trivia_watcher, daemon=True).start()
+
+    # Поток удаления сообщений по расписанию
+    threading.Thread(target=run_deletion_scheduler, daemon=True).start()
+
+    # Поток фонового тикера цены
+    if PRICE_TICKER:
+        threading.Thread(target=run_price_ticker, daemon=True).start()
+
+    if BOT_MODE == "webhook":
+        BOT_RUNTIME = "webhook"
+    elif BOT_RUNTIME == "async" and aiohttp is None:
+        logging.warning("BOT_RUNTIME=async требует пакет aiohttp. Работаем в обычном режиме.")
+        BOT_RUNTIME = "threaded"
+
+    # Основной поток - webhook или polling с автоматическим перезапуском
+    if BOT_RUNTIME == "webhook":
+        try:
+            run_webhook()
+        finally:
+            remove_lock_file()
+    elif BOT_RUNTIME == "async":
+        try:
+            asyncio.run(poll_updates_async())
+        finally:
+            remove_lock_file()
+    else:
+        delay = 1
+        while True:
+            started = time.monotonic()
+            try:
+                poll_updates()
+            except Exception as e:
+                logging.error(f"[POLLING ERROR] {e}")
+                if time.monotonic() - started > 300:
+                    delay = 1                            # Долго работали без ошибок — начинаем паузы заново
+                time.sleep(delay)                        # Пауза растёт при повторных ошибках: 1, 2, 4 ... 60 сек
+                delay = min(delay * 2, 60)
+            finally:
+                # Удаляем lock-файл при аварийном завершении
+                remove_lock_file()
@@ -11,6 +11,9 @@ commands = [
     {"command": "roll", "description": "ROLL"},
     {"command": "reroll", "description": "Throw the dice"},
     {"command": "score", "description": "Leaderboard"},
+    {"command": "myrank", "description": "Your place in the leaderboard"},
+    {"command": "top", "description": "Top players card"},
+    {"command": "fastest", "description": "Fastest trivia answers"},
     {"command": "gm", "description": "Good morning RPDAO"},
     {"command": "gn", "description": "Good night RPDAO"},
     {"command": "start_roll", "description": "Start ROLL (only admins)"},
@@ -0,0 +1,27 @@
+# Общая фикстура: модуль бота, импортированный во временной папке без Telegram.
+import importlib
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+CHAT_ID = -100
+
+@pytest.fixture(scope="session")
+def btc_bot(tmp_path_factory):
+    # Бот создаёт базы и файлы в текущей папке — импортируем его во временной
+    workdir = tmp_path_factory.mktemp("bot")
+    (workdir / "trivia_questions.txt").write_text("Столица Франции:Париж|Paris\n", encoding="utf-8")
+    old_cwd, old_env = os.getcwd(), dict(os.environ)
+    os.chdir(workdir)
+    os.environ.update(TELEGRAM_TOKEN="123:test", CHAT_ID=str(CHAT_ID), STATE_BACKEND="memory")
+    sys.path.insert(0, str(ROOT))
+    try:
+        yield importlib.import_module("btc_bot")
+    finally:
+        sys.path.remove(str(ROOT))
+        os.chdir(old_cwd)
+        os.environ.clear()
+        os.environ.update(old_env)
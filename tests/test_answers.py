@@ -0,0 +1,52 @@
+# Сравнение ответов викторины: нормализация, допустимые опечатки и несколько вариантов через '|'.
+import random
+
+import pytest
+
+def levenshtein(a, b):
+    prev = list(range(len(b) + 1))
+    for i, char in enumerate(a, start=1):
+        cur = [i]
+        for j, other in enumerate(b, start=1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (char != other)))
+        prev = cur
+    return prev[-1]
+
+def test_bounded_distance_matches_levenshtein(btc_bot):
+    rng = random.Random(24)
+    for _ in range(3000):
+        a = "".join(rng.choice("абвг") for _ in range(rng.randint(0, 9)))
+        b = "".join(rng.choice("абвг") for _ in range(rng.randint(0, 9)))
+        k = rng.randint(0, 3)
+        assert btc_bot.bounded_distance(a, b, k) == min(levenshtein(a, b), k + 1), (a, b, k)
+
+@pytest.mark.parametrize("message", ["ежик в тумане", "ЁЖИК В ТУМАНЕ!", "  Ёжик, в   тумане... "])
+def test_yo_case_and_punctuation_are_ignored(btc_bot, message):
+    assert btc_bot.compile_answer("Ёжик в тумане").matches(message)
+
+@pytest.mark.parametrize("answer, message, expected", [
+    ("Вашингтон", "Вашингтн", True),                      # Длинное слово — одна опечатка прощается
+    ("Александрия", "Алесандрея", True),                  # Больше 9 букв — две
+    ("Вашингтон", "Вшнгтон", False),
+    ("1961", "1962", False),                               # Числа — только точно
+    ("1961", "1961", True),
+    ("Гагарин 1961", "Гагарин 1691", False),
+    ("Марс", "Мари", False),                               # Короткие слова — только точно
+    ("Марс", "марс", True),
+])
+def test_typo_tolerance(btc_bot, answer, message, expected):
+    assert btc_bot.compile_answer(answer).matches(message) is expected
+
+def test_several_answers(btc_bot):
+    matcher = btc_bot.compile_answer("Париж|Paris| Lutetia ")
+    assert all(matcher.matches(text) for text in ("париж", "PARIS", "Lutetia", "Lutecia"))
+    assert not matcher.matches("Лондон")
+    assert btc_bot.primary_answer("Париж|Paris") == "Париж"
+
+def test_symbol_only_answer_is_compared_as_is(btc_bot):
+    matcher = btc_bot.compile_answer("🍕|?!")
+    assert matcher.matches("🍕") and matcher.matches(" 🍕 ") and matcher.matches("?!")
+    assert not any(matcher.matches(text) for text in ("🍔", "!", "", "   ", "пицца"))
+
+def test_long_message_is_rejected_without_matching(btc_bot):
+    assert not btc_bot.compile_answer("Париж").matches("Париж " * 100)
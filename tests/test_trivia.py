@@ -0,0 +1,92 @@
+# Прогон раунда викторины на виртуальных игровых часах: вопрос → подсказка → ответ → следующий вопрос.
+# Telegram не нужен: send_message подменяется, время двигает GameClock.advance().
+import time
+import types
+
+from conftest import CHAT_ID
+
+def text_message(message_id, text, user_id=7, name="Alice"):
+    user = types.SimpleNamespace(id=user_id, is_bot=False, first_name=name, username=name.lower(), full_name=name)
+    return types.SimpleNamespace(
+        message_id=message_id, date=int(time.time()), text=text, from_user=user,
+        chat=types.SimpleNamespace(id=CHAT_ID, type="supergroup"), reply_to_message=None,
+    )
+
+def test_trivia_round_on_virtual_clock(btc_bot, monkeypatch):
+    clock = btc_bot.GameClock(virtual=True)
+    monkeypatch.setattr(btc_bot, "game_clock", clock)
+    monkeypatch.setattr(btc_bot, "schedule_delete", lambda *args, **kwargs: None)
+    sent = []
+
+    def send_message(chat_id, text, **kwargs):
+        sent.append(text)
+        return types.SimpleNamespace(message_id=1000 + len(sent), date=int(time.time()))
+
+    monkeypatch.setattr(btc_bot.bot, "send_message", send_message)
+
+    with btc_bot.chat_session(CHAT_ID) as state:
+        state.trivia_running = True
+        btc_bot.schedule_next_trivia(state, 60)
+
+    # Вопрос — через минуту после запуска
+    clock.advance(59)
+    assert sent == []
+    clock.advance(1)
+    assert sent[-1].endswith("Столица Франции")
+    assert state.trivia_active and state.trivia_question_id == 1
+
+    # Подсказка через 15 секунд открывает одну букву основного ответа
+    clock.advance(15)
+    assert "Подсказка" in sent[-1]
+    assert sent[-1].splitlines()[-1].count("-") == len("Париж") - 1
+
+    # Верный ответ (второй вариант из «Париж|Paris», в другом регистре) — победа и очки
+    btc_bot.handle_text_messages(text_message(1000 + len(sent) + 1, "PARIS"))
+    assert "Alice угадал слово" in sent[-1]
+    assert btc_bot.scores[str(CHAT_ID)]["7"] == 5
+    assert not state.trivia_active and state.trivia_winner == 7
+
+    # Повторный верный ответ другого игрока очков не даёт
+    messages = len(sent)
+    btc_bot.handle_text_messages(text_message(1000 + len(sent) + 2, "Париж", user_id=8, name="Bob"))
+    assert len(sent) == messages
+    assert "8" not in btc_bot.scores[str(CHAT_ID)]
+
+    # Подсказки остановлены, следующий вопрос — через 15 секунд после ответа
+    clock.advance(14)
+    assert len(sent) == messages
+    clock.advance(1)
+    assert sent[-1].endswith("Столица Франции")
+    assert state.trivia_active and state.trivia_question_id == 2
+    assert state.trivia_answers == {}
+
+def test_shuffled_index_is_a_permutation(btc_bot):
+    for n in (1, 2, 3, 7, 64, 1000, 4099):
+        for seed in (0, 1, 2 ** 61 + 12345):
+            assert sorted(btc_bot.shuffled_index(p, n, seed) for p in range(n)) == list(range(n))
+
+def test_trivia_start_rejects_unknown_section(btc_bot, monkeypatch, tmp_path):
+    path = tmp_path / "sections.txt"
+    path.write_text("[история:легко]\nПервый в космосе:Гагарин\n[наука]\nКрасная планета:Марс\n", encoding="utf-8")
+    monkeypatch.setattr(btc_bot, "TRIVIA_INDEX_FILE", str(tmp_path / "sections.idx"))
+    monkeypatch.setattr(btc_bot, "question_bank", btc_bot.QuestionBank.open(str(path)))
+    monkeypatch.setattr(btc_bot, "schedule_delete", lambda *args, **kwargs: None)
+    monkeypatch.setattr(btc_bot, "schedule_next_trivia", lambda *args, **kwargs: None)
+    monkeypatch.setattr(btc_bot.bot, "get_chat_member", lambda chat_id, user_id: types.SimpleNamespace(status="creator"))
+    replies = []
+    monkeypatch.setattr(btc_bot.bot, "reply_to", lambda message, text, **kwargs: replies.append(text) or types.SimpleNamespace(message_id=1))
+    monkeypatch.setattr(btc_bot.bot, "send_message", lambda chat_id, text, **kwargs: types.SimpleNamespace(message_id=2))
+    with btc_bot.chat_session(CHAT_ID) as state:
+        state.trivia_running = False
+
+    btc_bot.handle_trivia_start(text_message(1, "/rpdao_trivia история сложно"))
+    assert "Разделы: история:легко, наука" in replies[-1]
+    with btc_bot.chat_session(CHAT_ID) as state:
+        assert not state.trivia_running
+
+    btc_bot.handle_trivia_start(text_message(2, "/rpdao_trivia история"))
+    with btc_bot.chat_session(CHAT_ID) as state:
+        assert state.trivia_running
+        assert (state.trivia_category, state.trivia_difficulty) == ("история", None)
+        state.trivia_running = False
+    assert len(replies) == 1